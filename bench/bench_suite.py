@@ -0,0 +1,580 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim :set ft=py:
+
+""" Benchmark suite for bloscpack.
+
+Runs a set of scenarios over a sweep of Blosc and Bloscpack settings, with
+warm-up runs and repeated measurements, prints a summary table and writes the
+results as JSON. Results can be compared against a baseline, saved earlier
+as JSON, exiting with a non-zero status on significant regressions.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import itertools
+import json
+import math
+import os
+import os.path as path
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import blosc
+import numpy as np
+import bloscpack
+import datasets
+
+# percentiles reported for every scenario
+PERCENTILES = (10, 50, 90, 99)
+
+SCENARIOS = ('pack', 'unpack', 'append', 'random_access', 'open',
+             'ndarray', 'small_str')
+
+
+def comma_list(type_):
+    """ Argparse type for comma separated lists. """
+    def parse(value):
+        return [type_(v) for v in value.split(',')]
+    return parse
+
+
+def size_list(value):
+    return [bloscpack.reverse_pretty(v) for v in value.split(',')]
+
+
+def summarize(times, nbytes):
+    """ Compute statistics of the measured times.
+
+    Parameters
+    ----------
+    times : list of float
+        the duration of each repetition in seconds
+    nbytes : int
+        the number of bytes processed in each repetition
+
+    Returns
+    -------
+    stats : dict
+        the latency percentiles in seconds and, if 'nbytes' is non-zero, the
+        throughput percentiles in MB/s
+
+    """
+    times = np.asarray(times)
+    stats = {'repeats': len(times),
+             'mean_s': float(times.mean()),
+             'stdev_s': float(times.std()),
+             'latency_s': dict(('p%d' % p, float(np.percentile(times, p)))
+                               for p in PERCENTILES),
+             }
+    if nbytes:
+        # the lowest latency is the highest throughput
+        stats['throughput_mbs'] = dict(
+                ('p%d' % p, float(nbytes / 2**20 /
+                                  np.percentile(times, 100 - p)))
+                for p in PERCENTILES)
+    return stats
+
+
+def measure(func, setup=None, repeats=5, warmup=1):
+    """ Time a function after some warm-up runs.
+
+    Parameters
+    ----------
+    func : callable
+        the function to time, called without arguments
+    setup : callable or None
+        called before every run, not timed
+    repeats : int
+        the number of timed runs
+    warmup : int
+        the number of runs before the timed ones
+
+    Returns
+    -------
+    times : list of float
+        the duration of each timed run in seconds
+
+    """
+    times = []
+    for i in range(warmup + repeats):
+        if setup is not None:
+            setup()
+        tic = time.time()
+        func()
+        toc = time.time()
+        if i >= warmup:
+            times.append(toc - tic)
+    return times
+
+
+class Scenarios(object):
+    """ The scenarios, run for a single combination of settings.
+
+    Parameters
+    ----------
+    tdir : str
+        the directory for temporary files
+    in_file : str
+        the file with the input data
+    settings : dict
+        the Blosc arguments, the chunk size, the number of threads and the
+        cache mode
+    repeats : int
+        the number of timed runs
+    warmup : int
+        the number of runs before the timed ones
+
+    Notes
+    -----
+    In both cache modes, the outputs of a scenario are removed before every
+    run, outside of the timed region, so that neither the write back nor the
+    truncation of the previous output is timed. In the 'cold' cache mode, the
+    input and compressed files are evicted from the page cache as well, so
+    that reads hit the disk.
+
+    """
+
+    def __init__(self, tdir, in_file, settings, repeats, warmup):
+        self.tdir = tdir
+        self.in_file = in_file
+        self.size = path.getsize(in_file)
+        self.out_file = path.join(tdir, 'data.blp')
+        self.dcmp_file = path.join(tdir, 'data.dcmp')
+        self.blosc_args = dict((arg, settings[arg])
+                               for arg in bloscpack.BLOSC_ARGS)
+        self.chunk_size = settings['chunk_size']
+        self.cold = settings['cache'] == 'cold'
+        self.repeats = repeats
+        self.warmup = warmup
+
+    def _measure(self, func, setup=None, repeats=None, outputs=(),
+            inputs=()):
+        def prepare():
+            for name in outputs:
+                if path.exists(name):
+                    os.remove(name)
+            if setup is not None:
+                setup()
+            if self.cold:
+                for name in (self.in_file, self.out_file) + tuple(inputs):
+                    if path.exists(name):
+                        bloscpack.drop_file_cache(name)
+        return measure(func, setup=prepare,
+                       repeats=repeats or self.repeats, warmup=self.warmup)
+
+    def _pack(self):
+        bloscpack.pack_file(self.in_file, self.out_file,
+                chunk_size=self.chunk_size, blosc_args=self.blosc_args)
+
+    def pack(self):
+        times = self._measure(self._pack, outputs=[self.out_file])
+        return times, self.size, {'ratio': path.getsize(self.out_file) /
+                                  self.size}
+
+    def unpack(self):
+        self._pack()
+        times = self._measure(lambda: bloscpack.unpack_file(self.out_file,
+                                                            self.dcmp_file),
+                              outputs=[self.dcmp_file])
+        return times, self.size, {}
+
+    def append(self):
+        self._pack()
+        orig_file = path.join(self.tdir, 'orig.blp')
+        new_size = min(self.size, self.chunk_size * 4)
+        new_file = path.join(self.tdir, 'new.dat')
+        with open(self.in_file, 'rb') as in_fp:
+            with open(new_file, 'wb') as new_fp:
+                new_fp.write(in_fp.read(new_size))
+
+        def copy_orig():
+            # the copy is written back before the append is timed
+            shutil.copy(self.out_file, orig_file)
+            with open(orig_file, 'rb') as fp:
+                os.fsync(fp.fileno())
+        times = self._measure(
+                lambda: bloscpack.append(orig_file, new_file,
+                                         blosc_args=self.blosc_args),
+                setup=copy_orig, outputs=[orig_file],
+                inputs=[orig_file, new_file])
+        return times, new_size, {}
+
+    def random_access(self, nreads=16):
+        self._pack()
+        with open(self.out_file, 'rb') as fp:
+            nchunks = bloscpack._read_bloscpack_header(fp).nchunks
+        random = np.random.RandomState(42)
+        indices = [list(random.randint(0, nchunks, nreads))
+                   for _ in range(self.warmup + self.repeats)]
+        batches = iter(indices)
+        times = self._measure(lambda: bloscpack.read_chunks(self.out_file,
+                                                            next(batches)))
+        return times, 0, {'chunks_per_read': nreads}
+
+    def open(self):
+        self._pack()
+
+        def open_file():
+            with open(self.out_file, 'rb') as fp:
+                bloscpack._read_beginning(fp)
+        return self._measure(open_file, repeats=self.repeats * 10), 0, {}
+
+    def ndarray(self):
+        dtype = {2: np.uint16, 4: np.uint32, 8: np.float64}.get(
+                self.blosc_args['typesize'], np.uint8)
+        ndarray = np.fromfile(self.in_file, dtype=dtype)
+        ndarray_file = path.join(self.tdir, 'ndarray.blp')
+
+        def round_trip():
+            bloscpack.pack_ndarray_file(ndarray, ndarray_file,
+                    chunk_size=self.chunk_size, blosc_args=self.blosc_args)
+            bloscpack.unpack_ndarray_file(ndarray_file)
+        # every byte is both packed and unpacked
+        return (self._measure(round_trip, outputs=[ndarray_file]),
+                ndarray.nbytes * 2, {})
+
+    def small_str(self, nitems=1000):
+        ndarray = np.arange(nitems, dtype=np.int32)
+        blosc_args = dict(self.blosc_args, typesize=ndarray.itemsize)
+        times = self._measure(lambda: bloscpack.unpack_ndarray_str(
+            bloscpack.pack_ndarray_str(ndarray, blosc_args=blosc_args)),
+            repeats=self.repeats * 10)
+        return times, 0, {'nbytes': ndarray.nbytes}
+
+
+def sweep(args):
+    """ All combinations of settings to run. """
+    keys = ('dataset', 'cname', 'clevel', 'shuffle', 'typesize',
+            'chunk_size', 'nthreads', 'cache')
+    # without a typesize, use the one of the dataset
+    typesizes = args.typesize or [None]
+    for values in itertools.product(args.dataset, args.cname, args.clevel,
+            args.shuffle, typesizes, args.chunk_size, args.nthreads,
+            args.cache):
+        settings = dict(zip(keys, values))
+        if settings['typesize'] is None:
+            settings['typesize'] = datasets.typesize(settings['dataset'])
+        yield settings
+
+
+def run(args):
+    """ Run all scenarios for all settings, return the results. """
+    results = []
+    tdir = tempfile.mkdtemp(prefix='blpk-bench')
+    try:
+        for settings in sweep(args):
+            in_file = path.join(tdir, '%s.dat' % settings['dataset'])
+            if not path.exists(in_file):
+                datasets.write(settings['dataset'], in_file, args.size,
+                               seed=args.seed)
+            blosc.set_nthreads(settings['nthreads'])
+            scenarios = Scenarios(tdir, in_file, settings,
+                                  args.repeats, args.warmup)
+            for name in args.scenarios:
+                times, nbytes, extra = getattr(scenarios, name)()
+                result = {'scenario': name,
+                          'settings': settings,
+                          'nbytes': nbytes,
+                          'times_s': times,
+                          'stats': summarize(times, nbytes),
+                          }
+                result.update(extra)
+                results.append(result)
+                print_result(result)
+    finally:
+        shutil.rmtree(tdir)
+    return results
+
+
+def settings_key(settings, cache=True):
+    key = '%s/%s/%d/%s/%d/%s/%d' % (settings.get('dataset', 'smooth'),
+            settings['cname'], settings['clevel'],
+            'shuffle' if settings['shuffle'] else 'noshuffle',
+            settings['typesize'],
+            bloscpack.pretty_size(settings['chunk_size']),
+            settings['nthreads'])
+    if cache:
+        key += '/' + settings.get('cache', 'warm')
+    return key
+
+
+def print_result(result):
+    stats = result['stats']
+    if 'throughput_mbs' in stats:
+        summary = 'MB/s p10 %9.1f p50 %9.1f p90 %9.1f' % tuple(
+                stats['throughput_mbs']['p%d' % p] for p in (10, 50, 90))
+    else:
+        summary = 'ms   p50 %9.3f p90 %9.3f p99 %9.3f' % tuple(
+                stats['latency_s']['p%d' % p] * 1000 for p in (50, 90, 99))
+    print('%-14s %-46s %s' % (result['scenario'],
+                              settings_key(result['settings']), summary))
+    sys.stdout.flush()
+
+
+def _erfc(x):
+    """ The complementary error function, with a fractional error below
+    1.2e-7, for Python 2.6, which has no ``math.erfc``.
+
+    From the Chebyshev fit in Numerical Recipes, section 6.2.
+    """
+    t = 1 / (1 + 0.5 * abs(x))
+    coefficients = (-1.26551223, 1.00002368, 0.37409196, 0.09678418,
+                    -0.18628806, 0.27886807, -1.13520398, 1.48851587,
+                    -0.82215223, 0.17087277)
+    polynomial = 0.0
+    for coefficient in reversed(coefficients):
+        polynomial = coefficient + t * polynomial
+    result = t * math.exp(-x * x + polynomial)
+    return result if x >= 0 else 2 - result
+
+
+erfc = getattr(math, 'erfc', _erfc)
+
+
+def mann_whitney(baseline, current):
+    """ One-sided Mann-Whitney U test that 'current' is slower.
+
+    Parameters
+    ----------
+    baseline, current : list of float
+        the measured times
+
+    Returns
+    -------
+    p : float
+        the p-value of the times in 'current' being larger, from the normal
+        approximation with a correction for ties
+
+    Notes
+    -----
+    The test only uses the ranks of the times, so that a few outliers, as are
+    common in timings, do not dominate the outcome.
+
+    """
+    n1, n2 = len(baseline), len(current)
+    values = np.concatenate([baseline, current])
+    order = values.argsort()
+    ranks = np.empty(len(values))
+    ranks[order] = np.arange(1, len(values) + 1)
+    # average the ranks of ties, and count them
+    counts = []
+    for value in np.unique(values):
+        tied = values == value
+        ranks[tied] = ranks[tied].mean()
+        counts.append(tied.sum())
+    counts = np.array(counts)
+    u = ranks[n1:].sum() - n2 * (n2 + 1) / 2
+    mean = n1 * n2 / 2
+    n = n1 + n2
+    variance = n1 * n2 / 12 * ((n + 1) -
+                               (counts ** 3 - counts).sum() / (n * (n - 1)))
+    if variance <= 0:
+        return 1.0
+    z = (u - mean - 0.5) / math.sqrt(variance)
+    return 0.5 * erfc(z / math.sqrt(2))
+
+
+def compare(baseline, current, tolerance, alpha):
+    """ Compare the results of two runs.
+
+    Parameters
+    ----------
+    baseline, current : dict
+        the reports of the runs
+    tolerance : float
+        the relative change of the median time that is tolerated
+    alpha : float
+        the significance level
+
+    Returns
+    -------
+    rows : list of dict
+        for each scenario and settings found in both runs, the median times,
+        the relative change, the p-values and a status of 'regression',
+        'improvement' or 'ok'
+
+    Notes
+    -----
+    A change is only flagged if it exceeds the tolerance and is significant.
+
+    """
+    def index(report):
+        return dict(((r['scenario'], settings_key(r['settings'])), r)
+                    for r in report['results'])
+    baseline_results = index(baseline)
+    current_results = index(current)
+    rows = []
+    for key in sorted(set(baseline_results) & set(current_results)):
+        old = baseline_results[key]['times_s']
+        new = current_results[key]['times_s']
+        change = np.median(new) / np.median(old) - 1
+        p_slower = mann_whitney(old, new)
+        p_faster = mann_whitney(new, old)
+        if change > tolerance and p_slower < alpha:
+            status = 'regression'
+        elif change < -tolerance and p_faster < alpha:
+            status = 'improvement'
+        else:
+            status = 'ok'
+        rows.append({'scenario': key[0],
+                     'settings': key[1],
+                     'baseline_s': float(np.median(old)),
+                     'current_s': float(np.median(new)),
+                     'change': float(change),
+                     'p': min(p_slower, p_faster),
+                     'status': status,
+                     })
+    for key in sorted(set(baseline_results) ^ set(current_results)):
+        print("warning: '%s %s' is only in the %s" % (key[0], key[1],
+              'baseline' if key in baseline_results else 'current results'))
+    return rows
+
+
+def print_comparison(rows):
+    print('%-14s %-46s %12s %12s %8s %7s %s' % ('scenario', 'settings',
+          'baseline ms', 'current ms', 'change', 'p', 'status'))
+    for row in rows:
+        print('%-14s %-46s %12.3f %12.3f %+7.1f%% %7.4f %s' % (
+              row['scenario'], row['settings'], row['baseline_s'] * 1000,
+              row['current_s'] * 1000, row['change'] * 100, row['p'],
+              row['status']))
+
+
+def print_cache_comparison(results):
+    """ Print the median times of the warm and cold runs side by side. """
+    medians = {}
+    for result in results:
+        key = (result['scenario'], settings_key(result['settings'],
+                                                cache=False))
+        medians.setdefault(key, {})[result['settings']['cache']] = \
+                result['stats']['latency_s']['p50']
+    print('%-14s %-46s %12s %12s %8s' % ('scenario', 'settings', 'warm ms',
+          'cold ms', 'cold/warm'))
+    for (scenario, key), median in sorted(medians.items()):
+        if 'warm' in median and 'cold' in median:
+            print('%-14s %-46s %12.3f %12.3f %8.2f' % (scenario, key,
+                  median['warm'] * 1000, median['cold'] * 1000,
+                  median['cold'] / median['warm']))
+
+
+def environment():
+    return {'bloscpack': bloscpack.__version__,
+            'blosc': blosc.__version__,
+            'numpy': np.__version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'ncores': blosc.ncores,
+            }
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-s', '--size', type=bloscpack.reverse_pretty,
+            default=bloscpack.reverse_pretty('64M'),
+            help='size of the input data (default: 64M)')
+    parser.add_argument('-r', '--repeats', type=int, default=5,
+            help='number of timed runs (default: 5)')
+    parser.add_argument('-w', '--warmup', type=int, default=1,
+            help='number of untimed warm-up runs (default: 1)')
+    parser.add_argument('-S', '--scenarios', type=comma_list(str),
+            default=list(SCENARIOS),
+            help='scenarios to run (default: %s)' % ','.join(SCENARIOS))
+    parser.add_argument('-c', '--cname', type=comma_list(str),
+            default=['blosclz'])
+    parser.add_argument('-l', '--clevel', type=comma_list(int), default=[7])
+    parser.add_argument('--shuffle', type=comma_list(int), default=[1])
+    parser.add_argument('-d', '--dataset', type=comma_list(str),
+            default=['smooth'],
+            help='datasets to use (default: smooth), from: %s' %
+            ','.join(datasets.FAMILIES))
+    parser.add_argument('--seed', type=int, default=0,
+            help='seed of the datasets (default: 0)')
+    parser.add_argument('-t', '--typesize', type=comma_list(int),
+            default=None,
+            help='typesizes (default: the one of each dataset)')
+    parser.add_argument('-z', '--chunk-size', type=size_list,
+            default=size_list(bloscpack.DEFAULT_CHUNK_SIZE),
+            dest='chunk_size')
+    parser.add_argument('-n', '--nthreads', type=comma_list(int),
+            default=[blosc.ncores])
+    parser.add_argument('-C', '--cache', type=comma_list(str),
+            default=['warm'],
+            help='page cache modes, warm and/or cold (default: warm)')
+    parser.add_argument('-o', '--output', default=None,
+            help='file to write the JSON results to, usable as a baseline')
+    parser.add_argument('-b', '--baseline', default=None,
+            help='JSON results to compare against')
+    parser.add_argument('--compare', default=None, metavar='RESULTS',
+            help='compare saved JSON results against the baseline, '
+            'instead of running the benchmarks')
+    parser.add_argument('--tolerance', type=float, default=0.05,
+            help='tolerated relative slowdown of the median (default: 0.05)')
+    parser.add_argument('--alpha', type=float, default=0.05,
+            help='significance level of regressions (default: 0.05)')
+    return parser
+
+
+def load(filename):
+    with open(filename) as fp:
+        return json.load(fp)
+
+
+def main(argv=None):
+    """ Run the benchmarks, or compare results, and return the exit status.
+    """
+    args = create_parser().parse_args(argv)
+    if args.compare:
+        if not args.baseline:
+            sys.exit('error: --compare requires --baseline')
+        return check(load(args.baseline), load(args.compare), args)
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            sys.exit("error: no such scenario: '%s'" % name)
+    for cname in args.cname:
+        if cname not in bloscpack.CNAME_AVAIL:
+            sys.exit("error: no such codec: '%s'" % cname)
+    for dataset in args.dataset:
+        if dataset not in datasets.FAMILIES:
+            sys.exit("error: no such dataset: '%s'" % dataset)
+    for cache in args.cache:
+        if cache not in ('warm', 'cold'):
+            sys.exit("error: no such cache mode: '%s'" % cache)
+    if 'cold' in args.cache and bloscpack._posix_fadvise is None:
+        sys.exit('error: the cold cache mode requires posix_fadvise')
+    report = {'environment': environment(),
+              'arguments': dict(vars(args)),
+              'results': run(args),
+              }
+    if len(args.cache) > 1:
+        print_cache_comparison(report['results'])
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=1, sort_keys=True)
+        print("results written to: '%s'" % args.output)
+    if args.baseline:
+        return check(load(args.baseline), report, args)
+    return 0
+
+
+def check(baseline, current, args):
+    """ Print the comparison, return 1 if there are regressions. """
+    for key, value in sorted(baseline['environment'].items()):
+        if current['environment'].get(key) != value:
+            print("note: %s differs, baseline: '%s' current: '%s'" %
+                  (key, value, current['environment'].get(key)))
+    rows = compare(baseline, current, args.tolerance, args.alpha)
+    print_comparison(rows)
+    regressions = [row for row in rows if row['status'] == 'regression']
+    print("'%d' of '%d' compared scenarios regressed" %
+          (len(regressions), len(rows)))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,7 +5,6 @@ from __future__ import division
 from __future__ import print_function
 
 import os.path as path
-import os
 import sys
 import time
 import subprocess
@@ -23,21 +22,19 @@ def get_ratio(file1, file2):
     return path.getsize(file1)/path.getsize(file2)
 
 
-def drop_caches():
+def drop_caches(*file_names):
     if DROP_CACHES:
-        os.system('echo 3 > /proc/sys/vm/drop_caches')
-
-
-def am_root():
-    return os.geteuid() == 0
+        for file_name in file_names:
+            if path.exists(file_name):
+                bloscpack.drop_file_cache(file_name)
 
 
 if len(sys.argv) == 2 and sys.argv[1] in ('-d', '--drop-caches'):
-    if am_root():
+    if bloscpack._posix_fadvise is not None:
         print('will drop caches')
         DROP_CACHES = True
     else:
-        print('error: need uid 0 (root) to drop caches')
+        print('error: need posix_fadvise to drop caches')
         sys.exit(1)
 
 with tb.create_tmp_files() as (tdir, in_file, out_file, dcmp_file):
@@ -53,7 +50,7 @@ with tb.create_tmp_files() as (tdir, in_file, out_file, dcmp_file):
     print('')
 
     print("Input file size: %s" % get_fs(in_file))
-    drop_caches()
+    drop_caches(in_file, out_file, gz_out_file)
 
     print("Will now run bloscpack... ")
     tic = time.time()
@@ -62,7 +59,7 @@ with tb.create_tmp_files() as (tdir, in_file, out_file, dcmp_file):
     print("Time: %.2f seconds" % (toc - tic))
     print("Output file size: %s" % get_fs(out_file))
     print("Ratio: %.2f" % get_ratio(out_file, in_file))
-    drop_caches()
+    drop_caches(in_file, out_file, gz_out_file)
 
     print("Will now run gzip... ")
     tic = time.time()
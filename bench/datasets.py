@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim :set ft=py:
+
+""" Deterministic datasets for benchmarks and tests.
+
+Every family produces exactly the requested number of bytes, and the same
+bytes for the same size and seed. The families are also available from the
+command line, for example:
+
+    $ PYTHONPATH=. bench/datasets.py json_logs 64M logs.dat
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import sys
+
+try:
+    from collections import OrderedDict
+except ImportError:  # pragma: no cover
+    from ordereddict import OrderedDict
+import numpy as np
+
+# size of the blocks data is generated in, to bound memory use
+BLOCK_SIZE = 2**22
+
+WORDS = ('the', 'chunk', 'of', 'data', 'is', 'compressed', 'and', 'written',
+         'to', 'a', 'file', 'with', 'offsets', 'metadata', 'checksum',
+         'blosc', 'array', 'value', 'error', 'request', 'user', 'time')
+
+LEVELS = ('DEBUG', 'INFO', 'INFO', 'INFO', 'WARNING', 'ERROR')
+
+
+def _noise(random, nbytes, i):
+    """ Normally distributed float64, compresses poorly. """
+    return random.standard_normal(nbytes // 8 + 1)
+
+
+def _smooth(random, nbytes, i):
+    """ A float64 random walk with small steps, like sensor readings. """
+    steps = random.standard_normal(nbytes // 8 + 1) * 0.01
+    return np.round(i * 1000 + np.cumsum(steps), 3)
+
+
+def _counter(random, nbytes, i):
+    """ Increasing int64 with small random increments, like timestamps. """
+    count = nbytes // 8 + 1
+    start = i * (BLOCK_SIZE // 8) * 10
+    return start + np.cumsum(random.randint(0, 10, count)).astype(np.int64)
+
+
+def _sparse(random, nbytes, i):
+    """ float64, mostly zeros with one value in a hundred set. """
+    count = nbytes // 8 + 1
+    data = np.zeros(count)
+    hits = random.randint(0, count, count // 100 + 1)
+    data[hits] = random.standard_normal(len(hits))
+    return data
+
+
+def _text(random, nbytes, i):
+    """ Lines of words from a small vocabulary, like prose. """
+    lines = []
+    length = 0
+    while length < nbytes:
+        line = ' '.join(WORDS[w] for w in
+                        random.randint(0, len(WORDS),
+                                       random.randint(3, 16))) + '.\n'
+        lines.append(line)
+        length += len(line)
+    return ''.join(lines)
+
+
+def _json_logs(random, nbytes, i):
+    """ JSON log records, one per line. """
+    lines = []
+    length = 0
+    timestamp = 1400000000000 + i * 10**9
+    while length < nbytes:
+        timestamp += int(random.randint(0, 1000))
+        record = OrderedDict([
+            ('ts', timestamp),
+            ('level', LEVELS[random.randint(0, len(LEVELS))]),
+            ('user', 'user%04d' % random.randint(0, 500)),
+            ('latency_ms', round(float(random.exponential(20)), 2)),
+            ('msg', ' '.join(WORDS[w] for w in
+                             random.randint(0, len(WORDS), 5))),
+        ])
+        line = json.dumps(record) + '\n'
+        lines.append(line)
+        length += len(line)
+    return ''.join(lines)
+
+
+def _image(random, nbytes, i, width=1024):
+    """ uint16 2-D data, smooth gradients with noise, like a camera frame.
+    """
+    rows = (nbytes // 2) // width + 1
+    y, x = np.mgrid[i * rows:(i + 1) * rows, 0:width]
+    image = (2000 + 1000 * np.sin(x / 97.0) * np.cos(y / 53.0) +
+             random.normal(0, 20, (rows, width)))
+    return image.astype(np.uint16)
+
+
+RECORD_DTYPE = np.dtype([('id', np.int64), ('x', np.float32),
+                         ('y', np.float32), ('flag', np.uint8),
+                         ('code', 'S7')])
+
+
+def _records(random, nbytes, i):
+    """ A structured array, like rows of a table. """
+    count = nbytes // RECORD_DTYPE.itemsize + 1
+    records = np.zeros(count, dtype=RECORD_DTYPE)
+    records['id'] = np.arange(count) + i * count
+    records['x'] = random.uniform(0, 100, count)
+    records['y'] = records['x'] * 0.5 + random.normal(0, 1, count)
+    records['flag'] = random.randint(0, 2, count)
+    records['code'] = np.array(['ABC%04d' % c for c in
+                                random.randint(0, 50, count)])
+    return records
+
+
+def _incompressible(random, nbytes, i):
+    """ Uniformly random bytes. """
+    return random.bytes(nbytes)
+
+
+# the generators and the typesize of the data they produce
+FAMILIES = OrderedDict([
+    ('noise', (_noise, 8)),
+    ('smooth', (_smooth, 8)),
+    ('counter', (_counter, 8)),
+    ('sparse', (_sparse, 8)),
+    ('text', (_text, 1)),
+    ('json_logs', (_json_logs, 1)),
+    ('image', (_image, 2)),
+    ('records', (_records, RECORD_DTYPE.itemsize)),
+    ('incompressible', (_incompressible, 1)),
+])
+
+
+def typesize(family):
+    """ The natural typesize of a family. """
+    return FAMILIES[family][1]
+
+
+def blocks(family, size, seed=0):
+    """ Generate a dataset in blocks.
+
+    Parameters
+    ----------
+    family : str
+        one of 'FAMILIES'
+    size : int
+        the total number of bytes
+    seed : int
+        the seed of the random number generator
+
+    Returns
+    -------
+    blocks : iterator of str
+        blocks of at most 'BLOCK_SIZE' bytes
+
+    Raises
+    ------
+    ValueError
+        if the family does not exist
+
+    """
+    if family not in FAMILIES:
+        raise ValueError("no such dataset family: '%s', choose from: %s" %
+                         (family, ', '.join(FAMILIES)))
+    generator = FAMILIES[family][0]
+    # a separate random stream per block, so that memory use is bounded
+    # without the content depending on how much was generated before
+    for i, start in enumerate(range(0, size, BLOCK_SIZE)):
+        nbytes = min(BLOCK_SIZE, size - start)
+        random = np.random.RandomState([seed, i])
+        data = generator(random, nbytes, i)
+        if isinstance(data, np.ndarray):
+            data = data.tostring()
+        yield data[:nbytes]
+
+
+def generate(family, size, seed=0):
+    """ Generate a dataset as a string, see ``blocks``. """
+    return ''.join(blocks(family, size, seed=seed))
+
+
+def write(family, filename, size, seed=0):
+    """ Write a dataset to a file, see ``blocks``. """
+    with open(filename, 'wb') as fp:
+        for block in blocks(family, size, seed=seed):
+            fp.write(block)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('family', choices=list(FAMILIES))
+    parser.add_argument('size', help='number of bytes, suffixes K, M and G '
+                        'are allowed')
+    parser.add_argument('filename')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    import bloscpack
+    write(args.family, args.filename, bloscpack.reverse_pretty(args.size),
+          seed=args.seed)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -12,15 +12,30 @@ import contextlib
 import collections
 import cStringIO
 import copy
+import ctypes
+import ctypes.util
 import hashlib
+import httplib
+import io
 import json
 import itertools
+import mmap
+import multiprocessing.pool
 import os
 import os.path as path
 import pprint
+import Queue
+import socket
 import struct
 import sys
+import threading
+import time
+import urlparse
 import zlib
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None
 try:
     from collections import OrderedDict
 except ImportError:  # pragma: no cover
@@ -39,6 +54,9 @@ PREFIX = "bloscpack.py"
 
 # header lengths
 BLOSC_HEADER_LENGTH = 16
+
+# version byte of a constant chunk marker, never used by Blosc
+CONSTANT_CHUNK_VERSION = 0
 BLOSCPACK_HEADER_LENGTH = 32
 METADATA_HEADER_LENGTH = 32
 
@@ -47,17 +65,90 @@ MAX_FORMAT_VERSION = 255
 MAX_CHUNKS = (2**63)-1
 MAX_META_SIZE = (2**32-1)  # uint32 max val
 
+# buffer size for verbatim copies of compressed chunks
+COPY_BUFFER_SIZE = 2**22
+
+# largest gap between two chunks that are fetched with a single read
+DEFAULT_MAX_GAP = 2**16
+
+# number of chunks handed to worker threads, or read ahead, at once
+DEFAULT_MAX_INFLIGHT = 8
+
+# number of threads running asynchronous jobs
+DEFAULT_ASYNC_JOBS = 4
+
+# smallest range fetched by a single HTTP request
+DEFAULT_HTTP_READAHEAD = 2**20
+
+# getrusage target for the calling thread only, the value is that of Linux
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', 1)
+
+# the stages of a pipeline, in the order they are reported
+PIPELINE_STAGES = ('calibrate', 'metadata', 'read', 'checksum', 'compress',
+        'decompress', 'write', 'finalize')
+
+# upper bounds of the histogram buckets of the Prometheus exporter
+DEFAULT_DURATION_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+        0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+DEFAULT_RATIO_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9,
+        1.0)
+
+# advice for posix_fadvise, the fallback values are those of Linux
+POSIX_FADV_SEQUENTIAL = getattr(os, 'POSIX_FADV_SEQUENTIAL', 2)
+POSIX_FADV_WILLNEED = getattr(os, 'POSIX_FADV_WILLNEED', 3)
+POSIX_FADV_DONTNEED = getattr(os, 'POSIX_FADV_DONTNEED', 4)
+
 # Bloscpack args
-BLOSCPACK_ARGS = ('offsets', 'checksum', 'max_app_chunks')
+BLOSCPACK_ARGS = ('offsets', 'checksum', 'max_app_chunks', 'merkle', 'dedup',
+        'constant')
 _BLOSCPACK_ARGS_SET = set(BLOSCPACK_ARGS)  # cached
+# the args added later, which take their defaults when missing
+_OPTIONAL_BLOSCPACK_ARGS = ('merkle', 'dedup', 'constant')
 DEFAULT_OFFSETS = True
 DEFAULT_CHECKSUM = 'adler32'
 DEFAULT_MAX_APP_CHUNKS = lambda x: 10 * x
+DEFAULT_MERKLE = False
+DEFAULT_DEDUP = False
+DEFAULT_CONSTANT = False
 DEFAULT_BLOSCPACK_ARGS = dict(zip(BLOSCPACK_ARGS,
-    (DEFAULT_OFFSETS, DEFAULT_CHECKSUM, DEFAULT_MAX_APP_CHUNKS)))
+    (DEFAULT_OFFSETS, DEFAULT_CHECKSUM, DEFAULT_MAX_APP_CHUNKS,
+     DEFAULT_MERKLE, DEFAULT_DEDUP, DEFAULT_CONSTANT)))
 
 DEFAULT_CHUNK_SIZE = '1M'
 
+# automatic chunk size: the largest sample compressed for calibration, the
+# smallest chunk size considered and the loss of throughput tolerated for a
+# better ratio
+AUTO_CHUNK_SAMPLE_SIZE = 2**22
+AUTO_CHUNK_MIN_SIZE = 2**16
+AUTO_CHUNK_TOLERANCE = 0.05
+
+# automatic blosc args: the levels tried, the number of chunks sampled, the
+# bytes compressed of each, the fewest bytes worth timing and the objective
+# if none is given
+AUTO_CLEVELS = (1, 5, 9)
+AUTO_BLOSC_SAMPLES = 4
+AUTO_BLOSC_SAMPLE_SIZE = 2**18
+AUTO_BLOSC_MIN_SAMPLE_SIZE = 2**16
+DEFAULT_OBJECTIVE = 'speed>=100'
+
+# adaptive compression: the codec and shuffle tried for every chunk besides
+# the given blosc args, the time allowed for the trials, as a multiple of the
+# time taken by the given blosc args, and the trials in a row a candidate may
+# take longer before it is no longer tried, and the least CPU time a chunk is
+# counted as for the budget, so that negligible times do not end the trials
+ADAPTIVE_CANDIDATES = (('lz4', True), ('lz4', False), ('zstd', True),
+                       ('zstd', False), ('zlib', True))
+ADAPTIVE_TIME_BUDGET = 4.0
+ADAPTIVE_MAX_MISSES = 3
+ADAPTIVE_MIN_BASE_TIME = 0.001
+
+# where Linux describes the caches of the first CPU, and the cache sizes
+# assumed when it does not
+CPU_CACHE_PATH = '/sys/devices/system/cpu/cpu0/cache'
+DEFAULT_L2_CACHE_SIZE = 2**18
+DEFAULT_LAST_CACHE_SIZE = 2**23
+
 # Blosc args
 BLOSC_ARGS = ('typesize', 'clevel', 'shuffle', 'cname')
 _BLOSC_ARGS_SET = set(BLOSC_ARGS)  # cached
@@ -156,6 +247,10 @@ class NotANumpyArray(RuntimeError):
     pass
 
 
+class IncompatibleFiles(RuntimeError):
+    pass
+
+
 class Hash(object):
     """ Uniform hash object.
 
@@ -209,6 +304,10 @@ CHECKSUMS = [Hash('None', 0, lambda data: ''),
              ]
 CHECKSUMS_AVAIL = [c.name for c in CHECKSUMS]
 CHECKSUMS_LOOKUP = dict(((c.name, c) for c in CHECKSUMS))
+# the checksums that rule out collisions well enough to match chunks by, and
+# to build a Merkle tree with
+SYNC_CHECKSUMS_AVAIL = [c for c in CHECKSUMS_AVAIL
+                        if c not in ('None', 'adler32', 'crc32')]
 
 
 def _check_valid_checksum(checksum):
@@ -335,9 +434,16 @@ def print_verbose(message, level=VERBOSE):
             print('%s: %s' % (PREFIX, line))
 
 
-def print_debug(message):
-    """ Print message with verbosity level ``DEBUG``. """
-    print_verbose(message, level=DEBUG)
+def print_debug(message, *args):
+    """ Print message with verbosity level ``DEBUG``.
+
+    The message is formatted with 'args', if any, only when it is printed.
+    Pass the arguments rather than a formatted message from the chunk loops,
+    such that disabled debug output costs a single comparison and large
+    buffers are not turned into strings in vain.
+    """
+    if LEVEL == DEBUG:
+        print_verbose(message % args if args else message, level=DEBUG)
 
 
 def print_normal(message):
@@ -387,6 +493,27 @@ def drop_caches():  # pragma: no cover
         raise RuntimeError('Need root permission to drop caches')
 
 
+def drop_file_cache(filename):
+    """ Evict a file from the page cache, without root permission.
+
+    Dirty pages are written back first, since they can not be dropped.
+
+    Parameters
+    ----------
+    filename : str
+        the file to evict
+
+    Returns
+    -------
+    dropped : bool
+        False if posix_fadvise is not available on this platform
+
+    """
+    with open(filename, 'rb') as fp:
+        os.fsync(fp.fileno())
+        return _fadvise(fp, 0, 0, POSIX_FADV_DONTNEED)
+
+
 def sync():
     os.system('sync')
 
@@ -468,7 +595,12 @@ class BloscPackCustomFormatter(argparse.HelpFormatter):
         return text.splitlines()
 
 
-def _inject_blosc_group(parser):
+def _inject_blosc_group(parser, auto=False):
+    """ Add the blosc settings to a parser.
+
+    If 'auto', 'clevel', 'shuffle' and 'cname' default to None, so that
+    those not given can be told apart, see ``process_compression_args``.
+    """
     blosc_group = parser.add_argument_group(title='blosc settings')
     blosc_group.add_argument('-t', '--typesize',
             metavar='<size>',
@@ -476,24 +608,26 @@ def _inject_blosc_group(parser):
             type=int,
             help='typesize for blosc')
     blosc_group.add_argument('-l', '--clevel',
-            default=DEFAULT_CLEVEL,
+            default=None if auto else DEFAULT_CLEVEL,
             choices=range(10),
             metavar='[0, 9]',
             type=int,
-            help='compression level')
+            help='compression level' +
+                    (' (default: %d)' % DEFAULT_CLEVEL if auto else ''))
     blosc_group.add_argument('-s', '--no-shuffle',
             action='store_false',
-            default=DEFAULT_SHUFFLE,
+            default=None if auto else DEFAULT_SHUFFLE,
             dest='shuffle',
             help='deactivate shuffle')
     blosc_group.add_argument('-c', '--codec',
             metavar='<codec>',
             type=str,
             choices=CNAME_AVAIL,
-            default=DEFAULT_CNAME,
+            default=None if auto else DEFAULT_CNAME,
             dest='cname',
             help="codec to be used by Blosc: \n%s"
-                    % join_with_eol(CNAME_AVAIL))
+                    % join_with_eol(CNAME_AVAIL) +
+                    (' (default: %s)' % DEFAULT_CNAME if auto else ''))
 
 
 def create_parser():
@@ -552,6 +686,8 @@ def create_parser():
         def __call__(self, parser, namespace, value, option_string=None):
             if value == 'max':
                 value = blosc.BLOSC_MAX_BUFFERSIZE
+            elif value == 'auto':
+                pass
             else:
                 try:
                     # try to get the value as bytes
@@ -562,12 +698,12 @@ def create_parser():
                         value = int(value)
                 except ValueError as ve:
                     error('%s error: %s' % (option_string, str(ve) +
-                        " or 'max'"))
+                        " or 'max' or 'auto'"))
                 if value < 0:
                     error('%s must be > 0 ' % option_string)
             setattr(namespace, self.dest, value)
     for p in [compress_parser, c_parser]:
-        _inject_blosc_group(p)
+        _inject_blosc_group(p, auto=True)
         bloscpack_chunking_group = p.add_mutually_exclusive_group()
         bloscpack_chunking_group.add_argument('-z', '--chunk-size',
                 metavar='<size>',
@@ -575,7 +711,34 @@ def create_parser():
                 type=str,
                 default=DEFAULT_CHUNK_SIZE,
                 dest='chunk_size',
-                help="set desired chunk size or 'max'")
+                help="set desired chunk size, 'max' or 'auto'")
+        p.add_argument('-A', '--auto',
+                metavar='<objective>',
+                type=str,
+                default=None,
+                dest='objective',
+                help="choose codec, level and shuffle by compressing "
+                     "samples, for the objective 'speed>=<MB/s>' or "
+                     "'ratio<=<ratio>'")
+        p.add_argument('-a', '--adaptive',
+                action='store_true',
+                default=False,
+                dest='adaptive',
+                help='compress every chunk with the best of several codecs '
+                     'and shuffles')
+        p.add_argument('-w', '--workers',
+                metavar='<n>',
+                type=int,
+                default=1,
+                dest='workers',
+                help='compress chunks in parallel with <n> threads')
+        p.add_argument('-b', '--memory-budget',
+                metavar='<size>',
+                action=CheckChunkSizeOption,
+                type=str,
+                default=None,
+                dest='memory_budget',
+                help='buffer at most <size> of chunks for the workers')
         bloscpack_group = p.add_argument_group(title='bloscpack settings')
         checksum_format = join_with_eol(CHECKSUMS_AVAIL[0:3]) + \
                 join_with_eol(CHECKSUMS_AVAIL[3:6]) + \
@@ -593,6 +756,21 @@ def create_parser():
                 default=DEFAULT_OFFSETS,
                 dest='offsets',
                 help='deactivate offsets')
+        bloscpack_group.add_argument('-M', '--merkle',
+                action='store_true',
+                default=DEFAULT_MERKLE,
+                dest='merkle',
+                help='store a Merkle tree over the chunk checksums')
+        bloscpack_group.add_argument('-D', '--dedup',
+                action='store_true',
+                default=DEFAULT_DEDUP,
+                dest='dedup',
+                help='store duplicate chunks only once')
+        bloscpack_group.add_argument('-Z', '--constant',
+                action='store_true',
+                default=DEFAULT_CONSTANT,
+                dest='constant',
+                help='store constant chunks as compact markers')
         bloscpack_group.add_argument('-m', '--metadata',
                 metavar='<metadata>',
                 type=str,
@@ -615,6 +793,32 @@ def create_parser():
                 dest='no_check_extension',
                 help='disable checking input file for extension (*.blp)\n' +
                 '(requires use of <out_file>)')
+        p.add_argument('-S', '--sparse',
+                action='store_true',
+                default=False,
+                dest='sparse',
+                help='leave holes in the output for chunks of null bytes')
+        p.add_argument('-w', '--workers',
+                metavar='<n>',
+                type=int,
+                default=1,
+                dest='workers',
+                help='decompress chunks in parallel with <n> threads')
+        p.add_argument('-r', '--readahead',
+                metavar='<size>',
+                action=CheckChunkSizeOption,
+                type=str,
+                default=None,
+                dest='readahead',
+                help='read <size> ahead and keep the input out of the '
+                'page cache')
+        p.add_argument('-b', '--memory-budget',
+                metavar='<size>',
+                action=CheckChunkSizeOption,
+                type=str,
+                default=None,
+                dest='memory_budget',
+                help='buffer at most <size> of chunks for the workers')
 
     for p, help_in, help_out in [(compress_parser,
             'file to be compressed', 'file to compress to'),
@@ -681,6 +885,101 @@ def create_parser():
                 type=str,
                 default=None,
                 help="file to show info for")
+
+    concat_parser = subparsers.add_parser('concat',
+            formatter_class=BloscPackCustomFormatter,
+            help='concatenate compressed files')
+
+    cat_parser = subparsers.add_parser('cat',
+            formatter_class=BloscPackCustomFormatter,
+            help="alias for 'concat'")
+
+    for p in (concat_parser, cat_parser):
+        _inject_blosc_group(p)
+        p.add_argument('in_files',
+                metavar='<in_file>',
+                type=str,
+                nargs='+',
+                help="files to be concatenated")
+        p.add_argument('out_file',
+                metavar='<out_file>',
+                type=str,
+                help="file to concatenate to")
+
+    split_parser = subparsers.add_parser('split',
+            formatter_class=BloscPackCustomFormatter,
+            help='split a compressed file into shards')
+
+    s_parser = subparsers.add_parser('s',
+            formatter_class=BloscPackCustomFormatter,
+            help="alias for 'split'")
+
+    for p in (split_parser, s_parser):
+        shard_group = p.add_mutually_exclusive_group(required=True)
+        shard_group.add_argument('-N', '--nshards',
+                metavar='<n>',
+                type=int,
+                dest='nshards',
+                help='split into <n> shards')
+        shard_group.add_argument('-C', '--chunks',
+                metavar='<n>',
+                type=int,
+                dest='chunks_per_shard',
+                help='split into shards of <n> chunks each')
+        shard_group.add_argument('-S', '--shard-size',
+                metavar='<size>',
+                action=CheckChunkSizeOption,
+                type=str,
+                dest='shard_size',
+                help='split into shards of at most <size> each')
+        p.add_argument('in_file',
+                metavar='<in_file>',
+                type=str,
+                help="file to be split")
+        p.add_argument('out_prefix',
+                metavar='<out_prefix>',
+                type=str,
+                nargs='?',
+                default=None,
+                help="prefix for the shards, '<out_prefix>.<k>.blp'")
+
+    verify_parser = subparsers.add_parser('verify',
+            formatter_class=BloscPackCustomFormatter,
+            help='verify the integrity of a compressed file')
+
+    v_parser = subparsers.add_parser('v',
+            formatter_class=BloscPackCustomFormatter,
+            help="alias for 'verify'")
+
+    for p in (verify_parser, v_parser):
+        p.add_argument('file_',
+                metavar='<file>',
+                type=str,
+                help="file to verify")
+
+    sync_parser = subparsers.add_parser('sync',
+            formatter_class=BloscPackCustomFormatter,
+            help='update a compressed file from another one')
+
+    sy_parser = subparsers.add_parser('sy',
+            formatter_class=BloscPackCustomFormatter,
+            help="alias for 'sync'")
+
+    for p in (sync_parser, sy_parser):
+        p.add_argument('local_file',
+                metavar='<local_file>',
+                type=str,
+                help="outdated file to be updated")
+        p.add_argument('remote_file',
+                metavar='<remote_file>',
+                type=str,
+                help="up to date file to be synced from")
+        p.add_argument('out_file',
+                metavar='<out_file>',
+                type=str,
+                nargs='?',
+                default=None,
+                help="file to write to, instead of replacing <local_file>")
     return parser
 
 
@@ -780,6 +1079,461 @@ def calculate_nchunks(in_file_size, chunk_size=DEFAULT_CHUNK_SIZE):
     return nchunks, chunk_size, last_chunk_size
 
 
+def _blosc_nthreads():
+    """ The number of threads Blosc currently uses.
+
+    'blosc.nthreads' is set at import, and not updated by
+    ``blosc.set_nthreads``, which does return the previous setting.
+
+    """
+    nthreads = blosc.set_nthreads(blosc.ncores)
+    blosc.set_nthreads(nthreads)
+    return nthreads
+
+
+def _cpu_cache_sizes(cache_path=CPU_CACHE_PATH):
+    """ Read the sizes of the data caches of the first CPU from sysfs.
+
+    Returns
+    -------
+    sizes : dict
+        maps the level of each data or unified cache to its size in bytes,
+        empty if the sizes are not available
+
+    """
+    sizes = {}
+    try:
+        entries = os.listdir(cache_path)
+    except OSError:
+        return sizes
+    for entry in entries:
+        if not entry.startswith('index'):
+            continue
+        values = []
+        try:
+            for name in ('type', 'level', 'size'):
+                with open(path.join(cache_path, entry, name)) as fp:
+                    values.append(fp.read().strip())
+            type_, level, size = values[0], int(values[1]), \
+                    reverse_pretty(values[2])
+        except (IOError, ValueError, IndexError):
+            continue
+        if type_ != 'Instruction':
+            sizes[level] = max(sizes.get(level, 0), size)
+    return sizes
+
+
+def auto_chunk_size(sample, total_size, typesize,
+        blosc_args=DEFAULT_BLOSC_ARGS, nthreads=None):
+    """ Choose a chunk size for the data, by calibrating on a sample.
+
+    Parameters
+    ----------
+    sample : str
+        the beginning of the data, 'AUTO_CHUNK_SAMPLE_SIZE' bytes suffice
+    total_size : int
+        the size of all of the data
+    typesize : int
+        the typesize, the chunk size is a multiple of it
+    blosc_args : dict
+        the blosc args the data will be compressed with
+    nthreads : int or None
+        the number of Blosc threads, by default the current setting
+
+    Returns
+    -------
+    chunk_size : int
+        the chosen chunk size
+
+    Notes
+    -----
+    Chunks should give each Blosc thread a few blocks of about a quarter of
+    the L2 cache, and the raw and compressed chunk should fit into the last
+    level cache together. The cache sizes are read from sysfs, where
+    available. Of the powers of two between these bounds, that also fit the
+    sample and the data, each is timed by compressing the sample twice, and
+    without any, the lower bound is used. The chunk size with the best ratio
+    among those within 'AUTO_CHUNK_TOLERANCE' of the highest throughput is
+    chosen.
+
+    """
+    if nthreads is None:
+        nthreads = _blosc_nthreads()
+    # calibrate automatic blosc args with the defaults
+    blosc_args = dict((arg, DEFAULT_BLOSC_ARGS[arg] if value == 'auto'
+                       else value) for arg, value in blosc_args.iteritems())
+    caches = _cpu_cache_sizes()
+    l2_size = caches.get(2, DEFAULT_L2_CACHE_SIZE)
+    last_size = caches[max(caches)] if caches else DEFAULT_LAST_CACHE_SIZE
+    lower = max(AUTO_CHUNK_MIN_SIZE, nthreads * l2_size // 4)
+    upper = min(last_size // 2, len(sample), total_size,
+            blosc.BLOSC_MAX_BUFFERSIZE)
+    print_verbose("cache sizes: %s, blosc threads: '%d'" %
+            (', '.join('L%d: %s' % (level, pretty_size(size))
+                       for level, size in sorted(caches.items())) or
+             'unknown', nthreads), level=DEBUG)
+    if total_size <= lower or upper <= lower:
+        # too little data to choose from, use a single or the smallest chunk
+        chunk_size = max(min(total_size, lower), typesize)
+        chunk_size -= chunk_size % typesize
+        print_verbose('automatic chunk_size: %s' %
+                double_pretty_size(chunk_size))
+        return chunk_size
+    candidates = []
+    # the largest power of two not above the lower bound
+    size = 1
+    while size * 2 <= lower:
+        size *= 2
+    while size <= upper:
+        if size >= lower and size >= typesize:
+            candidates.append(size - size % typesize)
+        size *= 2
+    if not candidates:
+        # no power of two between the bounds, use the smallest chunk
+        chunk_size = max(lower - lower % typesize, typesize)
+        print_verbose('automatic chunk_size: %s' %
+                double_pretty_size(chunk_size))
+        return chunk_size
+    results = []
+    for candidate in candidates:
+        nbytes = len(sample) - len(sample) % candidate
+        # the best of two runs, to reduce the noise
+        elapsed = float('inf')
+        for _ in range(2):
+            compressed = 0
+            start = time.time()
+            for offset in xrange(0, nbytes, candidate):
+                compressed += len(_compress_chunk_str(
+                    sample[offset:offset + candidate], blosc_args))
+            elapsed = min(elapsed, max(time.time() - start, 1e-9))
+        results.append((candidate, nbytes / elapsed, compressed / nbytes))
+        if LEVEL == DEBUG:
+            print_debug('chunk_size %s: %s/s, ratio: %f',
+                    pretty_size(candidate), pretty_size(nbytes / elapsed),
+                    compressed / nbytes)
+    fastest = max(throughput for _, throughput, _ in results)
+    # the best ratio, and of equal ratios the larger chunks, that are fast
+    fast = [(ratio, -candidate) for candidate, throughput, ratio in results
+            if throughput >= (1 - AUTO_CHUNK_TOLERANCE) * fastest]
+    chunk_size = -min(fast)[1]
+    print_verbose("automatic chunk_size: %s, calibrated on %s with '%d' "
+            "candidates" % (double_pretty_size(chunk_size),
+                pretty_size(len(sample)), len(candidates)))
+    return chunk_size
+
+
+class Objective(object):
+    """ The goal of the automatic choice of blosc args.
+
+    Parameters
+    ----------
+    min_speed : float or None
+        maximize the compression, at a speed of at least so many MB/s
+    max_ratio : float or None
+        maximize the speed, at a compression ratio, the compressed size over
+        the original size, of at most this
+
+    Raises
+    ------
+    ValueError
+        unless exactly one of 'min_speed' and 'max_ratio' is given
+
+    """
+
+    def __init__(self, min_speed=None, max_ratio=None):
+        if (min_speed is None) == (max_ratio is None):
+            raise ValueError(
+                    "exactly one of 'min_speed' and 'max_ratio' is needed")
+        self.min_speed = min_speed
+        self.max_ratio = max_ratio
+
+    @staticmethod
+    def parse(objective):
+        """ Parse an objective like 'speed>=100' or 'ratio<=0.5'. """
+        try:
+            name, value = objective.replace(' ', '').split('>=' if
+                    objective.startswith('speed') else '<=')
+            if name == 'speed':
+                return Objective(min_speed=float(value))
+            elif name == 'ratio':
+                return Objective(max_ratio=float(value))
+        except ValueError:
+            pass
+        raise ValueError("invalid objective: '%s', use 'speed>=<MB/s>' or "
+                "'ratio<=<ratio>'" % objective)
+
+    def choose(self, results):
+        """ Choose the best of the measured settings.
+
+        Parameters
+        ----------
+        results : list of (dict, float, float)
+            the blosc args, the speed in bytes per second and the ratio
+
+        Returns
+        -------
+        best : (dict, float, float)
+            the chosen entry of 'results'
+        met : bool
+            if the entry meets the objective, otherwise it comes closest
+
+        """
+        if self.min_speed is not None:
+            fast = [r for r in results if r[1] >= self.min_speed * 2**20]
+            if fast:
+                return min(fast, key=lambda r: (r[2], -r[1])), True
+            return max(results, key=lambda r: r[1]), False
+        else:
+            small = [r for r in results if r[2] <= self.max_ratio]
+            if small:
+                return max(small, key=lambda r: (r[1], -r[2])), True
+            return min(results, key=lambda r: r[2]), False
+
+    def __str__(self):
+        if self.min_speed is not None:
+            return 'speed>=%g' % self.min_speed
+        return 'ratio<=%g' % self.max_ratio
+
+
+def auto_blosc_args(samples, blosc_args, objective=None):
+    """ Choose the blosc args given as 'auto' by compressing samples.
+
+    Parameters
+    ----------
+    samples : list of str
+        samples of the data, 'AUTO_BLOSC_SAMPLES' of 'AUTO_BLOSC_SAMPLE_SIZE'
+        bytes suffice
+    blosc_args : dict
+        blosc args, of which 'cname', 'clevel' and 'shuffle' may be 'auto'
+    objective : Objective, str or None
+        the goal, see ``Objective.parse``, by default 'DEFAULT_OBJECTIVE'
+
+    Returns
+    -------
+    blosc_args : dict
+        the blosc args with the choices filled in
+    results : list of (dict, float, float)
+        the blosc args tried, with the speed in bytes per second and the
+        compression ratio measured for each
+
+    Notes
+    -----
+    Every codec in 'CNAME_AVAIL', every level in 'AUTO_CLEVELS' and shuffle
+    on and off are tried, as far as they are 'auto'. Speeds are those of
+    compression, the best of two passes over the samples. With fewer than
+    'AUTO_BLOSC_MIN_SAMPLE_SIZE' bytes of samples, too few to time, the
+    defaults are used.
+
+    """
+    if objective is None:
+        objective = DEFAULT_OBJECTIVE
+    if isinstance(objective, basestring):
+        objective = Objective.parse(objective)
+    grid = [CNAME_AVAIL, AUTO_CLEVELS, (True, False)]
+    for i, arg in enumerate(('cname', 'clevel', 'shuffle')):
+        if blosc_args[arg] != 'auto':
+            grid[i] = [blosc_args[arg]]
+    nbytes = sum(len(sample) for sample in samples)
+    if nbytes < AUTO_BLOSC_MIN_SAMPLE_SIZE:
+        print_verbose("too little data to choose blosc args: %s, using the "
+                "defaults" % pretty_size(nbytes))
+        return dict((arg, DEFAULT_BLOSC_ARGS[arg] if value == 'auto'
+                     else value) for arg, value in blosc_args.iteritems()), []
+    results = []
+    for cname, clevel, shuffle in itertools.product(*grid):
+        args = dict(blosc_args, cname=cname, clevel=clevel, shuffle=shuffle)
+        # the best of two runs, to reduce the noise
+        elapsed = float('inf')
+        for _ in range(2):
+            compressed = 0
+            start = time.time()
+            for sample in samples:
+                compressed += len(_compress_chunk_str(sample, args))
+            elapsed = min(elapsed, max(time.time() - start, 1e-9))
+        results.append((args, nbytes / elapsed, compressed / nbytes))
+        if LEVEL == DEBUG:
+            print_debug('%s, clevel %d, shuffle %s: %s/s, ratio: %f',
+                    cname, clevel, shuffle, pretty_size(nbytes / elapsed),
+                    compressed / nbytes)
+    (args, speed, ratio), met = objective.choose(results)
+    print_verbose("automatic blosc args for '%s': cname: %s, clevel: %d, "
+            "shuffle: %s, at %s/s and ratio %f, of '%d' tried on %s" %
+            (objective, args['cname'], args['clevel'], args['shuffle'],
+                pretty_size(speed), ratio, len(results), pretty_size(nbytes)))
+    if not met:
+        print_normal("no blosc args meet the objective '%s', using the "
+                "closest" % objective)
+    return args, results
+
+
+class AdaptiveCompressor(object):
+    """ Compress every chunk with the best of several codecs and shuffles.
+
+    Parameters
+    ----------
+    candidates : sequence of (str, bool) or None
+        the codec and shuffle to try besides the given blosc args, by default
+        those of 'ADAPTIVE_CANDIDATES' whose codec is available
+    budget : float
+        the time allowed for the trials, as a multiple of the time taken by
+        the given blosc args
+
+    Raises
+    ------
+    ValueError
+        if a codec is not available or the budget is negative
+
+    Notes
+    -----
+    Every chunk is compressed with the given blosc args first, then with the
+    candidates, in parallel by a pool of one thread per candidate. The
+    smallest result available when the budget has passed is kept, trials
+    that take longer are ignored, and their candidate skipped until they
+    finish, so that trials do not queue up. A candidate whose trials take
+    longer 'ADAPTIVE_MAX_MISSES' times in a row is added to 'retired', and
+    no longer tried until the next ``open``.
+    The CPU time of all trials, those that finish after their chunk
+    included, is counted against the budget too, as a multiple of the CPU
+    time of the given blosc args, at least 'ADAPTIVE_MIN_BASE_TIME' per
+    chunk, and while it is spent, chunks are
+    compressed with the given blosc args alone. Since the header of
+    every blosc chunk records how it was compressed, the chunks decompress as
+    usual. 'chosen' counts the chunks kept of each codec and shuffle,
+    'timeouts' the trials ignored and 'skipped' the chunks without trials
+    for lack of budget. The pool exists between ``open`` and ``close``,
+    which waits for the trials still running.
+
+    """
+
+    def __init__(self, candidates=None, budget=ADAPTIVE_TIME_BUDGET):
+        if candidates is None:
+            candidates = [(cname, shuffle)
+                          for cname, shuffle in ADAPTIVE_CANDIDATES
+                          if cname in CNAME_AVAIL]
+        for cname, shuffle in candidates:
+            if cname not in CNAME_AVAIL:
+                raise ValueError("codec '%s' is not available, choose from: "
+                        "%s" % (cname, ', '.join(CNAME_AVAIL)))
+        if budget < 0:
+            raise ValueError("'budget' must be >= 0, not '%s'" % budget)
+        self.candidates = list(candidates)
+        self.budget = budget
+        self.chosen = {}
+        self.timeouts = 0
+        self.skipped = 0
+        self.pool = None
+        self.running = set()
+        self.misses = {}
+        self.retired = set()
+        self.base_time = 0.0
+        self.trial_time = 0.0
+        self.lock = threading.Lock()
+
+    def open(self):
+        """ Start the pool of threads for the trials, with a fresh budget. """
+        if self.pool is None and self.candidates:
+            self.pool = multiprocessing.pool.ThreadPool(len(self.candidates))
+            self.running = set()
+            self.misses = {}
+            self.retired = set()
+            self.base_time = self.trial_time = 0.0
+
+    def close(self):
+        """ Stop the pool, waiting for any trials still running. """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def _trial(self, compress_func, chunk, blosc_args, candidate):
+        """ Compress in the pool, counting the CPU time against the budget. """
+        start = _thread_cpu_time()
+        try:
+            return compress_func(chunk, blosc_args)
+        finally:
+            with self.lock:
+                self.trial_time += _thread_cpu_time() - start
+                self.running.discard(candidate)
+
+    def compress(self, compress_func, chunk, blosc_args):
+        """ Compress a chunk with the best of the blosc args and candidates.
+
+        Parameters
+        ----------
+        compress_func : callable
+            compresses a chunk, given the chunk and the blosc args
+        chunk : object
+            the chunk, as handed to 'compress_func'
+        blosc_args : dict
+            the blosc args to try first, and of which the candidates vary
+            'cname' and 'shuffle'
+
+        Returns
+        -------
+        compressed : str
+            the smallest of the compressed chunks
+
+        """
+        start, cpu_start = time.time(), _thread_cpu_time()
+        best = compress_func(chunk, blosc_args)
+        choice = (blosc_args['cname'], blosc_args['shuffle'])
+        deadline = time.time() + self.budget * (time.time() - start)
+        trials = []
+        timeouts = 0
+        with self.lock:
+            self.base_time += max(_thread_cpu_time() - cpu_start,
+                                  ADAPTIVE_MIN_BASE_TIME)
+            if self.pool is None:
+                pass
+            elif self.trial_time > self.budget * self.base_time:
+                self.skipped += 1
+            else:
+                for candidate in self.candidates:
+                    # candidates still busy with an earlier chunk are left
+                    # out, only the trials of this chunk count as timeouts
+                    if candidate == choice or candidate in self.retired or \
+                            candidate in self.running:
+                        continue
+                    trial = self.pool.apply_async(self._trial,
+                            (compress_func, chunk,
+                             dict(blosc_args, cname=candidate[0],
+                                  shuffle=candidate[1]), candidate))
+                    self.running.add(candidate)
+                    trials.append((candidate, trial))
+        missed = []
+        for candidate, trial in trials:
+            trial.wait(max(deadline - time.time(), 0))
+            if not trial.ready():
+                timeouts += 1
+                missed.append(candidate)
+            elif len(trial.get()) < len(best):
+                best, choice = trial.get(), candidate
+        with self.lock:
+            self.chosen[choice] = self.chosen.get(choice, 0) + 1
+            self.timeouts += timeouts
+            for candidate, _ in trials:
+                if candidate not in missed:
+                    self.misses[candidate] = 0
+                    continue
+                self.misses[candidate] = self.misses.get(candidate, 0) + 1
+                if self.misses[candidate] >= ADAPTIVE_MAX_MISSES:
+                    print_debug('adaptive candidate retired: %s, shuffle %s',
+                            candidate[0], candidate[1])
+                    self.retired.add(candidate)
+        print_debug('adaptive choice: %s, shuffle %s, %d trials timed out',
+                choice[0], choice[1], timeouts)
+        return best
+
+    def summary(self):
+        """ The chunks kept of each codec and shuffle, as a string. """
+        return ', '.join('%s%s: %d' % (cname, '/shuffle' if shuffle else '',
+                                       count)
+                         for (cname, shuffle), count in
+                         sorted(self.chosen.items())) + \
+                ', timed out trials: %d, chunks without trials: %d' % \
+                (self.timeouts, self.skipped)
+
+
 def check_range(name, value, min_, max_):
     """ Check that a variable is in range. """
     if not isinstance(value, (int, long)):
@@ -888,6 +1642,27 @@ def _check_bloscpack_args(bloscpack_args):
     __check_args('bloscpack', bloscpack_args, _BLOSCPACK_ARGS_SET)
 
 
+def _complete_bloscpack_args(bloscpack_args):
+    """ Add the defaults of the optional bloscpack args that are missing.
+
+    Parameters
+    ----------
+    bloscpack_args : dict
+        bloscpack args dictionary
+
+    Returns
+    -------
+    bloscpack_args : dict
+        a copy, with the values of 'DEFAULT_BLOSCPACK_ARGS' for the keys of
+        '_OPTIONAL_BLOSCPACK_ARGS' that were missing
+
+    """
+    completed = dict((arg, DEFAULT_BLOSCPACK_ARGS[arg])
+                     for arg in _OPTIONAL_BLOSCPACK_ARGS)
+    completed.update(bloscpack_args)
+    return completed
+
+
 def _check_metadata_arguments(metadata_args):
     """ Check the integrity of the metadata arguments dict.
 
@@ -932,16 +1707,22 @@ def __check_args(name, received, expected):
         raise ValueError("%s args had some extras: '%s'" % (name, repr(extra)))
 
 
-def create_options(offsets=DEFAULT_OFFSETS, metadata=False):
+def create_options(offsets=DEFAULT_OFFSETS, metadata=False,
+        merkle=DEFAULT_MERKLE, dedup=DEFAULT_DEDUP,
+        constant=DEFAULT_CONSTANT):
     """ Create the options bitfield.
 
     Parameters
     ----------
     offsets : bool
     metadata : bool
+    merkle : bool
+    dedup : bool
+    constant : bool
     """
     return "".join([str(int(i)) for i in
-            [False, False, False, False, False, False, metadata, offsets]])
+            [False, False, False, constant, dedup, merkle, metadata,
+             offsets]])
 
 
 def decode_options(options):
@@ -958,9 +1739,12 @@ def decode_options(options):
     """
 
     _check_options(options)
-    _check_options_zero(options, range(6))
+    _check_options_zero(options, range(3))
     return {'offsets': bool(int(options[7])),
             'metadata': bool(int(options[6])),
+            'merkle': bool(int(options[5])),
+            'dedup': bool(int(options[4])),
+            'constant': bool(int(options[3])),
             }
 
 
@@ -1075,6 +1859,13 @@ class BloscPackHeader(collections.MutableMapping):
         the number of chunks
     max_app_chunks : int
         the total number of possible append chunks
+    merkle : bool
+        if a Merkle tree over the chunk checksums is present, requires one of
+        'SYNC_CHECKSUMS_AVAIL'
+    dedup : bool
+        if chunks may be shared between several offsets
+    constant : bool
+        if constant chunks may be stored as markers
 
     Notes
     -----
@@ -1096,7 +1887,10 @@ class BloscPackHeader(collections.MutableMapping):
                  chunk_size=-1,
                  last_chunk=-1,
                  nchunks=-1,
-                 max_app_chunks=0):
+                 max_app_chunks=0,
+                 merkle=False,
+                 dedup=False,
+                 constant=False):
 
         check_range('format_version', format_version, 0, MAX_FORMAT_VERSION)
         _check_valid_checksum(checksum)
@@ -1113,6 +1907,15 @@ class BloscPackHeader(collections.MutableMapping):
         if chunk_size != -1 and last_chunk != -1 and last_chunk > chunk_size:
             raise ValueError("'last_chunk' (%d) is larger than 'chunk_size' (%d)"
                     % (last_chunk, chunk_size))
+        if merkle and (not offsets or nchunks == -1):
+            raise ValueError("'merkle' requires offsets and a known "
+                    "'nchunks'")
+        if merkle and checksum not in SYNC_CHECKSUMS_AVAIL:
+            # equal nodes hide differing subtrees, so collisions must be rare
+            raise ValueError("'merkle' requires one of the checksums: %s, "
+                    "not '%s'" % (', '.join(SYNC_CHECKSUMS_AVAIL), checksum))
+        if dedup and not offsets:
+            raise ValueError("'dedup' requires offsets")
 
         self._attrs = ['format_version',
                        'offsets',
@@ -1122,7 +1925,10 @@ class BloscPackHeader(collections.MutableMapping):
                        'chunk_size',
                        'last_chunk',
                        'nchunks',
-                       'max_app_chunks']
+                       'max_app_chunks',
+                       'merkle',
+                       'dedup',
+                       'constant']
         self._len = len(self._attrs)
         self._bytes_attrs = ['chunk_size',
                              'last_chunk']
@@ -1136,6 +1942,9 @@ class BloscPackHeader(collections.MutableMapping):
         self.last_chunk      = last_chunk
         self.nchunks         = nchunks
         self.max_app_chunks  = max_app_chunks
+        self.merkle          = merkle
+        self.dedup           = dedup
+        self.constant        = constant
 
     def __getitem__(self, key):
         if key not in self._attrs:
@@ -1190,7 +1999,9 @@ class BloscPackHeader(collections.MutableMapping):
         """
         format_version = encode_uint8(self.format_version)
         options = encode_uint8(int(
-            create_options(offsets=self.offsets, metadata=self.metadata),
+            create_options(offsets=self.offsets, metadata=self.metadata,
+                merkle=self.merkle, dedup=self.dedup,
+                constant=self.constant),
             2))
         checksum = encode_uint8(CHECKSUMS_AVAIL.index(self.checksum))
         typesize = encode_uint8(self.typesize)
@@ -1202,7 +2013,7 @@ class BloscPackHeader(collections.MutableMapping):
         raw_bloscpack_header = (MAGIC + format_version + options + checksum +
                                 typesize + chunk_size + last_chunk + nchunks +
                                 max_app_chunks)
-        print_debug('raw_bloscpack_header: %s' % repr(raw_bloscpack_header))
+        print_debug('raw_bloscpack_header: %r', raw_bloscpack_header)
         return raw_bloscpack_header
 
     @staticmethod
@@ -1248,7 +2059,10 @@ class BloscPackHeader(collections.MutableMapping):
             chunk_size=decode_int32(buffer_[8:12]),
             last_chunk=decode_int32(buffer_[12:16]),
             nchunks=decode_int64(buffer_[16:24]),
-            max_app_chunks=decode_int64(buffer_[24:32]))
+            max_app_chunks=decode_int64(buffer_[24:32]),
+            merkle=options['merkle'],
+            dedup=options['dedup'],
+            constant=options['constant'])
 
 
 def create_metadata_header(magic_format='',
@@ -1320,12 +2134,18 @@ def process_compression_args(args):
         the input file name
     out_file : str
         the out_file name
-    blosc_args : tuple of (int, int, bool)
-        typesize, clevel and shuffle
+    blosc_args : dict
+        the blosc args, those of 'cname', 'clevel' and 'shuffle' not given
+        are 'auto' with an objective, and the defaults otherwise
     """
     in_file = args.in_file
     out_file = args.out_file or in_file + EXTENSION
-    return in_file, out_file, _blosc_args_from_args(args)
+    blosc_args = _blosc_args_from_args(args)
+    for arg in ('cname', 'clevel', 'shuffle'):
+        if blosc_args[arg] is None:
+            blosc_args[arg] = 'auto' if args.objective is not None \
+                    else DEFAULT_BLOSC_ARGS[arg]
+    return in_file, out_file, blosc_args
 
 
 def process_decompression_args(args):
@@ -1469,10 +2289,9 @@ def _write_metadata(output_fp, metadata, metadata_args):
     else:
         meta_size = len(metadata)
         meta_comp_size = meta_size
-    print_verbose("Raw %s metadata of size '%s': %s" %
-            ('compressed' if metadata_args['meta_codec'] != 'None' else
-                'uncompressed', meta_comp_size, repr(metadata)),
-            level=DEBUG)
+    print_debug("Raw %s metadata of size '%s': %r",
+            'compressed' if metadata_args['meta_codec'] != 'None' else
+            'uncompressed', meta_comp_size, metadata)
     if hasattr(metadata_args['max_meta_size'], '__call__'):
         max_meta_size = metadata_args['max_meta_size'](meta_size)
     elif isinstance(metadata_args['max_meta_size'], int):
@@ -1527,6 +2346,91 @@ def _compress_chunk_ptr(chunk, blosc_args):
     return blosc.compress_ptr(ptr, size, **blosc_args)
 
 
+def _constant_value(raw, typesize):
+    """ Check if a chunk consists of a single repeated element.
+
+    Parameters
+    ----------
+    raw : ndarray of uint8 or None
+        the bytes of the chunk, None if they may not be inspected
+    typesize : int
+        the size of an element
+
+    Returns
+    -------
+    value : str or None
+        the repeated element, or None if the chunk is not constant
+
+    """
+    typesize = max(typesize, 1)
+    if raw is None or len(raw) < typesize or len(raw) % typesize != 0:
+        return None
+    # look at the last element first, to reject most chunks cheaply
+    if not np.array_equal(raw[:typesize], raw[-typesize:]) or \
+            not np.array_equal(raw[typesize:], raw[:-typesize]):
+        return None
+    return raw[:typesize].tostring()
+
+
+def _encode_constant_chunk(value, nbytes):
+    """ Encode a marker for a chunk of 'nbytes' repeating 'value'.
+
+    The marker has the layout of a Blosc header, with a version of
+    'CONSTANT_CHUNK_VERSION', followed by the value, such that 'ctbytes' gives
+    the length of the marker.
+    """
+    return (encode_uint8(CONSTANT_CHUNK_VERSION) + encode_uint8(0) +
+            encode_uint8(0) + encode_uint8(len(value)) +
+            encode_uint32(nbytes) + encode_uint32(0) +
+            encode_uint32(BLOSC_HEADER_LENGTH + len(value)) + value)
+
+
+def _decode_constant_chunk(compressed):
+    """ Decode a constant chunk marker.
+
+    Returns
+    -------
+    value : str or None
+        the repeated element, or None if 'compressed' is a Blosc chunk
+    nbytes : int
+        the length of the chunk when decompressed
+
+    """
+    if decode_uint8(compressed[0]) != CONSTANT_CHUNK_VERSION:
+        return None, None
+    return (compressed[BLOSC_HEADER_LENGTH:],
+            decode_uint32(compressed[4:8]))
+
+
+def _chunk_nbytes(compressed):
+    """ The length of a compressed chunk or constant marker when
+    decompressed.
+    """
+    return decode_uint32(compressed[4:8])
+
+
+def _decompress_chunk_str(compressed):
+    value, nbytes = _decode_constant_chunk(compressed)
+    if value is None:
+        return blosc.decompress(compressed)
+    return value * (nbytes // len(value))
+
+
+def _is_zero(decompressed):
+    """ Check if a decompressed chunk consists of null bytes only. """
+    return (decompressed[:1] == decompressed[-1:] == '\x00' and
+            not np.frombuffer(decompressed, dtype=np.uint8).any())
+
+
+def _fill_constant(raw, value):
+    """ Fill an ndarray of uint8 with a repeated value. """
+    if value.count(value[0]) == len(value):
+        # a single repeated byte, e.g. zeros, becomes a memset
+        raw.fill(ord(value[0]))
+    else:
+        raw.reshape(-1, len(value))[:] = np.frombuffer(value, dtype=np.uint8)
+
+
 def _write_compressed_chunk(output_fp, compressed, digest):
     output_fp.write(compressed)
     if len(digest) > 0:
@@ -1536,17 +2440,24 @@ def _write_compressed_chunk(output_fp, compressed, digest):
 def pack_file(in_file, out_file, chunk_size=DEFAULT_CHUNK_SIZE, metadata=None,
         blosc_args=DEFAULT_BLOSC_ARGS,
         bloscpack_args=DEFAULT_BLOSCPACK_ARGS,
-        metadata_args=DEFAULT_METADATA_ARGS):
+        metadata_args=DEFAULT_METADATA_ARGS,
+        observer=None,
+        objective=None,
+        adaptive=None,
+        stats=None,
+        nthreads=1,
+        memory_budget=None):
     """ Main function for compressing a file.
 
     Parameters
     ----------
     in_file : str
         the name of the input file
-    out_file : str
-        the name of the output file
-    chunk_size : int
-        the desired chunk size in bytes
+    out_file : str or Storage
+        the name of the output file or the storage to write to
+    chunk_size : int or str
+        the desired chunk size in bytes, or 'auto' to choose one with
+        ``auto_chunk_size``
     metadata : dict
         the metadata dict
     blosc_args : dict
@@ -1555,6 +2466,24 @@ def pack_file(in_file, out_file, chunk_size=DEFAULT_CHUNK_SIZE, metadata=None,
         bloscpack keyword args
     metadata_args : dict
         metadata keyword args
+    observer : ChunkObserver or None
+        if given, receives an event for every chunk
+    objective : Objective, str or None
+        the objective of any blosc args that are 'auto'
+    adaptive : AdaptiveCompressor, bool or None
+        if given, compress every chunk with the best of its candidates
+    stats : PipelineStats or None
+        if given, accumulates the time spent in each stage
+    nthreads : int
+        the number of threads compressing chunks in parallel
+    memory_budget : MemoryBudget or None
+        if given, limits the chunks in flight for parallel compression
+
+    Returns
+    -------
+    stats : PipelineStats
+        the time spent in each stage, only measured if 'stats' are given, the
+        output is verbose or there is an 'observer'
 
     Raises
     ------
@@ -1567,36 +2496,321 @@ def pack_file(in_file, out_file, chunk_size=DEFAULT_CHUNK_SIZE, metadata=None,
     """
     in_file_size = path.getsize(in_file)
     print_verbose('input file size: %s' % double_pretty_size(in_file_size))
+    if isinstance(objective, basestring):
+        # fail before the output is opened
+        objective = Objective.parse(objective)
+    if chunk_size == 'auto':
+        with open(in_file, 'rb') as input_fp:
+            sample = input_fp.read(AUTO_CHUNK_SAMPLE_SIZE)
+        chunk_size = auto_chunk_size(sample, in_file_size,
+                blosc_args['typesize'], blosc_args=blosc_args)
     # calculate chunk sizes
     nchunks, chunk_size, last_chunk_size = \
             calculate_nchunks(in_file_size, chunk_size)
-    with open_two_file(open(in_file, 'rb'), open(out_file, 'wb')) as \
+    out_storage = open_storage(out_file)
+    with open_two_file(open(in_file, 'rb'), out_storage.open_write()) as \
             (input_fp, output_fp):
         source = PlainFPSource(input_fp)
         sink = CompressedFPSink(output_fp)
-        pack(source, sink,
+        stats = pack(source, sink,
                 nchunks, chunk_size, last_chunk_size,
                 metadata=metadata,
                 blosc_args=blosc_args,
                 bloscpack_args=bloscpack_args,
-                metadata_args=metadata_args)
-    out_file_size = path.getsize(out_file)
+                metadata_args=metadata_args,
+                observer=observer,
+                objective=objective,
+                adaptive=adaptive,
+                stats=stats,
+                nthreads=nthreads,
+                memory_budget=memory_budget)
+    out_file_size = out_storage.size()
     print_verbose('output file size: %s' % double_pretty_size(out_file_size))
     print_verbose('compression ratio: %f' % (out_file_size/in_file_size))
+    return stats
 
 
-class PlainSource(object):
+class Storage(object):
+    """ Where the bytes of a compressed file are kept.
 
-    _metaclass__ = abc.ABCMeta
+    Sources and sinks operate on file likes, a storage opens these for
+    reading, and possibly for writing.
+    """
 
-    def configure(self, chunk_size, last_chunk, nchunks):
-        self.chunk_size = chunk_size
-        self.last_chunk = last_chunk
-        self.nchunks = nchunks
+    __metaclass__ = abc.ABCMeta
 
-    @property
-    def compress_func(self):
-        return _compress_chunk_str
+    @abc.abstractmethod
+    def size(self):
+        """ The number of bytes stored. """
+        pass
+
+    @abc.abstractmethod
+    def open_read(self):
+        """ Open a seekable file like for reading. """
+        pass
+
+    def open_write(self):
+        """ Open a seekable file like for writing, truncating the storage.
+
+        Raises IOError if the storage is read-only.
+        """
+        raise IOError("storage is read-only: '%s'" % type(self).__name__)
+
+    def close(self):
+        """ Release any resources held, such as connections. """
+        pass
+
+
+class FileStorage(Storage):
+    """ A storage backed by a local file.
+
+    Parameters
+    ----------
+    filename : str
+        the name of the file
+
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def size(self):
+        return path.getsize(self.filename)
+
+    def open_read(self):
+        return open(self.filename, 'rb')
+
+    def open_write(self):
+        return open(self.filename, 'wb')
+
+
+class MemoryStorage(Storage):
+    """ A storage backed by a string in memory.
+
+    Parameters
+    ----------
+    data : str
+        the initial contents
+
+    Notes
+    -----
+    Written contents are stored in 'data' when the file like returned by
+    'open_write' is closed.
+
+    """
+
+    def __init__(self, data=''):
+        self.data = data
+
+    def size(self):
+        return len(self.data)
+
+    def open_read(self):
+        return cStringIO.StringIO(self.data)
+
+    def open_write(self):
+        return _MemoryStorageWriter(self)
+
+
+class _MemoryStorageWriter(io.BytesIO):
+
+    def __init__(self, storage):
+        io.BytesIO.__init__(self)
+        self.storage = storage
+
+    def close(self):
+        if not self.closed:
+            self.storage.data = self.getvalue()
+        io.BytesIO.close(self)
+
+
+class HTTPStorage(Storage):
+    """ A read-only storage fetching ranges of a file from an HTTP server.
+
+    Parameters
+    ----------
+    url : str
+        the URL of the file, must be 'http' or 'https'
+    readahead : int
+        the smallest number of bytes fetched by a single request
+    timeout : float or None
+        the timeout of the connection in seconds
+
+    Notes
+    -----
+    Reads are served with 'Range' requests over a single persistent
+    connection, which is reopened once if the server has closed it. Combined
+    with the offsets, only the header, the metadata, the offsets and the
+    chunks that are actually needed are transferred. If the server ignores
+    the 'Range' header, the complete file it sends is kept and all further
+    reads are served from it. 'nrequests' counts the requests made so far,
+    'nconnections' the connections opened.
+
+    """
+
+    def __init__(self, url, readahead=DEFAULT_HTTP_READAHEAD, timeout=None):
+        parts = urlparse.urlsplit(url)
+        if parts.scheme == 'http':
+            self.connection_class = httplib.HTTPConnection
+        elif parts.scheme == 'https':
+            self.connection_class = httplib.HTTPSConnection
+        else:
+            raise ValueError("not an 'http' or 'https' URL: '%s'" % url)
+        self.url = url
+        self.host = parts.netloc
+        self.path = (parts.path or '/') + \
+                ('?' + parts.query if parts.query else '')
+        self.readahead = readahead
+        self.timeout = timeout
+        self.connection = None
+        self.nrequests = 0
+        self.nconnections = 0
+        self._size = None
+        self._body = None
+
+    def _request(self, method, headers=None):
+        for attempt in (0, 1):
+            if self.connection is None:
+                self.connection = self.connection_class(self.host,
+                        timeout=self.timeout)
+                self.nconnections += 1
+            try:
+                self.connection.request(method, self.path,
+                        headers=headers or {})
+                response = self.connection.getresponse()
+                body = response.read()
+            except (httplib.HTTPException, socket.error):
+                # the server may have closed an idle connection
+                self.close()
+                if attempt:
+                    raise
+            else:
+                break
+        self.nrequests += 1
+        if response.getheader('connection', '').lower() == 'close':
+            self.close()
+        print_debug("HTTP %s '%s' %s: '%d'", method, self.url,
+                (headers or {}).get('Range', ''), response.status)
+        return response, body
+
+    def size(self):
+        if self._size is None:
+            response, _ = self._request('HEAD')
+            if response.status != httplib.OK:
+                raise IOError("HTTP error '%d' for: '%s'" %
+                        (response.status, self.url))
+            self._size = int(response.getheader('content-length'))
+        return self._size
+
+    def read_range(self, position, length):
+        """ Fetch 'length' bytes starting at 'position'. """
+        if length <= 0:
+            return ''
+        elif self._body is not None:
+            return self._body[position:position + length]
+        response, body = self._request('GET', {'Range': 'bytes=%d-%d' %
+                (position, position + length - 1)})
+        if response.status == httplib.PARTIAL_CONTENT:
+            return body
+        elif response.status == httplib.OK:
+            # the server ignored the range, so keep what it sent
+            self._body = body
+            return body[position:position + length]
+        elif response.status == httplib.REQUESTED_RANGE_NOT_SATISFIABLE:
+            return ''
+        raise IOError("HTTP error '%d' for: '%s'" %
+                (response.status, self.url))
+
+    def open_read(self):
+        return _RangeReader(self.read_range, self.size(), self.readahead)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class _RangeReader(object):
+    """ A read-only file like on top of a function fetching byte ranges.
+
+    Each read that is not covered by the last range fetched, fetches at
+    least 'readahead' bytes.
+    """
+
+    def __init__(self, read_range, size, readahead):
+        self.read_range = read_range
+        self.size = size
+        self.readahead = readahead
+        self.position = 0
+        self.buffer_start = 0
+        self.buffer = ''
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.size
+        if offset < 0:
+            raise IOError('negative seek position %d' % offset)
+        self.position = offset
+
+    def tell(self):
+        return self.position
+
+    def read(self, n=-1):
+        available = max(0, self.size - self.position)
+        n = available if n < 0 else min(n, available)
+        start = self.position - self.buffer_start
+        if start < 0 or start + n > len(self.buffer):
+            self.buffer = self.read_range(self.position,
+                    min(max(n, self.readahead), available))
+            self.buffer_start, start = self.position, 0
+        data = self.buffer[start:start + n]
+        self.position += len(data)
+        return data
+
+    def close(self):
+        self.buffer = ''
+
+
+def open_storage(name):
+    """ Get the storage for a file name or URL.
+
+    Parameters
+    ----------
+    name : str or Storage
+        a file name, an 'http' or 'https' URL, or a storage
+
+    Returns
+    -------
+    storage : Storage
+        an HTTPStorage for URLs, a FileStorage otherwise
+
+    """
+    if isinstance(name, Storage):
+        return name
+    elif name.startswith(('http://', 'https://')):
+        return HTTPStorage(name)
+    else:
+        return FileStorage(name)
+
+
+class PlainSource(object):
+
+    _metaclass__ = abc.ABCMeta
+
+    def configure(self, chunk_size, last_chunk, nchunks):
+        self.chunk_size = chunk_size
+        self.last_chunk = last_chunk
+        self.nchunks = nchunks
+
+    @property
+    def compress_func(self):
+        return _compress_chunk_str
+
+    def as_bytes(self, chunk):
+        """ View a chunk as an ndarray of uint8. """
+        return np.frombuffer(chunk, dtype=np.uint8)
 
     def __iter__(self):
         return self()
@@ -1630,19 +2844,104 @@ class PlainFPSource(PlainSource):
 
 
 class CompressedFPSource(CompressedSource):
+    """ A compressed source reading from a file pointer.
 
-    def __init__(self, input_fp):
+    Parameters
+    ----------
+    input_fp : file like
+        the file pointer to read from
+    readahead : int or None
+        if given, and the file has offsets, ask the kernel to read this many
+        bytes ahead of the current chunk and to drop chunks from the page
+        cache once they have been read, using posix_fadvise
+
+    """
+
+    def __init__(self, input_fp, readahead=None):
 
         self.input_fp = input_fp
         self.bloscpack_header, self.metadata, self.metadata_header, \
                 self.offsets = _read_beginning(input_fp)
         self.checksum_impl = self.bloscpack_header.checksum_impl
         self.nchunks = self.bloscpack_header.nchunks
+        # chunks of deduplicated files are not stored in order
+        self.readahead = (readahead if self.offsets and
+                          not self.bloscpack_header.dedup else None)
 
     def __call__(self):
+        if self.readahead and not _fadvise(self.input_fp, self.offsets[0], 0,
+                POSIX_FADV_SEQUENTIAL):
+            self.readahead = None
+        # the ends of the ranges advised to be read and dropped so far
+        advised = consumed = self.offsets[0] if self.offsets else 0
         for i in xrange(self.nchunks):
+            if self.bloscpack_header.dedup:
+                # chunks may be shared, so they are not stored in order
+                self.input_fp.seek(self.offsets[i], 0)
+            if self.readahead:
+                position = self.offsets[i]
+                if advised < position + self.readahead:
+                    # advise twice the readahead to keep the syscalls rare
+                    advised = max(advised, position)
+                    _fadvise(self.input_fp, advised, 2 * self.readahead,
+                            POSIX_FADV_WILLNEED)
+                    advised += 2 * self.readahead
+                if position - consumed >= self.readahead:
+                    _fadvise(self.input_fp, consumed, position - consumed,
+                            POSIX_FADV_DONTNEED)
+                    consumed = position
             compressed, header = _read_compressed_chunk_fp(self.input_fp, self.checksum_impl)
             yield compressed
+        if self.readahead:
+            _fadvise(self.input_fp, consumed, 0, POSIX_FADV_DONTNEED)
+
+
+class CompressedMmapSource(CompressedSource):
+    """ A compressed source that may be read from several threads.
+
+    Parameters
+    ----------
+    input_fp : file
+        the file to read from, must have a file descriptor
+
+    Notes
+    -----
+    The header, metadata and chunk extents are read once on construction.
+    Afterwards, chunks are sliced from a read-only memory map of the file,
+    which does not depend on a shared file position. Hence, 'read_chunk' and
+    'decompress_chunk' may be called concurrently from any number of threads
+    without locking.
+
+    """
+
+    def __init__(self, input_fp):
+        self.bloscpack_header, self.metadata, self.metadata_header, \
+                self.offsets = _read_beginning(input_fp)
+        self.checksum_impl = self.bloscpack_header.checksum_impl
+        self.nchunks = self.bloscpack_header.nchunks
+        self.extents = _read_chunk_extents(input_fp, self.bloscpack_header,
+                self.offsets)
+        self.mmap = mmap.mmap(input_fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read_chunk(self, i):
+        """ Read the compressed chunk 'i' and check its checksum. """
+        position, length = self.extents[i]
+        raw = self.mmap[position:position + length]
+        if len(raw) != length:
+            raise EOFError("chunk '%d' extends beyond the end of the file" %
+                    i)
+        return _unwrap_chunk(raw, self.checksum_impl)
+
+    def decompress_chunk(self, i):
+        """ Read and decompress the chunk 'i'. """
+        return _decompress_chunk_str(self.read_chunk(i))
+
+    def close(self):
+        self.mmap.close()
+
+    def __call__(self):
+        for i in xrange(self.nchunks):
+            yield self.read_chunk(i)
 
 
 class PlainMemorySource(PlainSource):
@@ -1707,11 +3006,21 @@ class PlainNumpySource(PlainSource):
         self.size = ndarray.size * ndarray.itemsize
         self.ndarray = np.ascontiguousarray(ndarray)
         self.ptr = ndarray.__array_interface__['data'][0]
+        # object arrays hold pointers, which must not be treated as values
+        self.raw = (np.ravel(ndarray, order='K').view(np.uint8)
+                    if not ndarray.dtype.hasobject else None)
 
     @property
     def compress_func(self):
         return _compress_chunk_ptr
 
+    def as_bytes(self, chunk):
+        if self.raw is None:
+            return None
+        ptr, nitems = chunk
+        start = ptr - self.ptr
+        return self.raw[start:start + nitems * self.ndarray.itemsize]
+
     def __call__(self):
         self.nitems = int(self.chunk_size / self.ndarray.itemsize)
         offset = self.ptr
@@ -1729,6 +3038,12 @@ class PlainSink(object):
     def put(self, chunk):
         pass
 
+    def flush(self):
+        pass
+
+    def finalize(self):
+        pass
+
 
 class CompressedSink(object):
 
@@ -1739,6 +3054,8 @@ class CompressedSink(object):
         self.bloscpack_header = bloscpack_header
         self.checksum_impl = bloscpack_header.checksum_impl
         self.offsets = bloscpack_header.offsets
+        self.merkle = bloscpack_header.merkle
+        self.dedup = bloscpack_header.dedup
 
     @abc.abstractmethod
     def write_bloscpack_header(self):
@@ -1763,10 +3080,9 @@ class CompressedSink(object):
     def do_checksum(self, compressed):
         if self.checksum_impl.size > 0:
             # compute the checksum on the compressed data
-            digest = self.checksum_impl(compressed)
-            print_verbose('checksum (%s): %s ' %
-                    (self.checksum_impl.name, repr(digest)),
-                    level=DEBUG)
+            with _stage('checksum'):
+                digest = self.checksum_impl(compressed)
+            print_debug('checksum (%s): %r ', self.checksum_impl.name, digest)
         else:
             digest = ''
             print_debug('no checksum')
@@ -1775,22 +3091,148 @@ class CompressedSink(object):
 
 class PlainFPSink(PlainSink):
 
-    def __init__(self, output_fp, nchunks=None):
+    def __init__(self, output_fp, nchunks=None, sparse=False):
         self.output_fp = output_fp
         self.nchunks = nchunks
+        self.sparse = sparse
         self.i = 0
+        self.holes = 0
 
     def put(self, compressed):
-        print_verbose("decompressing chunk '%d'%s" %
-                (self.i, ' (last)' if self.nchunks is not None
-                                   and self.i == self.nchunks - 1 else ''),
-                level=DEBUG)
-        decompressed = blosc.decompress(compressed)
-        print_verbose("chunk handled, in: %s out: %s" %
-                (pretty_size(len(compressed)),
-                    pretty_size(len(decompressed))), level=DEBUG)
-        self.output_fp.write(decompressed)
+        if LEVEL == DEBUG:
+            print_debug("decompressing chunk '%d'%s", self.i,
+                    ' (last)' if self.nchunks is not None
+                                 and self.i == self.nchunks - 1 else '')
+        self.i += 1
+        if self.sparse:
+            value, nbytes = _decode_constant_chunk(compressed)
+            if value is not None and value.count('\x00') == len(value):
+                self._skip(nbytes)
+                return
+        with _stage('decompress'):
+            decompressed = _decompress_chunk_str(compressed)
+        if LEVEL == DEBUG:
+            print_debug("chunk handled, in: %s out: %s",
+                    pretty_size(len(compressed)),
+                    pretty_size(len(decompressed)))
+        if self.sparse and _is_zero(decompressed):
+            self._skip(len(decompressed))
+        else:
+            self.output_fp.write(decompressed)
+
+    def _skip(self, nbytes):
+        if LEVEL == DEBUG:
+            print_debug('zero chunk, leaving a hole of %s',
+                    pretty_size(nbytes))
+        self.output_fp.seek(nbytes, 1)
+        self.holes += 1
+
+    def finalize(self):
+        if self.holes:
+            # a hole at the end must be turned into file size explicitly
+            self.output_fp.truncate(self.output_fp.tell())
+            print_verbose("left '%d' holes in the output" % self.holes)
+
+
+class PlainParallelFPSink(PlainSink):
+    """ Decompress chunks in parallel into a preallocated file.
+
+    Parameters
+    ----------
+    output_fp : file
+        the output file, opened for reading and writing, with its final size
+    chunk_size : int
+        the size of all but the last decompressed chunk
+    nthreads : int
+        the number of worker threads
+    sparse : bool
+        if chunks of null bytes should be skipped, leaving holes
+    memory_budget : MemoryBudget or None
+        if given, limits the compressed chunks buffered for the workers
+
+    Notes
+    -----
+    Since the position of each decompressed chunk in the output is known,
+    the workers decompress straight into a memory map of the output file,
+    independently of each other. The GIL is released during decompression.
+    Chunks put with 'reserved' have been acquired from the memory budget by
+    whoever read them, the sink only releases them once they are written.
+
+    """
+
+    def __init__(self, output_fp, chunk_size, nthreads, sparse=False,
+            memory_budget=None):
+        self.mmap = mmap.mmap(output_fp.fileno(), 0)
+        self.raw = np.frombuffer(self.mmap, dtype=np.uint8)
+        self.ptr = self.raw.__array_interface__['data'][0]
+        self.chunk_size = chunk_size
+        self.sparse = sparse
+        self.batch_size = nthreads * 4
+        self.memory_budget = memory_budget
+        self.pending = []
+        self.i = 0
+        self.pool = multiprocessing.pool.ThreadPool(nthreads)
+        _acquire_releasegil()
+
+    def put(self, compressed, reserved=False):
+        if self.memory_budget is not None and not reserved:
+            while not self.memory_budget.acquire(len(compressed),
+                    block=not self.pending):
+                self.flush()
+        self.pending.append((self.i * self.chunk_size, compressed))
         self.i += 1
+        if len(self.pending) == self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        # the workers account their time to the stats of the caller
+        stats = _current_stats()
+        try:
+            self.pool.map(lambda item: self._write(item, stats),
+                    self.pending)
+        finally:
+            if self.memory_budget is not None:
+                self.memory_budget.release(sum(len(compressed)
+                    for _, compressed in self.pending))
+            self.pending = []
+
+    def _write(self, item, stats=None):
+        with _stage('decompress', stats):
+            self._decompress(item)
+
+    def _decompress(self, item):
+        offset, compressed = item
+        value, nbytes = _decode_constant_chunk(compressed)
+        if value is None:
+            nbytes = decode_blosc_header(compressed)['nbytes']
+        if offset + nbytes > len(self.raw):
+            raise ValueError("chunk at '%d' of length '%d' exceeds the "
+                    "output" % (offset, nbytes))
+        if value is not None:
+            if not (self.sparse and value.count('\x00') == len(value)):
+                _fill_constant(self.raw[offset:offset + nbytes], value)
+        elif self.sparse:
+            decompressed = blosc.decompress(compressed)
+            if not _is_zero(decompressed):
+                self.raw[offset:offset + nbytes] = \
+                        np.frombuffer(decompressed, dtype=np.uint8)
+        else:
+            blosc.decompress_ptr(compressed, self.ptr + offset)
+
+    def finalize(self):
+        try:
+            if self.pending:
+                self.flush()
+        finally:
+            self.pool.close()
+            self.pool.join()
+            _release_releasegil()
+            del self.raw
+            self.mmap.flush()
+            self.mmap.close()
+        print_verbose("decompressed '%d' chunks in parallel" % self.i)
 
 
 class CompressedFPSink(CompressedSink):
@@ -1798,6 +3240,9 @@ class CompressedFPSink(CompressedSink):
     def __init__(self, output_fp):
         self.output_fp = output_fp
         self.meta_total = 0
+        # maps the hash of each chunk written to its offset and digest
+        self.written_chunks = {}
+        self.nduplicates = 0
 
     def write_bloscpack_header(self):
         raw_bloscpack_header = self.bloscpack_header.encode()
@@ -1814,18 +3259,46 @@ class CompressedFPSink(CompressedSink):
             self.offset_storage = list(itertools.repeat(-1,
                 self.bloscpack_header.nchunks))
             self.output_fp.write(encode_int64(-1) * total_entries)
+        if self.merkle:
+            self.digest_storage = [None] * self.bloscpack_header.nchunks
+            self.output_fp.write('\x00' *
+                    _merkle_section_length(self.bloscpack_header))
 
     def finalize(self):
         if self.offsets:
             self.output_fp.seek(BLOSCPACK_HEADER_LENGTH + self.meta_total, 0)
             _write_offsets(self.output_fp, self.offset_storage)
+        if self.merkle:
+            self.output_fp.seek(BLOSCPACK_HEADER_LENGTH + self.meta_total +
+                    8 * (self.bloscpack_header.nchunks +
+                         self.bloscpack_header.max_app_chunks), 0)
+            _write_merkle_tree(self.output_fp, self.bloscpack_header,
+                    self.digest_storage)
+        if self.dedup:
+            print_verbose("'%d' duplicate chunks were not written" %
+                    self.nduplicates)
 
     def put(self, i, compressed):
+        if self.dedup:
+            key = hashlib.sha1(compressed).digest()
+            if key in self.written_chunks:
+                offset, digest = self.written_chunks[key]
+                print_debug("chunk '%d' is a duplicate, sharing offset '%d'",
+                        i, offset)
+                self.nduplicates += 1
+                self.offset_storage[i] = offset
+                if self.merkle:
+                    self.digest_storage[i] = digest
+                return offset, compressed, digest
         offset = self.output_fp.tell()
         digest = self.do_checksum(compressed)
         _write_compressed_chunk(self.output_fp, compressed, digest)
+        if self.dedup:
+            self.written_chunks[key] = offset, digest
         if self.offsets:
             self.offset_storage[i] = offset
+        if self.merkle:
+            self.digest_storage[i] = digest
         return offset, compressed, digest
 
 
@@ -1892,27 +3365,51 @@ class PlainNumpySink(PlainSink):
                 dtype=np.dtype(metadata['dtype']),
                 order=metadata['order'])
         self.ptr = self.ndarray.__array_interface__['data'][0]
+        self.nbytes = 0
 
     def put(self, compressed):
-        bwritten = blosc.decompress_ptr(compressed, self.ptr)
-        self.ptr += bwritten
+        value, nbytes = _decode_constant_chunk(compressed)
+        if value is None:
+            nbytes = blosc.decompress_ptr(compressed, self.ptr)
+        else:
+            raw = self.ndarray.ravel(order='K').view(np.uint8)
+            _fill_constant(raw[self.nbytes:self.nbytes + nbytes], value)
+        self.ptr += nbytes
+        self.nbytes += nbytes
 
 
-def pack(source, sink,
-        nchunks, chunk_size, last_chunk,
+def _write_beginning(sink, nchunks, chunk_size, last_chunk,
         metadata=None,
         blosc_args=DEFAULT_BLOSC_ARGS,
         bloscpack_args=DEFAULT_BLOSCPACK_ARGS,
         metadata_args=DEFAULT_METADATA_ARGS):
-    """ Core packing function.  """
-    _check_blosc_args(blosc_args)
-    print_verbose('blosc args are:', level=DEBUG)
-    for arg, value in blosc_args.iteritems():
-        print_verbose('\t%s: %s' % (arg, value), level=DEBUG)
-    _check_bloscpack_args(bloscpack_args)
-    print_verbose('bloscpack args are:', level=DEBUG)
-    for arg, value in bloscpack_args.iteritems():
-        print_verbose('\t%s: %s' % (arg, value), level=DEBUG)
+    """ Configure a sink and write the header, metadata and offsets.
+
+    Parameters
+    ----------
+    sink : CompressedSink
+        the sink to write to
+    nchunks : int
+        the number of chunks
+    chunk_size : int
+        the size of each chunk
+    last_chunk : int
+        the size of the last chunk
+    metadata : dict
+        the metadata dict
+    blosc_args : dict
+        blosc keyword args
+    bloscpack_args : dict
+        bloscpack keyword args
+    metadata_args : dict
+        metadata keyword args
+
+    Returns
+    -------
+    bloscpack_header : BloscPackHeader
+        the header that was written
+
+    """
     max_app_chunks = _handle_max_apps(bloscpack_args['offsets'],
             nchunks,
             bloscpack_args['max_app_chunks'])
@@ -1925,9 +3422,11 @@ def pack(source, sink,
             chunk_size=chunk_size,
             last_chunk=last_chunk,
             nchunks=nchunks,
-            max_app_chunks=max_app_chunks
+            max_app_chunks=max_app_chunks,
+            merkle=bloscpack_args['merkle'],
+            dedup=bloscpack_args['dedup'],
+            constant=bloscpack_args['constant'],
             )
-    source.configure(chunk_size, last_chunk, nchunks)
     sink.configure(blosc_args, bloscpack_header)
     sink.write_bloscpack_header()
     # deal with metadata
@@ -1936,112 +3435,822 @@ def pack(source, sink,
     elif metadata_args is not None:
         print_verbose('metadata_args will be silently ignored', level=DEBUG)
     sink.init_offsets()
-
-    compress_func = source.compress_func
-    # read-compress-write loop
-    for i, chunk in enumerate(source()):
-        print_verbose("Handle chunk '%d' %s" % (i,'(last)' if i == nchunks -1
-            else ''), level=DEBUG)
-        compressed = compress_func(chunk, blosc_args)
-        sink.put(i, compressed)
-
-    sink.finalize()
+    return bloscpack_header
 
 
-def pack_ndarray(ndarray, sink,
-        chunk_size=DEFAULT_CHUNK_SIZE,
-        blosc_args=DEFAULT_BLOSC_ARGS,
-        bloscpack_args=DEFAULT_BLOSCPACK_ARGS,
-        metadata_args=DEFAULT_METADATA_ARGS):
-    """ Serialialize a Numpy array.
+class MemoryBudget(object):
+    """ A limit on the number of bytes buffered by a pipeline.
 
     Parameters
     ----------
-    ndarray : ndarray
-        the numpy array to serialize
-    sink : CompressedSink
-        the sink to serialize to
-    blosc_args : dict
-        the args for blosc
-    bloscpack_args : dict
-        the args for bloscpack
-    metadata_args : dict
-        the args for the metadata
+    limit : int
+        the number of bytes that may be buffered at once
 
     Notes
     -----
+    A pipeline acquires the size of each item before buffering it and
+    releases it once the item has been written, waiting, and thereby holding
+    back the reading side, while the budget is exhausted. An item larger than
+    the limit is admitted when nothing else is buffered, so that a pipeline
+    always makes progress. 'peak' records the largest number of bytes
+    buffered at once. A budget may be shared by several pipelines.
 
-    The 'typesize' value of 'blosc_args' will be silently ignored and replaced
-    with the itemsize of the Numpy array's dtype.
     """
 
-    blosc_args = blosc_args.copy()
-    blosc_args['typesize'] = ndarray.dtype.itemsize
-    source = PlainNumpySource(ndarray)
-    nchunks, chunk_size, last_chunk_size = \
-            calculate_nchunks(source.size, chunk_size)
-    pack(source, sink,
-            nchunks, chunk_size, last_chunk_size,
-            metadata=source.metadata,
-            blosc_args=blosc_args,
-            bloscpack_args=bloscpack_args,
-            metadata_args=metadata_args)
-    #out_file_size = path.getsize(file_pointer)
-    #print_verbose('output file size: %s' % double_pretty_size(out_file_size))
-    #print_verbose('compression ratio: %f' % (out_file_size/source.size))
+    def __init__(self, limit):
+        if limit <= 0:
+            raise ValueError("'limit' must be > 0, not '%d'" % limit)
+        self.limit = limit
+        self.in_use = 0
+        self.peak = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, nbytes, block=True):
+        """ Reserve 'nbytes', return False if 'block' is False and they do
+        not fit.
+        """
+        with self.condition:
+            while self.in_use > 0 and self.in_use + nbytes > self.limit:
+                if not block:
+                    return False
+                self.condition.wait()
+            self.in_use += nbytes
+            self.peak = max(self.peak, self.in_use)
+            return True
+
+    def release(self, nbytes):
+        """ Return 'nbytes' to the budget. """
+        with self.condition:
+            self.in_use -= nbytes
+            self.condition.notify_all()
+
+
+_releasegil_lock = threading.Lock()
+_releasegil_users = 0
+_releasegil_saved = None
+
+
+def _acquire_releasegil():
+    """ Let Blosc release the GIL, until a matching ``_release_releasegil``.
+
+    The setting is global to the process and shared by concurrent pipelines,
+    so it is reference counted. The first user turns it on, and the last one
+    restores the previous value, no matter in which order they finish.
+    python-blosc before 1.5 has no such setting, and keeps the GIL.
+    """
+    global _releasegil_users, _releasegil_saved
+    set_releasegil = getattr(blosc, 'set_releasegil', None)
+    with _releasegil_lock:
+        if _releasegil_users == 0 and set_releasegil is not None:
+            _releasegil_saved = set_releasegil(True)
+        _releasegil_users += 1
 
 
-def pack_ndarray_file(ndarray, filename,
-                      chunk_size=DEFAULT_CHUNK_SIZE,
-                      blosc_args=DEFAULT_BLOSC_ARGS,
-                      bloscpack_args=DEFAULT_BLOSCPACK_ARGS,
-                      metadata_args=DEFAULT_METADATA_ARGS):
-    with open(filename, 'wb') as fp:
-        sink = CompressedFPSink(fp)
-        pack_ndarray(ndarray, sink,
-                    chunk_size=chunk_size,
-                    blosc_args=blosc_args,
-                    bloscpack_args=bloscpack_args,
-                    metadata_args=metadata_args)
+def _release_releasegil():
+    """ Undo one ``_acquire_releasegil``. """
+    global _releasegil_users
+    set_releasegil = getattr(blosc, 'set_releasegil', None)
+    with _releasegil_lock:
+        _releasegil_users -= 1
+        if _releasegil_users == 0 and set_releasegil is not None:
+            set_releasegil(_releasegil_saved)
 
 
-def pack_ndarray_str(ndarray,
-                      chunk_size=DEFAULT_CHUNK_SIZE,
-                      blosc_args=DEFAULT_BLOSC_ARGS,
-                      bloscpack_args=DEFAULT_BLOSCPACK_ARGS,
-                      metadata_args=DEFAULT_METADATA_ARGS):
-    sio = cStringIO.StringIO()
-    sink = CompressedFPSink(sio)
-    pack_ndarray(ndarray, sink,
-                    chunk_size=chunk_size,
-                    blosc_args=blosc_args,
-                    bloscpack_args=bloscpack_args,
-                    metadata_args=metadata_args)
-    return sio.getvalue()
+def _thread_cpu_time():
+    """ The CPU time used by the calling thread, in seconds.
 
-def unpack_ndarray(source):
-    """ Deserialize a Numpy array.
+    Falls back to the CPU time of the whole process where the time of a
+    single thread is not available.
+    """
+    if resource is not None:
+        try:
+            usage = resource.getrusage(RUSAGE_THREAD)
+            return usage.ru_utime + usage.ru_stime
+        except (ValueError, resource.error):  # pragma: no cover
+            pass
+    return time.clock()  # pragma: no cover
 
-    Parameters
-    ----------
-    source : CompressedSource
-        the source containing the serialized Numpy array
 
-    Returns
-    -------
-    ndarray : ndarray
-        the Numpy array
+# the stages being timed by the current thread, innermost last
+_active_stages = threading.local()
 
-    Raises
-    ------
-    NotANumpyArray
-        if the source doesn't seem to contain a Numpy array
-    """
 
-    sink = PlainNumpySink(source.metadata)
-    for compressed in iter(source):
-        sink.put(compressed)
-    return sink.ndarray
+class _StageFrame(object):
+    """ The timings of a single pass through a stage.
+
+    'wall' and 'cpu' exclude the stages nested within, whose wall times are
+    in 'nested', by name.
+    """
+
+    __slots__ = ('stats', 'start', 'cpu_start', 'wall', 'cpu', 'nested',
+            'nested_cpu')
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.start = time.time()
+        self.cpu_start = _thread_cpu_time()
+        self.wall = self.cpu = 0.0
+        self.nested = {}
+        self.nested_cpu = 0.0
+
+
+class PipelineStats(object):
+    """ The wall and CPU time spent in each stage of a pipeline.
+
+    Attributes
+    ----------
+    wall : dict
+        maps the name of each stage to its wall time in seconds
+    cpu : dict
+        maps the name of each stage to its CPU time in seconds
+    count : dict
+        maps the name of each stage to the number of times it was entered
+
+    Notes
+    -----
+    The time of a stage excludes that of the stages nested within it in the
+    same thread, for example the checksum of a chunk while writing it. When
+    chunks are processed by several threads, their stages overlap, and the
+    sum of the wall times may exceed the duration of the pipeline. The
+    stages are listed in 'PIPELINE_STAGES'.
+
+    """
+
+    def __init__(self):
+        self.wall = {}
+        self.cpu = {}
+        self.count = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, wall, cpu):
+        """ Account 'wall' and 'cpu' seconds to the stage 'name'. """
+        with self.lock:
+            self.wall[name] = self.wall.get(name, 0.0) + wall
+            self.cpu[name] = self.cpu.get(name, 0.0) + cpu
+            self.count[name] = self.count.get(name, 0) + 1
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """ Time the body of a with statement as the stage 'name'.
+
+        Yields a '_StageFrame', which holds the timings of this stage once
+        the body has been left.
+        """
+        stack = _active_stages.__dict__.setdefault('stack', [])
+        frame = _StageFrame(self)
+        stack.append(frame)
+        try:
+            yield frame
+        finally:
+            stack.pop()
+            wall = time.time() - frame.start
+            cpu = _thread_cpu_time() - frame.cpu_start
+            frame.wall = wall - sum(frame.nested.itervalues())
+            frame.cpu = cpu - frame.nested_cpu
+            self.add(name, frame.wall, frame.cpu)
+            if stack:
+                parent = stack[-1]
+                parent.nested[name] = parent.nested.get(name, 0.0) + wall
+                parent.nested_cpu += cpu
+
+    def timed(self, name, iterable):
+        """ Iterate, timing the production of each item as the stage 'name'.
+
+        Yields pairs of the '_StageFrame' and the item.
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name) as frame:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield frame, item
+
+    def stages(self):
+        """ The names of the stages entered, in the order they are reported.
+        """
+        known = [name for name in PIPELINE_STAGES if name in self.count]
+        return known + sorted(set(self.count) - set(PIPELINE_STAGES))
+
+    def summary(self):
+        """ A single line with the wall and CPU time of every stage. """
+        return ', '.join('%s: %.3fs/%.3fs' %
+                (name, self.wall[name], self.cpu[name])
+                for name in self.stages())
+
+    def __repr__(self):
+        return 'PipelineStats(%s)' % self.summary()
+
+
+class _NullFrame(object):
+    """ A stage that is not timed, entering it yields itself. """
+
+    __slots__ = ()
+
+    wall = cpu = nested_cpu = 0.0
+    nested = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_FRAME = _NullFrame()
+
+
+class _NullStats(PipelineStats):
+    """ Stats that time nothing, all their stages take no time. """
+
+    def add(self, name, wall, cpu):
+        pass
+
+    def stage(self, name):
+        return _NULL_FRAME
+
+    def timed(self, name, iterable):
+        return itertools.izip(itertools.repeat(_NULL_FRAME), iterable)
+
+
+def _pipeline_stats(stats=None, observer=None):
+    """ The stats to time a pipeline with.
+
+    These are 'stats' if given, new 'PipelineStats' if the times are printed,
+    at verbose level, or reported to the 'observer', and otherwise stats that
+    time nothing, such that the chunk loops do not pay for timings nobody
+    asked for.
+    """
+    if stats is not None:
+        return stats
+    elif LEVEL != NORMAL or observer is not None:
+        return PipelineStats()
+    return _NullStats()
+
+
+def _current_stats():
+    """ The stats of the innermost stage timed by this thread, or None. """
+    stack = getattr(_active_stages, 'stack', None)
+    return stack[-1].stats if stack else None
+
+
+@contextlib.contextmanager
+def _stage(name, stats=None):
+    """ Time a stage in 'stats', by default those of the innermost stage
+    being timed by the current thread, if any.
+    """
+    if stats is None:
+        stats = _current_stats()
+    if stats is None:
+        yield None
+    else:
+        with stats.stage(name) as frame:
+            yield frame
+
+
+class ChunkEvent(collections.namedtuple('ChunkEvent',
+        ('operation', 'index', 'raw_size', 'compressed_size', 'read_time',
+         'codec_time', 'write_time', 'checksum_time'))):
+    """ The processing of a single chunk.
+
+    Attributes
+    ----------
+    operation : str
+        one of 'pack', 'unpack', 'append' or 'read'
+    index : int
+        the index of the chunk in the file
+    raw_size : int
+        the size of the chunk when decompressed
+    compressed_size : int
+        the size of the compressed chunk, without its checksum
+    read_time : float
+        the seconds spent reading the chunk
+    codec_time : float
+        the seconds spent compressing or decompressing the chunk
+    write_time : float
+        the seconds spent writing the chunk
+    checksum_time : float
+        the seconds spent computing or verifying the checksum
+
+    Notes
+    -----
+    The times exclude each other. When reading several chunks with a single
+    read, the time of the read is divided among the chunks by size.
+
+    """
+
+    __slots__ = ()
+
+    @property
+    def duration(self):
+        """ The seconds spent on the chunk in total. """
+        return (self.read_time + self.codec_time + self.write_time +
+                self.checksum_time)
+
+    @property
+    def ratio(self):
+        """ The compressed size relative to the raw size. """
+        return self.compressed_size / self.raw_size if self.raw_size else 0.0
+
+
+class ChunkObserver(object):
+    """ Receives an event for every chunk processed by an operation.
+
+    Observers are passed as 'observer' to ``pack``, ``unpack``,
+    ``append_fp`` and ``read_chunks_fp`` and the functions wrapping them.
+    Subclasses override 'chunk', which is called in the order the chunks are
+    written, and optionally 'finish', called once the operation has
+    succeeded. An observer shared between threads must be thread-safe.
+
+    """
+
+    def chunk(self, event):
+        """ Handle the 'ChunkEvent' of a chunk. """
+        pass
+
+    def finish(self, operation):
+        """ Handle the end of an 'operation'. """
+        pass
+
+
+class _Histogram(object):
+    """ A cumulative histogram with fixed bucket bounds. """
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+def _prometheus_value(value):
+    """ Format a number for the Prometheus text format.
+
+    The 'repr' of a long ends in 'L' on Python 2, which is not valid.
+    """
+    if isinstance(value, (int, long)):
+        return '%d' % value
+    return repr(float(value))
+
+
+class PrometheusExporter(ChunkObserver):
+    """ Write chunk metrics to a file in the Prometheus text format.
+
+    Parameters
+    ----------
+    filename : str
+        the file to write, for example in the directory of the textfile
+        collector of the node exporter
+    duration_buckets : sequence of float
+        the bucket bounds of the chunk duration histogram, in seconds
+    ratio_buckets : sequence of float
+        the bucket bounds of the compression ratio histogram
+
+    Notes
+    -----
+    The metrics are labelled by operation and accumulate over all
+    operations observed. The file is rewritten, by renaming a temporary file
+    such that readers never see a partial file, whenever an operation
+    finishes or 'write' is called.
+
+    """
+
+    def __init__(self, filename,
+            duration_buckets=DEFAULT_DURATION_BUCKETS,
+            ratio_buckets=DEFAULT_RATIO_BUCKETS):
+        self.filename = filename
+        self.duration_buckets = tuple(duration_buckets)
+        self.ratio_buckets = tuple(ratio_buckets)
+        self.operations = OrderedDict()
+        self.lock = threading.Lock()
+
+    def chunk(self, event):
+        with self.lock:
+            if event.operation not in self.operations:
+                self.operations[event.operation] = {
+                        'chunks': 0,
+                        'raw_bytes': 0,
+                        'compressed_bytes': 0,
+                        'checksum_seconds': 0.0,
+                        'duration': _Histogram(self.duration_buckets),
+                        'ratio': _Histogram(self.ratio_buckets),
+                        }
+            metrics = self.operations[event.operation]
+            metrics['chunks'] += 1
+            metrics['raw_bytes'] += event.raw_size
+            metrics['compressed_bytes'] += event.compressed_size
+            metrics['checksum_seconds'] += event.checksum_time
+            metrics['duration'].observe(event.duration)
+            metrics['ratio'].observe(event.ratio)
+
+    def finish(self, operation):
+        self.write()
+
+    def render(self):
+        """ The metrics in the Prometheus text format. """
+        lines = []
+        with self.lock:
+            for name, key, help_ in (
+                    ('chunks_total', 'chunks', 'Chunks processed.'),
+                    ('raw_bytes_total', 'raw_bytes',
+                        'Decompressed bytes of the chunks processed.'),
+                    ('compressed_bytes_total', 'compressed_bytes',
+                        'Compressed bytes of the chunks processed.'),
+                    ('checksum_seconds_total', 'checksum_seconds',
+                        'Seconds spent on the checksums of chunks.')):
+                lines.append('# HELP bloscpack_%s %s' % (name, help_))
+                lines.append('# TYPE bloscpack_%s counter' % name)
+                for operation, metrics in self.operations.iteritems():
+                    lines.append('bloscpack_%s{operation="%s"} %s' %
+                            (name, operation,
+                             _prometheus_value(metrics[key])))
+            for name, key, help_ in (
+                    ('chunk_duration_seconds', 'duration',
+                        'Seconds spent on a chunk.'),
+                    ('chunk_ratio', 'ratio',
+                        'Compressed size of a chunk relative to its size.')):
+                lines.append('# HELP bloscpack_%s %s' % (name, help_))
+                lines.append('# TYPE bloscpack_%s histogram' % name)
+                for operation, metrics in self.operations.iteritems():
+                    histogram = metrics[key]
+                    for bound, count in zip(histogram.bounds,
+                            histogram.counts):
+                        lines.append('bloscpack_%s_bucket{operation="%s",'
+                                'le="%s"} %d' %
+                                (name, operation, _prometheus_value(bound),
+                                 count))
+                    lines.append('bloscpack_%s_bucket{operation="%s",'
+                            'le="+Inf"} %d' %
+                            (name, operation, histogram.count))
+                    lines.append('bloscpack_%s_sum{operation="%s"} %s' %
+                            (name, operation,
+                             _prometheus_value(histogram.sum)))
+                    lines.append('bloscpack_%s_count{operation="%s"} %d' %
+                            (name, operation, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        """ Write the metrics to the file. """
+        tmp_file = self.filename + '.tmp'
+        with open(tmp_file, 'w') as fp:
+            fp.write(self.render())
+        os.rename(tmp_file, self.filename)
+
+
+def _pipelined(pool, func, items, max_inflight, memory_budget=None,
+        size=len):
+    """ Apply a function to items in a pool, yielding results in order.
+
+    At most 'max_inflight' items, and if given, no more than the
+    'memory_budget' as measured by 'size', are handed to the pool at once.
+    The items are consumed, and the results processed, in the calling thread,
+    which hence overlaps its I/O with the work in the pool.
+    """
+    pending = collections.deque()
+
+    def complete():
+        result, nbytes = pending.popleft()
+        value = result.get()
+        if memory_budget is not None:
+            memory_budget.release(nbytes)
+        return value
+
+    try:
+        for item in items:
+            nbytes = 0
+            if memory_budget is not None:
+                nbytes = size(item)
+                # only wait for other pipelines if nothing is pending here
+                while not memory_budget.acquire(nbytes, block=not pending):
+                    yield complete()
+            pending.append((pool.apply_async(func, (item,)), nbytes))
+            if len(pending) >= max_inflight:
+                yield complete()
+        while pending:
+            yield complete()
+    finally:
+        if memory_budget is not None:
+            memory_budget.release(sum(nbytes for _, nbytes in pending))
+
+
+def _prefetch(items, max_inflight, memory_budget=None, size=len,
+        handoff=False, idle=None):
+    """ Consume an iterable in a background thread, up to 'max_inflight'
+    items, and if given, the 'memory_budget' as measured by 'size', ahead of
+    the caller.
+
+    The bytes of an item are released once the caller asks for the next one,
+    unless 'handoff' is True, in which case releasing them is up to the
+    caller. If given, 'idle' is called before waiting for an item that has
+    not been read yet, so that a caller holding on to handed off items may
+    release them. Exceptions raised by the iterable are re-raised in the
+    calling thread.
+    """
+    queue = Queue.Queue(max_inflight)
+    stop = threading.Event()
+    done = object()
+
+    def produce():
+        try:
+            for item in items:
+                if stop.is_set():
+                    return
+                nbytes = 0
+                if memory_budget is not None:
+                    nbytes = size(item)
+                    memory_budget.acquire(nbytes)
+                queue.put((item, nbytes, None))
+            queue.put((done, 0, None))
+        except Exception:
+            queue.put((None, 0, sys.exc_info()))
+
+    def release(nbytes):
+        if memory_budget is not None:
+            memory_budget.release(nbytes)
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            if idle is not None and queue.empty():
+                idle()
+            item, nbytes, exc_info = queue.get()
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if item is done:
+                break
+            try:
+                yield item
+            finally:
+                # the caller is done with the item once it asks for the next
+                if not handoff:
+                    release(nbytes)
+    finally:
+        stop.set()
+        # drain the queue, so that a blocked producer may notice the stop
+        while thread.is_alive():
+            try:
+                release(queue.get_nowait()[1])
+            except Queue.Empty:
+                thread.join(0.01)
+        while not queue.empty():
+            release(queue.get_nowait()[1])
+
+
+def pack(source, sink,
+        nchunks, chunk_size, last_chunk,
+        metadata=None,
+        blosc_args=DEFAULT_BLOSC_ARGS,
+        bloscpack_args=DEFAULT_BLOSCPACK_ARGS,
+        metadata_args=DEFAULT_METADATA_ARGS,
+        nthreads=1,
+        max_inflight=DEFAULT_MAX_INFLIGHT,
+        memory_budget=None,
+        stats=None,
+        observer=None,
+        objective=None,
+        adaptive=None):
+    """ Core packing function.
+
+    If 'nthreads' is larger than one, chunks are compressed by a pool of
+    threads, at most 'max_inflight' at a time, while the next chunks are read
+    and the compressed ones written in the calling thread. A 'memory_budget'
+    further limits the chunks in flight, counting each twice the chunk size
+    for its plain and compressed copies. If given, the 'ChunkObserver'
+    'observer' receives an event for every chunk written.
+
+    Any of 'cname', 'clevel' and 'shuffle' in 'blosc_args' may be 'auto', to
+    be chosen by ``auto_blosc_args`` for the 'objective' from the first
+    chunks. If 'adaptive' is an 'AdaptiveCompressor', or True for one with
+    the defaults, every chunk is compressed with the best of its candidates.
+
+    Returns the 'PipelineStats' with the time spent in each stage, those
+    given as 'stats' if any. Unless given, printed or needed by the
+    'observer', the times are not measured, and the stats are empty.
+    """
+    _check_blosc_args(blosc_args)
+    print_verbose('blosc args are:', level=DEBUG)
+    for arg, value in blosc_args.iteritems():
+        print_verbose('\t%s: %s' % (arg, value), level=DEBUG)
+    bloscpack_args = _complete_bloscpack_args(bloscpack_args)
+    _check_bloscpack_args(bloscpack_args)
+    print_verbose('bloscpack args are:', level=DEBUG)
+    for arg, value in bloscpack_args.iteritems():
+        print_verbose('\t%s: %s' % (arg, value), level=DEBUG)
+    stats = _pipeline_stats(stats, observer)
+    if adaptive is True:
+        adaptive = AdaptiveCompressor()
+    elif adaptive is False:
+        adaptive = None
+    source.configure(chunk_size, last_chunk, nchunks)
+    chunks = stats.timed('read', source())
+    if 'auto' in (blosc_args['cname'], blosc_args['clevel'],
+            blosc_args['shuffle']):
+        # sample the first chunks, and hand them on to be compressed
+        head = list(itertools.islice(chunks, AUTO_BLOSC_SAMPLES))
+        chunks = itertools.chain(head, chunks)
+        with stats.stage('calibrate'):
+            size = AUTO_BLOSC_SAMPLE_SIZE - \
+                    AUTO_BLOSC_SAMPLE_SIZE % blosc_args['typesize']
+            samples = [source.as_bytes(chunk) for _, chunk in head]
+            blosc_args, _ = auto_blosc_args(
+                    [sample[:size].tostring() for sample in samples
+                     if sample is not None],
+                    blosc_args, objective=objective)
+    with stats.stage('metadata'):
+        _write_beginning(sink, nchunks, chunk_size, last_chunk,
+                metadata=metadata,
+                blosc_args=blosc_args,
+                bloscpack_args=bloscpack_args,
+                metadata_args=metadata_args)
+
+    compress_func = source.compress_func
+
+    def compress(item):
+        i, (read_frame, chunk) = item
+        with stats.stage('compress') as frame:
+            value = None
+            if bloscpack_args['constant']:
+                raw = source.as_bytes(chunk)
+                value = _constant_value(raw, blosc_args['typesize'])
+            if value is not None:
+                print_debug("chunk '%d' is constant", i)
+                compressed = _encode_constant_chunk(value, len(raw))
+            elif adaptive is not None:
+                compressed = adaptive.compress(compress_func, chunk,
+                        blosc_args)
+            else:
+                compressed = compress_func(chunk, blosc_args)
+        return compressed, read_frame.wall, frame.wall
+
+    pool = None
+    if nthreads > 1 or adaptive is not None:
+        _acquire_releasegil()
+    if adaptive is not None:
+        adaptive.open()
+    if nthreads > 1:
+        pool = multiprocessing.pool.ThreadPool(nthreads)
+        compressed_chunks = _pipelined(pool, compress, enumerate(chunks),
+                max_inflight, memory_budget=memory_budget,
+                size=lambda item: 2 * chunk_size)
+    else:
+        compressed_chunks = itertools.imap(compress, enumerate(chunks))
+    # read-compress-write loop
+    try:
+        for i, (compressed, read_time, compress_time) in \
+                enumerate(compressed_chunks):
+            print_debug("Handle chunk '%d' %s", i,
+                    '(last)' if i == nchunks - 1 else '')
+            with stats.stage('write') as frame:
+                sink.put(i, compressed)
+            if observer is not None:
+                observer.chunk(ChunkEvent('pack', i,
+                    chunk_size if i < nchunks - 1 else last_chunk,
+                    len(compressed), read_time, compress_time, frame.wall,
+                    frame.nested.get('checksum', 0.0)))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if adaptive is not None:
+            adaptive.close()
+        if nthreads > 1 or adaptive is not None:
+            _release_releasegil()
+
+    with stats.stage('finalize'):
+        sink.finalize()
+    if observer is not None:
+        observer.finish('pack')
+    if memory_budget is not None:
+        print_verbose('peak buffered: %s' %
+                double_pretty_size(memory_budget.peak))
+    if adaptive is not None:
+        print_verbose('adaptive choices: %s' % adaptive.summary())
+    print_verbose('time in stages (wall/cpu): %s' % stats.summary())
+    return stats
+
+
+def pack_ndarray(ndarray, sink,
+        chunk_size=DEFAULT_CHUNK_SIZE,
+        blosc_args=DEFAULT_BLOSC_ARGS,
+        bloscpack_args=DEFAULT_BLOSCPACK_ARGS,
+        metadata_args=DEFAULT_METADATA_ARGS,
+        objective=None):
+    """ Serialialize a Numpy array.
+
+    Parameters
+    ----------
+    ndarray : ndarray
+        the numpy array to serialize
+    sink : CompressedSink
+        the sink to serialize to
+    chunk_size : int or str
+        the desired chunk size in bytes, or 'auto' to choose one with
+        ``auto_chunk_size``
+    blosc_args : dict
+        the args for blosc
+    bloscpack_args : dict
+        the args for bloscpack
+    metadata_args : dict
+        the args for the metadata
+    objective : Objective, str or None
+        the objective of any blosc args that are 'auto'
+
+    Notes
+    -----
+
+    The 'typesize' value of 'blosc_args' will be silently ignored and replaced
+    with the itemsize of the Numpy array's dtype.
+    """
+
+    blosc_args = blosc_args.copy()
+    blosc_args['typesize'] = ndarray.dtype.itemsize
+    source = PlainNumpySource(ndarray)
+    if chunk_size == 'auto':
+        if source.raw is None:
+            chunk_size = DEFAULT_CHUNK_SIZE
+        else:
+            chunk_size = auto_chunk_size(
+                    source.raw[:AUTO_CHUNK_SAMPLE_SIZE].tostring(),
+                    source.size, blosc_args['typesize'],
+                    blosc_args=blosc_args)
+    nchunks, chunk_size, last_chunk_size = \
+            calculate_nchunks(source.size, chunk_size)
+    pack(source, sink,
+            nchunks, chunk_size, last_chunk_size,
+            metadata=source.metadata,
+            blosc_args=blosc_args,
+            bloscpack_args=bloscpack_args,
+            metadata_args=metadata_args,
+            objective=objective)
+    #out_file_size = path.getsize(file_pointer)
+    #print_verbose('output file size: %s' % double_pretty_size(out_file_size))
+    #print_verbose('compression ratio: %f' % (out_file_size/source.size))
+
+
+def pack_ndarray_file(ndarray, filename,
+                      chunk_size=DEFAULT_CHUNK_SIZE,
+                      blosc_args=DEFAULT_BLOSC_ARGS,
+                      bloscpack_args=DEFAULT_BLOSCPACK_ARGS,
+                      metadata_args=DEFAULT_METADATA_ARGS,
+                      objective=None):
+    with open(filename, 'wb') as fp:
+        sink = CompressedFPSink(fp)
+        pack_ndarray(ndarray, sink,
+                    chunk_size=chunk_size,
+                    blosc_args=blosc_args,
+                    bloscpack_args=bloscpack_args,
+                    metadata_args=metadata_args,
+                    objective=objective)
+
+
+def pack_ndarray_str(ndarray,
+                      chunk_size=DEFAULT_CHUNK_SIZE,
+                      blosc_args=DEFAULT_BLOSC_ARGS,
+                      bloscpack_args=DEFAULT_BLOSCPACK_ARGS,
+                      metadata_args=DEFAULT_METADATA_ARGS,
+                      objective=None):
+    sio = cStringIO.StringIO()
+    sink = CompressedFPSink(sio)
+    pack_ndarray(ndarray, sink,
+                    chunk_size=chunk_size,
+                    blosc_args=blosc_args,
+                    bloscpack_args=bloscpack_args,
+                    metadata_args=metadata_args,
+                    objective=objective)
+    return sio.getvalue()
+
+def unpack_ndarray(source):
+    """ Deserialize a Numpy array.
+
+    Parameters
+    ----------
+    source : CompressedSource
+        the source containing the serialized Numpy array
+
+    Returns
+    -------
+    ndarray : ndarray
+        the Numpy array
+
+    Raises
+    ------
+    NotANumpyArray
+        if the source doesn't seem to contain a Numpy array
+    """
+
+    sink = PlainNumpySink(source.metadata)
+    for compressed in iter(source):
+        sink.put(compressed)
+    return sink.ndarray
 
 
 def unpack_ndarray_file(filename):
@@ -2080,10 +4289,9 @@ def _read_bloscpack_header(input_fp):
     """
     print_verbose('reading bloscpack header', level=DEBUG)
     bloscpack_header_raw = input_fp.read(BLOSCPACK_HEADER_LENGTH)
-    print_verbose('bloscpack_header_raw: %s' %
-            repr(bloscpack_header_raw), level=DEBUG)
+    print_debug('bloscpack_header_raw: %r', bloscpack_header_raw)
     bloscpack_header = BloscPackHeader.decode(bloscpack_header_raw)
-    print_verbose("bloscpack header: %s" % repr(bloscpack_header), level=DEBUG)
+    print_debug("bloscpack header: %r", bloscpack_header)
     if FORMAT_VERSION != bloscpack_header.format_version:
         raise FormatVersionMismatch(
                 "format version of file was not '%s' as expected, but '%d'" %
@@ -2172,11 +4380,10 @@ def _read_offsets(input_fp, bloscpack_header):
         total_entries = bloscpack_header.nchunks + \
                 bloscpack_header.max_app_chunks
         offsets_raw = input_fp.read(8 * total_entries)
-        print_verbose('Read raw offsets: %s' % repr(offsets_raw),
-                level=DEBUG)
+        print_debug('Read raw offsets: %r', offsets_raw)
         offsets = [decode_int64(offsets_raw[j - 8:j]) for j in
                 xrange(8, bloscpack_header.nchunks * 8 + 1, 8)]
-        print_verbose('Offsets: %s' % offsets, level=DEBUG)
+        print_debug('Offsets: %s', offsets)
         return offsets
     else:
         return []
@@ -2203,73 +4410,407 @@ def _read_beginning(input_fp):
             if bloscpack_header.metadata\
             else (None, None)
     offsets = _read_offsets(input_fp, bloscpack_header)
+    if bloscpack_header.merkle:
+        input_fp.seek(_merkle_section_length(bloscpack_header), 1)
     return bloscpack_header, metadata, metadata_header, offsets
 
 
 def _write_offsets(output_fp, offsets):
-    print_verbose("Writing '%d' offsets: '%s'" %
-            (len(offsets), repr(offsets)), level=DEBUG)
+    print_debug("Writing '%d' offsets: '%r'", len(offsets), offsets)
     # write the offsets encoded into the reserved space in the file
     encoded_offsets = "".join([encode_int64(i) for i in offsets])
-    print_verbose("Raw offsets: %s" % repr(encoded_offsets),
-            level=DEBUG)
+    print_debug("Raw offsets: %r", encoded_offsets)
     output_fp.write(encoded_offsets)
 
 
-def _read_compressed_chunk_fp(input_fp, checksum_impl):
-    """ Read a compressed chunk from a file pointer.
+def _offsets_position(bloscpack_header, metadata_header):
+    """ Compute the position of the offsets section in a file.
 
     Parameters
     ----------
-    input_fp : file like
-        the file pointer to read the chunk from
-    checksum_impl : Checksum
-        the checksum that has been used
+    bloscpack_header : BloscPackHeader
+        the header of the file
+    metadata_header : dict
+        the metadata header, None if there is no metadata
 
     Returns
     -------
-    compressed : str
-        the compressed data
-    blosc_header : dict
-        the blosc header from the chunk
+    position : int
+        the position of the offsets section, which is also the position of
+        the first chunk if there are no offsets
+
     """
-    # read blosc header
-    blosc_header_raw = input_fp.read(BLOSC_HEADER_LENGTH)
-    blosc_header = decode_blosc_header(blosc_header_raw)
-    if LEVEL == DEBUG:
-        print_debug('blosc_header: %s' % repr(blosc_header))
-    ctbytes = blosc_header['ctbytes']
-    # Seek back BLOSC_HEADER_LENGTH bytes in file relative to current
-    # position. Blosc needs the header too and presumably this is
-    # better than to read the whole buffer and then concatenate it...
-    input_fp.seek(-BLOSC_HEADER_LENGTH, 1)
-    # read chunk
-    compressed = input_fp.read(ctbytes)
-    if checksum_impl.size > 0:
-        # do checksum
-        expected_digest = input_fp.read(checksum_impl.size)
-        received_digest = checksum_impl(compressed)
-        if received_digest != expected_digest:
-            raise ChecksumMismatch(
-                    "Checksum mismatch detected in chunk, "
-                    "expected: '%s', received: '%s'" %
-                    (repr(expected_digest), repr(received_digest)))
-        else:
-            print_verbose('checksum OK (%s): %s ' %
-                    (checksum_impl.name, repr(received_digest)),
-                    level=DEBUG)
-    return compressed, blosc_header
+    return (BLOSCPACK_HEADER_LENGTH +
+            (METADATA_HEADER_LENGTH + metadata_header['max_meta_size'] +
+                CHECKSUMS_LOOKUP[metadata_header['meta_checksum']].size
+             if metadata_header is not None else 0))
 
 
-def unpack_file(in_file, out_file):
-    """ Main function for decompressing a file.
+def _merkle_capacity(bloscpack_header):
+    """ The number of leaves of the Merkle tree, a power of two.
+
+    The tree has space for all chunks including the ones that may be
+    appended.
+    """
+    total_entries = bloscpack_header.nchunks + bloscpack_header.max_app_chunks
+    capacity = 1
+    while capacity < total_entries:
+        capacity *= 2
+    return capacity
+
+
+def _merkle_section_length(bloscpack_header):
+    """ The length of the Merkle tree section in bytes. """
+    return (2 * _merkle_capacity(bloscpack_header) - 1) * \
+            bloscpack_header.checksum_impl.size
+
+
+def _merkle_position(bloscpack_header, metadata_header):
+    """ Compute the position of the Merkle tree section in a file. """
+    return _offsets_position(bloscpack_header, metadata_header) + \
+            8 * (bloscpack_header.nchunks + bloscpack_header.max_app_chunks)
+
+
+def _build_merkle_tree(leaves, capacity, checksum_impl):
+    """ Build a Merkle tree over a list of digests.
 
     Parameters
     ----------
-    in_file : str
-        the name of the input file
+    leaves : list of str
+        the digests of the chunks
+    capacity : int
+        the number of leaves in the tree, a power of two
+    checksum_impl : Checksum
+        the checksum used to combine the nodes
+
+    Returns
+    -------
+    nodes : list of str
+        the nodes of the tree in heap order, i.e. the root comes first and the
+        children of node 'i' are '2i + 1' and '2i + 2'
+
+    Notes
+    -----
+    Unused leaves are all null bytes. Subtrees consisting entirely of unused
+    leaves are not hashed more than once per level.
+
+    """
+    empty = '\x00' * checksum_impl.size
+    level = list(leaves) + [empty] * (capacity - len(leaves))
+    levels = [level]
+    while len(level) > 1:
+        empty_parent = checksum_impl(empty + empty)
+        level = [empty_parent if level[j] == level[j + 1] == empty
+                 else checksum_impl(level[j] + level[j + 1])
+                 for j in xrange(0, len(level), 2)]
+        empty = empty_parent
+        levels.append(level)
+    return list(itertools.chain(*reversed(levels)))
+
+
+def _write_merkle_tree(output_fp, bloscpack_header, digests):
+    """ Write a complete Merkle tree over the chunk digests. """
+    nodes = _build_merkle_tree(digests, _merkle_capacity(bloscpack_header),
+            bloscpack_header.checksum_impl)
+    print_debug("Merkle root (%s): %r", bloscpack_header.checksum, nodes[0])
+    output_fp.write(''.join(nodes))
+
+
+def _read_merkle_node(input_fp, position, bloscpack_header, i):
+    """ Read node 'i' of the Merkle tree section at 'position'. """
+    size = bloscpack_header.checksum_impl.size
+    input_fp.seek(position + i * size, 0)
+    return input_fp.read(size)
+
+
+def _update_merkle_tree(target_fp, position, bloscpack_header, digests):
+    """ Update the Merkle tree section in place for some changed chunks.
+
+    Parameters
+    ----------
+    target_fp : file like
+        the file pointer to update
+    position : int
+        the position of the Merkle tree section
+    bloscpack_header : BloscPackHeader
+        the header of the file
+    digests : dict mapping int -> str
+        the new digests of the changed chunks
+
+    Notes
+    -----
+    Only the paths from the changed leaves to the root are recomputed, which
+    requires reading one sibling per level and changed chunk.
+
+    """
+    if not digests:
+        return
+    checksum_impl = bloscpack_header.checksum_impl
+    capacity = _merkle_capacity(bloscpack_header)
+    nodes = {}
+
+    def node(i):
+        if i not in nodes:
+            nodes[i] = _read_merkle_node(target_fp, position,
+                    bloscpack_header, i)
+        return nodes[i]
+    dirty = set()
+    for index, digest in digests.iteritems():
+        nodes[capacity - 1 + index] = digest
+        dirty.add(capacity - 1 + index)
+    changed = set(dirty)
+    while dirty != set([0]):
+        dirty = set((i - 1) // 2 for i in dirty)
+        for i in dirty:
+            nodes[i] = checksum_impl(node(2 * i + 1) + node(2 * i + 2))
+        changed.update(dirty)
+    print_verbose("updating '%d' nodes of the Merkle tree" % len(changed),
+            level=DEBUG)
+    for i in sorted(changed):
+        target_fp.seek(position + i * checksum_impl.size, 0)
+        target_fp.write(nodes[i])
+
+
+def _rewrite_chunk(target_fp, bloscpack_header, merkle_position, offset,
+        index, compressed):
+    """ Write a compressed chunk over chunk 'index' in place.
+
+    Parameters
+    ----------
+    target_fp : file like
+        the file pointer to update
+    bloscpack_header : BloscPackHeader
+        the header of the file
+    merkle_position : int
+        the position of the Merkle tree section, ignored without a tree
+    offset : int
+        the position to write the chunk to
+    index : int
+        the index of the chunk
+    compressed : str
+        the compressed chunk
+
+    Returns
+    -------
+    digest : str
+        the digest of the chunk
+
+    Notes
+    -----
+    The chunk must fit where it is written, which the caller ensures. If the
+    file has a Merkle tree, the path from the chunk to the root is updated.
+    The file pointer is left after the chunk and its digest.
+
+    """
+    with _stage('checksum'):
+        digest = bloscpack_header.checksum_impl(compressed)
+    if bloscpack_header.merkle:
+        _update_merkle_tree(target_fp, merkle_position, bloscpack_header,
+                {index: digest})
+    target_fp.seek(offset, 0)
+    _write_compressed_chunk(target_fp, compressed, digest)
+    return digest
+
+
+def _read_compressed_chunk_fp(input_fp, checksum_impl):
+    """ Read a compressed chunk from a file pointer.
+
+    Parameters
+    ----------
+    input_fp : file like
+        the file pointer to read the chunk from
+    checksum_impl : Checksum
+        the checksum that has been used
+
+    Returns
+    -------
+    compressed : str
+        the compressed data
+    blosc_header : dict
+        the blosc header from the chunk
+    """
+    # read blosc header
+    blosc_header_raw = input_fp.read(BLOSC_HEADER_LENGTH)
+    blosc_header = decode_blosc_header(blosc_header_raw)
+    print_debug('blosc_header: %r', blosc_header)
+    ctbytes = blosc_header['ctbytes']
+    # Seek back BLOSC_HEADER_LENGTH bytes in file relative to current
+    # position. Blosc needs the header too and presumably this is
+    # better than to read the whole buffer and then concatenate it...
+    input_fp.seek(-BLOSC_HEADER_LENGTH, 1)
+    # read chunk
+    compressed = input_fp.read(ctbytes)
+    if checksum_impl.size > 0:
+        _check_digest(compressed, input_fp.read(checksum_impl.size),
+                checksum_impl)
+    return compressed, blosc_header
+
+
+def _check_digest(compressed, expected_digest, checksum_impl):
+    """ Compare the checksum of a chunk to the expected digest.
+
+    Raises
+    ------
+    ChecksumMismatch
+        if the digests differ
+
+    """
+    with _stage('checksum'):
+        received_digest = checksum_impl(compressed)
+    if received_digest != expected_digest:
+        raise ChecksumMismatch(
+                "Checksum mismatch detected in chunk, "
+                "expected: '%s', received: '%s'" %
+                (repr(expected_digest), repr(received_digest)))
+    else:
+        print_debug('checksum OK (%s): %r ', checksum_impl.name,
+                received_digest)
+
+
+def _unwrap_chunk(raw, checksum_impl):
+    """ Split the checksum off a raw chunk as stored in the file.
+
+    Parameters
+    ----------
+    raw : str
+        the compressed chunk followed by its checksum
+    checksum_impl : Checksum
+        the checksum that has been used
+
+    Returns
+    -------
+    compressed : str
+        the compressed chunk
+
+    Raises
+    ------
+    ChecksumMismatch
+        if the checksum does not match
+
+    """
+    size = checksum_impl.size
+    if size == 0:
+        return raw
+    compressed = raw[:-size]
+    _check_digest(compressed, raw[-size:], checksum_impl)
+    return compressed
+
+
+def _load_posix_fadvise():
+    """ Find an implementation of posix_fadvise, None if there is none. """
+    if hasattr(os, 'posix_fadvise'):
+        return os.posix_fadvise
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc_fadvise = libc.posix_fadvise64
+    except (OSError, AttributeError):  # pragma: no cover
+        return None
+    libc_fadvise.argtypes = [ctypes.c_int, ctypes.c_longlong,
+                             ctypes.c_longlong, ctypes.c_int]
+
+    def posix_fadvise(fd, offset, length, advice):
+        # returns the error number instead of setting errno
+        result = libc_fadvise(fd, offset, length, advice)
+        if result != 0:
+            raise OSError(result, os.strerror(result))
+    return posix_fadvise
+
+_posix_fadvise = _load_posix_fadvise()
+
+
+def _fadvise(fp, offset, length, advice):
+    """ Give the kernel advice about the access pattern of a file.
+
+    Parameters
+    ----------
+    fp : file like
+        the file, advice is silently skipped if it has no file descriptor
+    offset : int
+        the start of the range
+    length : int
+        the length of the range, zero means until the end of the file
+    advice : int
+        one of the 'POSIX_FADV_*' constants
+
+    Returns
+    -------
+    advised : bool
+        if the advice was given
+
+    """
+    if _posix_fadvise is None or not hasattr(fp, 'fileno'):
+        return False
+    print_debug("fadvise '%d' for '%d' bytes at '%d'", advice, length, offset)
+    _posix_fadvise(fp.fileno(), offset, length, advice)
+    return True
+
+
+def _load_posix_fallocate():
+    """ Find an implementation of posix_fallocate, None if there is none.
+    """
+    if hasattr(os, 'posix_fallocate'):
+        return os.posix_fallocate
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc_fallocate = libc.posix_fallocate64
+    except (OSError, AttributeError):  # pragma: no cover
+        return None
+    libc_fallocate.argtypes = [ctypes.c_int, ctypes.c_longlong,
+                               ctypes.c_longlong]
+
+    def posix_fallocate(fd, offset, length):
+        # returns the error number instead of setting errno
+        result = libc_fallocate(fd, offset, length)
+        if result != 0:
+            raise OSError(result, os.strerror(result))
+    return posix_fallocate
+
+_posix_fallocate = _load_posix_fallocate()
+
+
+def _preallocate(output_fp, nbytes, sparse=False):
+    """ Give a file its final size before writing to it.
+
+    The blocks are reserved too if posix_fallocate is available, unless the
+    file should remain sparse.
+    """
+    output_fp.truncate(nbytes)
+    if not sparse and nbytes > 0 and _posix_fallocate is not None:
+        _posix_fallocate(output_fp.fileno(), 0, nbytes)
+    print_verbose('preallocated output of %s' % pretty_size(nbytes),
+            level=DEBUG)
+
+
+def unpack_file(in_file, out_file, sparse=False, nthreads=1, readahead=None,
+        memory_budget=None, stats=None, observer=None):
+    """ Main function for decompressing a file.
+
+    Parameters
+    ----------
+    in_file : str or Storage
+        the name or URL of the input file or the storage to read from
     out_file : str
         the name of the output file
+    sparse : bool
+        if chunks of null bytes should be skipped, leaving holes in the
+        output file on filesystems that support sparse files
+    nthreads : int
+        the number of threads decompressing chunks in parallel
+    readahead : int or None
+        if given, the number of bytes of the input to read ahead, while
+        dropping the chunks that have been read from the page cache
+    memory_budget : MemoryBudget or None
+        if given, the compressed chunks are read ahead in a background thread,
+        and together with those buffered for parallel decompression, limited
+        by it
+    stats : PipelineStats or None
+        if given, accumulates the time spent in each stage
+    observer : ChunkObserver or None
+        if given, receives an event for every chunk
 
     Returns
     -------
@@ -2284,23 +4825,95 @@ def unpack_file(in_file, out_file):
     ChecksumMismatch
         if any of the chunks fail to produce the correct checksum
     """
-    in_file_size = path.getsize(in_file)
-    print_verbose('input file size: %s' % pretty_size(in_file_size))
-    with open_two_file(open(in_file, 'rb'), open(out_file, 'wb')) as \
-            (input_fp, output_fp):
-        source = CompressedFPSource(input_fp)
-        sink = PlainFPSink(output_fp, source.nchunks)
-        metadata = unpack(source, sink)
+    stats = _pipeline_stats(stats, observer)
+    in_storage = open_storage(in_file)
+    try:
+        in_file_size = in_storage.size()
+        print_verbose('input file size: %s' % pretty_size(in_file_size))
+        with open_two_file(in_storage.open_read(), open(out_file, 'w+b')) as \
+                (input_fp, output_fp):
+            with stats.stage('metadata'):
+                source = CompressedFPSource(input_fp, readahead=readahead)
+            bloscpack_header = source.bloscpack_header
+            nbytes = None
+            if -1 not in (bloscpack_header.chunk_size,
+                    bloscpack_header.nchunks, bloscpack_header.last_chunk):
+                nbytes = (bloscpack_header.chunk_size *
+                          (bloscpack_header.nchunks - 1) +
+                          bloscpack_header.last_chunk)
+                _preallocate(output_fp, nbytes, sparse=sparse)
+            if nthreads > 1 and nbytes:
+                sink = PlainParallelFPSink(output_fp,
+                        bloscpack_header.chunk_size, nthreads, sparse=sparse,
+                        memory_budget=memory_budget)
+            else:
+                sink = PlainFPSink(output_fp, source.nchunks, sparse=sparse)
+            metadata = unpack(source, sink,
+                    max_inflight=DEFAULT_MAX_INFLIGHT
+                    if memory_budget is not None else 0,
+                    memory_budget=memory_budget,
+                    stats=stats, observer=observer)
+    finally:
+        # storages given by the caller are left open
+        if in_storage is not in_file:
+            in_storage.close()
     out_file_size = path.getsize(out_file)
     print_verbose('output file size: %s' % pretty_size(out_file_size))
     print_verbose('decompression ratio: %f' % (out_file_size / in_file_size))
     return metadata
 
 
-def unpack(source, sink):
+def unpack(source, sink, max_inflight=0, memory_budget=None, stats=None,
+        observer=None):
+    """ Core unpacking function.
+
+    If 'max_inflight' is non-zero, up to that many compressed chunks, and if
+    given, no more than the 'memory_budget', are read ahead from the source
+    in a background thread, while the calling thread decompresses and writes.
+    A sink with the same 'memory_budget' takes over the bytes of the chunks
+    read ahead, so that they are counted once.
+    If given, the time spent in each stage is accumulated in the
+    'PipelineStats' 'stats' and the 'ChunkObserver' 'observer' receives an
+    event for every chunk. Sinks decompressing in parallel report no codec
+    time per chunk.
+    """
+    stats = _pipeline_stats(stats, observer)
+    compressed_chunks = stats.timed('read', source)
+    # the sink releasing the bytes of the chunks read ahead, and not acquiring
+    # them again, avoids a deadlock when both wait for the budget
+    handoff = bool(max_inflight) and memory_budget is not None and \
+            getattr(sink, 'memory_budget', None) is memory_budget
+
+    def flush():
+        with stats.stage('write'):
+            sink.flush()
+    if max_inflight:
+        compressed_chunks = _prefetch(compressed_chunks, max_inflight,
+                memory_budget=memory_budget, size=lambda item: len(item[1]),
+                handoff=handoff, idle=flush if handoff else None)
     # read, decompress, write loop
-    for compressed in iter(source):
-        sink.put(compressed)
+    try:
+        for i, (read_frame, compressed) in enumerate(compressed_chunks):
+            with stats.stage('write') as frame:
+                if handoff:
+                    sink.put(compressed, reserved=True)
+                else:
+                    sink.put(compressed)
+            if observer is not None:
+                observer.chunk(ChunkEvent('unpack', i,
+                    _chunk_nbytes(compressed), len(compressed),
+                    read_frame.wall, frame.nested.get('decompress', 0.0),
+                    frame.wall, read_frame.nested.get('checksum', 0.0)))
+    finally:
+        # release any resources held by the sink, even on errors
+        with stats.stage('finalize'):
+            sink.finalize()
+    if observer is not None:
+        observer.finish('unpack')
+    if memory_budget is not None:
+        print_verbose('peak buffered: %s' %
+                double_pretty_size(memory_budget.peak))
+    print_verbose('time in stages (wall/cpu): %s' % stats.summary())
     return source.metadata
 
 
@@ -2428,7 +5041,8 @@ def _recreate_metadata(old_metadata_header, new_metadata,
     return metadata_args
 
 
-def append_fp(original_fp, new_content_fp, new_size, blosc_args=None):
+def append_fp(original_fp, new_content_fp, new_size, blosc_args=None,
+        observer=None):
     """ Append from a file pointer to a file pointer.
 
     Parameters
@@ -2441,6 +5055,9 @@ def append_fp(original_fp, new_content_fp, new_size, blosc_args=None):
         the size of the new_content
     blosc_args : dict
         the blosc_args
+    observer : ChunkObserver or None
+        if given, receives an event for every chunk written, including the
+        rewritten last chunk
 
     Returns
     -------
@@ -2477,28 +5094,53 @@ def append_fp(original_fp, new_content_fp, new_size, blosc_args=None):
     if blosc_args['cname'] is None:
         blosc_args['cname'] = DEFAULT_CNAME
     _check_blosc_args(blosc_args)
-    offsets_pos = (BLOSCPACK_HEADER_LENGTH +
-                  (METADATA_HEADER_LENGTH + metadata_header['max_meta_size'] +
-                      CHECKSUMS_LOOKUP[metadata_header['meta_checksum']].size
-                   if metadata is not None else 0))
+    offsets_pos = _offsets_position(bloscpack_header, metadata_header)
+    merkle_pos = _merkle_position(bloscpack_header, metadata_header)
+    stats = _pipeline_stats(observer=observer)
     # seek to the final offset
     original_fp.seek(offsets[-1], 0)
     # decompress the last chunk
-    compressed, blosc_header = _read_compressed_chunk_fp(original_fp, checksum_impl)
-    decompressed = blosc.decompress(compressed)
+    with stats.stage('read') as last_read_frame:
+        compressed, blosc_header = _read_compressed_chunk_fp(original_fp,
+                checksum_impl)
+    with stats.stage('decompress') as decompress_frame:
+        decompressed = _decompress_chunk_str(compressed)
+    if offsets.count(offsets[-1]) > 1:
+        # the last chunk is shared, so it may not be overwritten, instead the
+        # rebuilt last chunk goes to the end of the file
+        original_fp.seek(0, 2)
+        offsets[-1] = original_fp.tell()
+        print_verbose('last chunk is shared, moving it to the end',
+                level=DEBUG)
+
+    def rewrite_last_chunk(fill_up_size):
+        # write the chunk that has been filled up over the original last chunk
+        with stats.stage('read') as read_frame:
+            fill_up = new_content_fp.read(fill_up_size)
+        with stats.stage('compress') as compress_frame:
+            compressed = _compress_chunk_str(decompressed + fill_up,
+                    blosc_args)
+        with stats.stage('write') as frame:
+            _rewrite_chunk(original_fp, bloscpack_header, merkle_pos,
+                    offsets[-1], bloscpack_header.nchunks - 1, compressed)
+        if observer is not None:
+            observer.chunk(ChunkEvent('append', bloscpack_header.nchunks - 1,
+                len(decompressed) + len(fill_up), len(compressed),
+                last_read_frame.wall + read_frame.wall,
+                decompress_frame.wall + compress_frame.wall, frame.wall,
+                last_read_frame.nested.get('checksum', 0.0) +
+                frame.nested.get('checksum', 0.0)))
+
     # figure out how many bytes we need to read to rebuild the last chunk
     ultimo_length = len(decompressed)
     bytes_to_read = bloscpack_header.chunk_size - ultimo_length
     if new_size <= bytes_to_read:
         # special case
         # must squeeze data into last chunk
-        fill_up = new_content_fp.read(new_size)
-        # seek back to the position of the original last chunk
-        original_fp.seek(offsets[-1], 0)
-        # write the chunk that has been filled up
-        compressed = _compress_chunk_str(decompressed + fill_up, blosc_args)
-        digest = checksum_impl(compressed)
-        _write_compressed_chunk(original_fp, compressed, digest)
+        rewrite_last_chunk(new_size)
+        if bloscpack_header.dedup:
+            original_fp.seek(offsets_pos)
+            _write_offsets(original_fp, offsets)
         # return 0 to indicate that no new chunks have been written
         # build the new header
         bloscpack_header.last_chunk += new_size
@@ -2506,12 +5148,12 @@ def append_fp(original_fp, new_content_fp, new_size, blosc_args=None):
         raw_bloscpack_header = bloscpack_header.encode()
         original_fp.seek(0)
         original_fp.write(raw_bloscpack_header)
+        if observer is not None:
+            observer.finish('append')
         return 0
 
     # figure out what is left over
     new_new_size = new_size - bytes_to_read
-    # read those bytes
-    fill_up = new_content_fp.read(bytes_to_read)
     # figure out how many chunks we will need
     nchunks, chunk_size, last_chunk_size = \
             calculate_nchunks(new_new_size,
@@ -2519,30 +5161,39 @@ def append_fp(original_fp, new_content_fp, new_size, blosc_args=None):
     # make sure that we actually have that kind of space
     if nchunks > bloscpack_header.max_app_chunks:
         raise NotEnoughSpace('not enough space')
-    # seek back to the position of the original last chunk
-    original_fp.seek(offsets[-1], 0)
-    # write the chunk that has been filled up
-    compressed = _compress_chunk_str(decompressed + fill_up, blosc_args)
-    digest = checksum_impl(compressed)
-    _write_compressed_chunk(original_fp, compressed, digest)
+    # fill up the last chunk with the bytes read first
+    rewrite_last_chunk(bytes_to_read)
     # append to the original file, again original_fp should be adequately
     # positioned
     sink = CompressedFPSink(original_fp)
     sink.configure(blosc_args, bloscpack_header)
     # allocate new offsets
     sink.offset_storage = list(itertools.repeat(-1, nchunks))
+    sink.digest_storage = [None] * nchunks
     # read from the new input file, new_content_fp should be adequately
     # positioned
     source = PlainFPSource(new_content_fp)
     source.configure(chunk_size, last_chunk_size, nchunks)
     # read, compress, write loop
-    for i, chunk in enumerate(source()):
-        print_verbose("Handle chunk '%d' %s" % (i,'(last)' if i == nchunks -1
-            else ''), level=DEBUG)
-
-        compressed = _compress_chunk_str(chunk, blosc_args)
-        sink.put(i, compressed)
-
+    for i, (read_frame, chunk) in enumerate(stats.timed('read', source())):
+        print_debug("Handle chunk '%d' %s", i,
+                '(last)' if i == nchunks - 1 else '')
+
+        with stats.stage('compress') as compress_frame:
+            compressed = _compress_chunk_str(chunk, blosc_args)
+        with stats.stage('write') as frame:
+            sink.put(i, compressed)
+        if observer is not None:
+            observer.chunk(ChunkEvent('append', bloscpack_header.nchunks + i,
+                len(chunk), len(compressed), read_frame.wall,
+                compress_frame.wall, frame.wall,
+                frame.nested.get('checksum', 0.0)))
+
+    if bloscpack_header.merkle:
+        digests = dict(enumerate(sink.digest_storage,
+                                 bloscpack_header.nchunks))
+        _update_merkle_tree(original_fp, merkle_pos, bloscpack_header,
+                digests)
     # build the new header
     bloscpack_header.last_chunk = last_chunk_size
     bloscpack_header.nchunks += nchunks
@@ -2555,10 +5206,12 @@ def append_fp(original_fp, new_content_fp, new_size, blosc_args=None):
     original_fp.seek(offsets_pos)
     # FIXME: write only those that changed
     _write_offsets(sink.output_fp, offsets + sink.offset_storage)
+    if observer is not None:
+        observer.finish('append')
     return nchunks
 
 
-def append(orig_file, new_file, blosc_args=None):
+def append(orig_file, new_file, blosc_args=None, observer=None):
     """ Append from a file pointer to a file pointer.
 
     Parameters
@@ -2569,6 +5222,9 @@ def append(orig_file, new_file, blosc_args=None):
         the name of the file to append from
     blosc_args : dict
         the blosc_args
+    observer : ChunkObserver or None
+        if given, receives an event for every chunk written, including the
+        rewritten last chunk
 
     Notes
     -----
@@ -2583,107 +5239,1384 @@ def append(orig_file, new_file, blosc_args=None):
 
     with open_two_file(open(orig_file, 'r+b'), open(new_file, 'rb')) as \
             (orig_fp, new_fp):
-        append_fp(orig_fp, new_fp, new_size, blosc_args)
+        append_fp(orig_fp, new_fp, new_size, blosc_args, observer=observer)
     orig_size_after = path.getsize(orig_file)
     print_verbose('orig file size after append: %s' %
             double_pretty_size(orig_size_after))
     print_verbose('Approximate compression ratio of appended data: %f' %
             ((orig_size_after-orig_size_before)/new_size))
 
-if __name__ == '__main__':
-    parser = create_parser()
-    PREFIX = parser.prog
-    args = parser.parse_args()
-    if args.verbose:
-        LEVEL = VERBOSE
-    elif args.debug:
-        LEVEL = DEBUG
-    print_verbose('command line argument parsing complete', level=DEBUG)
-    print_verbose('command line arguments are: ', level=DEBUG)
-    for arg, val in vars(args).iteritems():
-        print_verbose('\t%s: %s' % (arg, str(val)), level=DEBUG)
-    process_nthread_arg(args)
+def _read_chunk_extents(input_fp, bloscpack_header, offsets):
+    """ Determine the position and length of every chunk in a file pointer.
 
-    # compression and decompression handled via subparsers
-    if args.subcommand in ['compress', 'c']:
-        print_verbose('getting ready for compression')
-        in_file, out_file, blosc_args = process_compression_args(args)
-        try:
-            check_files(in_file, out_file, args)
-        except FileNotFound as fnf:
-            error(str(fnf))
-        metadata = process_metadata_args(args)
-        bloscpack_args = DEFAULT_BLOSCPACK_ARGS.copy()
-        bloscpack_args['offsets'] = args.offsets
-        bloscpack_args['checksum'] = args.checksum
-        try:
-            pack_file(in_file, out_file, chunk_size=args.chunk_size,
-                    metadata=metadata,
-                    blosc_args=blosc_args,
-                    bloscpack_args=bloscpack_args,
-                    metadata_args=DEFAULT_METADATA_ARGS)
-        except ChunkingException as ce:
-            error(str(ce))
-    elif args.subcommand in ['decompress', 'd']:
-        print_verbose('getting ready for decompression')
-        in_file, out_file = process_decompression_args(args)
-        try:
-            check_files(in_file, out_file, args)
-        except FileNotFound as fnf:
-            error(str(fnf))
-        try:
-            metadata = unpack_file(in_file, out_file)
-            if metadata:
-                print_verbose("Metadata is:\n'%s'" % metadata, level=NORMAL)
-        except FormatVersionMismatch as fvm:
-            error(fvm.message)
-        except ChecksumMismatch as csm:
-            error(csm.message)
-    elif args.subcommand in ['append', 'a']:
-        print_verbose('getting ready for append')
-        original_file, new_file = process_append_args(args)
-        try:
-            if not path.exists(original_file):
-                raise FileNotFound("original file '%s' does not exist!" %
-                        original_file)
-            if not path.exists(new_file):
-                raise FileNotFound("new file '%s' does not exist!" %
-                        new_file)
-        except FileNotFound as fnf:
-            error(str(fnf))
-        print_verbose("original file is: '%s'" % original_file)
-        print_verbose("new file is: '%s'" % new_file)
-        blosc_args = _blosc_args_from_args(args)
-        metadata = process_metadata_args(args)
-        append(original_file, new_file, blosc_args=blosc_args)
-        if metadata is not None:
-            with open(original_file, 'r+b') as fp:
-                _seek_to_metadata(fp)
-                _rewrite_metadata_fp(fp, metadata)
-    elif args.subcommand in ('info', 'i'):
-        try:
-            if not path.exists(args.file_):
-                raise FileNotFound("file '%s' does not exist!" %
-                        args.file_)
-        except FileNotFound as fnf:
-            error(str(fnf))
-        try:
-            with open(args.file_) as fp:
-                bloscpack_header, metadata, metadata_header, offsets = \
-                        _read_beginning(fp)
-        except ValueError as ve:
-            error(str(ve) + "\n" +
-            "This might not be a bloscpack compressed file.")
-        print_normal(bloscpack_header.pformat())
-        if metadata is not None:
-            print_normal("'metadata':")
-            print_normal(pprint.pformat(metadata, indent=4))
-            print_normal("'metadata_header':")
-            print_normal(pprint.pformat(metadata_header, indent=4))
-        if offsets:
-            print_normal("'offsets':")
-            print_normal("[%s,...]" % (",".join(str(o) for o in offsets[:5])))
+    Parameters
+    ----------
+    input_fp : file like
+        the file pointer to read from
+    bloscpack_header : BloscPackHeader
+        the header of the file
+    offsets : list of int
+        the offsets, may be empty
+
+    Returns
+    -------
+    extents : list of (int, int) tuples
+        the position and the length of each chunk, the length includes the
+        checksum following the chunk
+
+    Notes
+    -----
+    If there are no offsets, the 'input_fp' should point to the position where
+    the first chunk starts and all Blosc headers will be read. Otherwise the
+    lengths are derived from the offsets and only the last Blosc header is
+    read. If chunks may be shared, the Blosc header at every distinct offset
+    is read.
+
+    """
+    checksum_size = bloscpack_header.checksum_impl.size
+    nchunks = bloscpack_header.nchunks
+    if bloscpack_header.dedup:
+        lengths = {}
+        for position in offsets:
+            if position not in lengths:
+                input_fp.seek(position, 0)
+                lengths[position] = decode_blosc_header(
+                        input_fp.read(BLOSC_HEADER_LENGTH))['ctbytes'] + \
+                        checksum_size
+        extents = [(position, lengths[position]) for position in offsets]
+    elif offsets:
+        extents = [(offsets[i], offsets[i + 1] - offsets[i])
+                   for i in xrange(nchunks - 1)]
+        positions = [offsets[-1]]
+    else:
+        extents = []
+        positions = [input_fp.tell()]
+    while len(extents) < nchunks:
+        input_fp.seek(positions[-1], 0)
+        blosc_header = decode_blosc_header(
+                input_fp.read(BLOSC_HEADER_LENGTH))
+        length = blosc_header['ctbytes'] + checksum_size
+        extents.append((positions[-1], length))
+        positions.append(positions[-1] + length)
+    print_debug('chunk extents: %r', extents)
+    return extents
+
+
+def _copy_range(input_fp, output_fp, start, length,
+        buffer_size=COPY_BUFFER_SIZE):
+    """ Copy a range of bytes verbatim from one file pointer to another.
+
+    Parameters
+    ----------
+    input_fp : file like
+        the file pointer to copy from
+    output_fp : file like
+        the file pointer to copy to, at its current position
+    start : int
+        the position in 'input_fp' to start copying from
+    length : int
+        the number of bytes to copy
+    buffer_size : int
+        the size of the blocks used for copying
+
+    Raises
+    ------
+    EOFError
+        if 'input_fp' ends before 'length' bytes could be copied
+
+    """
+    input_fp.seek(start, 0)
+    while length > 0:
+        block = input_fp.read(min(buffer_size, length))
+        if not block:
+            raise EOFError('unexpected end of file while copying chunks')
+        output_fp.write(block)
+        length -= len(block)
+
+
+def _copy_chunks(input_fp, sink, extents, i):
+    """ Copy chunks verbatim to a sink and record their offsets.
+
+    Parameters
+    ----------
+    input_fp : file like
+        the file pointer to copy from
+    sink : CompressedFPSink
+        the sink to copy to, positioned where the chunks should go
+    extents : list of (int, int) tuples
+        the position and length of the chunks to copy
+    i : int
+        the index of the first copied chunk in the sink
+
+    Returns
+    -------
+    i : int
+        the index of the next chunk in the sink
 
+    Notes
+    -----
+    Runs of contiguous chunks are copied as a single block. Chunks shared by
+    several offsets in the input are copied once for each offset.
+
+    """
+    runs = [[extents[0]]]
+    for position, length in extents[1:]:
+        if position == runs[-1][-1][0] + runs[-1][-1][1]:
+            runs[-1].append((position, length))
+        else:
+            runs.append([(position, length)])
+    for run in runs:
+        start = run[0][0]
+        end = run[-1][0] + run[-1][1]
+        output_start = sink.output_fp.tell()
+        if LEVEL == DEBUG:
+            print_debug("copying '%d' chunks (%s) verbatim", len(run),
+                    double_pretty_size(end - start))
+        _copy_range(input_fp, sink.output_fp, start, end - start)
+        if sink.merkle:
+            checksum_size = sink.checksum_impl.size
+            for j, (position, length) in enumerate(run, i):
+                input_fp.seek(position + length - checksum_size, 0)
+                sink.digest_storage[j] = input_fp.read(checksum_size)
+        if sink.offsets:
+            for j, (position, _) in enumerate(run, i):
+                sink.offset_storage[j] = output_start + position - start
+        i += len(run)
+    return i
+
+
+def _rechunk(pieces, chunk_size):
+    """ Regroup a sequence of strings into strings of 'chunk_size' bytes.
+
+    The last string yielded may be shorter than 'chunk_size'.
+    """
+    buffered, nbuffered = [], 0
+    for piece in pieces:
+        buffered.append(piece)
+        nbuffered += len(piece)
+        while nbuffered >= chunk_size:
+            joined = ''.join(buffered)
+            yield joined[:chunk_size]
+            buffered, nbuffered = [joined[chunk_size:]], nbuffered - chunk_size
+    if nbuffered > 0:
+        yield ''.join(buffered)
+
+
+def _merge_ndarray_metadata(metadatas):
+    """ Merge the Numpy metadata of several files along axis 0.
+
+    Parameters
+    ----------
+    metadatas : list of dict
+        the Numpy metadata of each file
+
+    Returns
+    -------
+    metadata : dict
+        the metadata for the concatenated array
+
+    Raises
+    ------
+    IncompatibleFiles
+        if the arrays differ in dtype, order or trailing dimensions or can not
+        be concatenated along axis 0
+
+    """
+    first = metadatas[0]
+    for metadata in metadatas[1:]:
+        for key in ('dtype', 'order'):
+            if metadata[key] != first[key]:
+                raise IncompatibleFiles(
+                        "can not concatenate arrays with different '%s': "
+                        "'%s' and '%s'" % (key, first[key], metadata[key]))
+        if list(metadata['shape'][1:]) != list(first['shape'][1:]):
+            raise IncompatibleFiles(
+                    "can not concatenate arrays with shapes '%s' and '%s' "
+                    "along axis 0" % (first['shape'], metadata['shape']))
+    if len(first['shape']) == 0:
+        raise IncompatibleFiles('can not concatenate zero-dimensional arrays')
+    if first['order'] == 'F' and len(first['shape']) > 1:
+        raise IncompatibleFiles(
+                'can not concatenate Fortran ordered arrays along axis 0')
+    metadata = dict(first)
+    metadata['shape'] = [sum(m['shape'][0] for m in metadatas)] + \
+            list(first['shape'][1:])
+    return metadata
+
+
+def concat_fp(input_fps, output_fp,
+        blosc_args=DEFAULT_BLOSC_ARGS,
+        bloscpack_args=None,
+        metadata_args=DEFAULT_METADATA_ARGS):
+    """ Concatenate several compressed file pointers into one.
+
+    Parameters
+    ----------
+    input_fps : list of file like
+        the file pointers to concatenate, in order
+    output_fp : file like
+        the file pointer to write the concatenation to
+    blosc_args : dict
+        the blosc args used for chunks that need to be recompressed
+    bloscpack_args : dict
+        the bloscpack args for the output, None means use the defaults
+    metadata_args : dict
+        the metadata args for the output
+
+    Returns
+    -------
+    nchunks_copied : int
+        the number of chunks that were copied without recompression
+
+    Raises
+    ------
+    IncompatibleFiles
+        if the inputs do not share chunk-size, typesize and checksum, or have
+        incompatible metadata
+
+    Notes
+    -----
+    As long as all preceding inputs end on a full chunk, the compressed chunks
+    (including their checksums) are copied verbatim using large block copies.
+    Since all chunks but the last must have the same size, the first short
+    last chunk of an input that is not the final one forces all remaining
+    data to be decompressed and re-chunked, using 'blosc_args'.
+
+    If all inputs contain Numpy metadata, it is merged along axis 0.
+    Otherwise the metadata of the first input is used.
+
+    The 'typesize' value of 'blosc_args' and the 'checksum' value of
+    'bloscpack_args' will be silently ignored and replaced with the values
+    shared by the inputs.
+
+    """
+    inputs = []
+    for input_fp in input_fps:
+        bloscpack_header, metadata, metadata_header, offsets = \
+                _read_beginning(input_fp)
+        if bloscpack_header.nchunks == -1 or \
+                bloscpack_header.chunk_size == -1:
+            raise IncompatibleFiles(
+                    'can not concatenate files with an unknown number '
+                    'of chunks or chunk-size')
+        inputs.append((input_fp, bloscpack_header, metadata, offsets))
+    first_header = inputs[0][1]
+    for key in ('chunk_size', 'typesize', 'checksum'):
+        values = set(i[1][key] for i in inputs)
+        if len(values) != 1:
+            raise IncompatibleFiles(
+                    "can not concatenate files with different '%s': %s" %
+                    (key, sorted(values)))
+    chunk_size = first_header.chunk_size
+    metadatas = [i[2] for i in inputs]
+    ndarray_metadatas = [m for m in metadatas
+                         if isinstance(m, dict) and m.get('container') == 'numpy']
+    if len(ndarray_metadatas) == len(metadatas):
+        metadata = _merge_ndarray_metadata(ndarray_metadatas)
+    elif ndarray_metadatas:
+        raise IncompatibleFiles(
+                'can not concatenate files with and without Numpy metadata')
+    else:
+        metadata = metadatas[0]
+    total_size = sum(h.chunk_size * (h.nchunks - 1) + h.last_chunk
+                     for _, h, _, _ in inputs)
+    print_verbose('total size of concatenated data: %s' %
+            double_pretty_size(total_size))
+    nchunks, chunk_size, last_chunk_size = \
+            calculate_nchunks(total_size, chunk_size)
+
+    blosc_args = blosc_args.copy()
+    blosc_args['typesize'] = first_header.typesize
+    _check_blosc_args(blosc_args)
+    bloscpack_args = _complete_bloscpack_args(DEFAULT_BLOSCPACK_ARGS
+            if bloscpack_args is None else bloscpack_args)
+    bloscpack_args['checksum'] = first_header.checksum
+    # constant chunk markers are copied verbatim
+    bloscpack_args['constant'] = bloscpack_args['constant'] or \
+            any(h.constant for _, h, _, _ in inputs)
+    _check_bloscpack_args(bloscpack_args)
+    sink = CompressedFPSink(output_fp)
+    _write_beginning(sink, nchunks, chunk_size, last_chunk_size,
+            metadata=metadata,
+            blosc_args=blosc_args,
+            bloscpack_args=bloscpack_args,
+            metadata_args=metadata_args)
+
+    # copy verbatim as long as the chunk boundaries line up
+    i, remainder = 0, []
+    for k, (input_fp, header, _, offsets) in enumerate(inputs):
+        extents = _read_chunk_extents(input_fp, header, offsets)
+        if remainder:
+            remainder.append((input_fp, header, extents))
+            continue
+        verbatim = header.nchunks
+        if header.last_chunk != chunk_size and k != len(inputs) - 1:
+            verbatim -= 1
+            remainder.append((input_fp, header, extents[verbatim:]))
+        if verbatim > 0:
+            i = _copy_chunks(input_fp, sink, extents[:verbatim], i)
+    nchunks_copied = i
+
+    # re-chunk whatever is left
+    def decompressed():
+        for input_fp, header, extents in remainder:
+            for position, _ in extents:
+                input_fp.seek(position, 0)
+                compressed, _ = _read_compressed_chunk_fp(input_fp,
+                        header.checksum_impl)
+                yield _decompress_chunk_str(compressed)
+    for chunk in _rechunk(decompressed(), chunk_size):
+        print_debug("recompressing chunk '%d'", i)
+        sink.put(i, _compress_chunk_str(chunk, blosc_args))
+        i += 1
+    sink.finalize()
+    print_verbose("copied '%d' of '%d' chunks without recompression" %
+            (nchunks_copied, nchunks))
+    return nchunks_copied
+
+
+def concat(in_files, out_file,
+        blosc_args=DEFAULT_BLOSC_ARGS,
+        bloscpack_args=None,
+        metadata_args=DEFAULT_METADATA_ARGS):
+    """ Concatenate several compressed files into one.
+
+    Parameters
+    ----------
+    in_files : list of str
+        the names of the files to concatenate, in order
+    out_file : str
+        the name of the output file
+    blosc_args : dict
+        the blosc args used for chunks that need to be recompressed
+    bloscpack_args : dict
+        the bloscpack args for the output, None means use the defaults
+    metadata_args : dict
+        the metadata args for the output
+
+    Notes
+    -----
+    See ``concat_fp`` for details.
+
+    """
+    input_fps = [open(in_file, 'rb') for in_file in in_files]
+    try:
+        with open(out_file, 'wb') as output_fp:
+            concat_fp(input_fps, output_fp,
+                    blosc_args=blosc_args,
+                    bloscpack_args=bloscpack_args,
+                    metadata_args=metadata_args)
+    finally:
+        for input_fp in input_fps:
+            input_fp.close()
+    print_verbose('output file size: %s' %
+            double_pretty_size(path.getsize(out_file)))
+
+
+def _plan_split(extents, nshards=None, chunks_per_shard=None,
+        shard_size=None):
+    """ Determine which chunks go into which shard.
+
+    Parameters
+    ----------
+    extents : list of (int, int) tuples
+        the position and length of each chunk
+    nshards : int
+        the desired number of shards
+    chunks_per_shard : int
+        the desired number of chunks per shard
+    shard_size : int
+        the desired maximum size of the compressed chunks in each shard
+
+    Returns
+    -------
+    ranges : list of (int, int) tuples
+        the start (inclusive) and stop (exclusive) chunk index of each shard
+
+    Raises
+    ------
+    ValueError
+        if not exactly one of the keyword arguments is given
+
+    Notes
+    -----
+    When splitting by 'shard_size' each shard contains at least one chunk,
+    even if that chunk alone is larger than 'shard_size'.
+
+    """
+    nchunks = len(extents)
+    given = [a for a in (nshards, chunks_per_shard, shard_size)
+             if a is not None]
+    if len(given) != 1:
+        raise ValueError("exactly one of 'nshards', 'chunks_per_shard' "
+                "and 'shard_size' must be given")
+    if nshards is not None:
+        check_range('nshards', nshards, 1, nchunks)
+        bounds = [nchunks * k // nshards for k in xrange(nshards + 1)]
+    elif chunks_per_shard is not None:
+        check_range('chunks_per_shard', chunks_per_shard, 1, MAX_CHUNKS)
+        bounds = range(0, nchunks, chunks_per_shard) + [nchunks]
+    else:
+        check_range('shard_size', shard_size, 1, sys.maxint)
+        bounds, current = [0], 0
+        for i, (_, length) in enumerate(extents):
+            if current > 0 and current + length > shard_size:
+                bounds.append(i)
+                current = 0
+            current += length
+        bounds.append(nchunks)
+    return zip(bounds[:-1], bounds[1:])
+
+
+def _shard_ndarray_metadata(metadata, start, nbytes):
+    """ Adjust Numpy metadata for a shard of the array.
+
+    Parameters
+    ----------
+    metadata : dict
+        the Numpy metadata of the whole array
+    start : int
+        the position of the shard in the uncompressed data in bytes
+    nbytes : int
+        the uncompressed size of the shard in bytes
+
+    Returns
+    -------
+    metadata : dict
+        the metadata of the shard
+
+    Raises
+    ------
+    ValueError
+        if the shard does not consist of whole rows along axis 0
+
+    """
+    shape = list(metadata['shape'])
+    if len(shape) == 0 or metadata['order'] == 'F' and len(shape) > 1:
+        raise ValueError('can only split C ordered arrays along axis 0')
+    row_size = np.dtype(metadata['dtype']).itemsize * \
+            int(np.prod(shape[1:]))
+    if start % row_size != 0 or nbytes % row_size != 0:
+        raise ValueError(
+                "shard at byte '%d' of '%d' bytes does not consist of whole "
+                "rows of '%d' bytes, use a different chunk-size or split"
+                % (start, nbytes, row_size))
+    metadata = dict(metadata)
+    metadata['shape'] = [nbytes // row_size] + shape[1:]
+    return metadata
+
+
+def _write_shard(input_fp, output_fp, bloscpack_header, metadata, extents,
+        start, stop,
+        bloscpack_args=None,
+        metadata_args=DEFAULT_METADATA_ARGS):
+    """ Copy a range of chunks into a new file pointer. """
+    chunk_size = bloscpack_header.chunk_size
+    nchunks = stop - start
+    last_chunk = (bloscpack_header.last_chunk
+                  if stop == bloscpack_header.nchunks else chunk_size)
+    if isinstance(metadata, dict) and metadata.get('container') == 'numpy':
+        metadata = _shard_ndarray_metadata(metadata, start * chunk_size,
+                (nchunks - 1) * chunk_size + last_chunk)
+    bloscpack_args = _complete_bloscpack_args(DEFAULT_BLOSCPACK_ARGS
+            if bloscpack_args is None else bloscpack_args)
+    bloscpack_args['checksum'] = bloscpack_header.checksum
+    bloscpack_args['constant'] = bloscpack_header.constant
+    _check_bloscpack_args(bloscpack_args)
+    blosc_args = DEFAULT_BLOSC_ARGS.copy()
+    blosc_args['typesize'] = bloscpack_header.typesize
+    sink = CompressedFPSink(output_fp)
+    _write_beginning(sink, nchunks, chunk_size, last_chunk,
+            metadata=metadata,
+            blosc_args=blosc_args,
+            bloscpack_args=bloscpack_args,
+            metadata_args=metadata_args)
+    _copy_chunks(input_fp, sink, extents[start:stop], 0)
+    sink.finalize()
+
+
+def shard_fp(input_fp, output_fp, start, stop,
+        bloscpack_args=None,
+        metadata_args=DEFAULT_METADATA_ARGS):
+    """ Copy a range of chunks from a compressed file pointer into a new one.
+
+    Parameters
+    ----------
+    input_fp : file like
+        the file pointer to copy from
+    output_fp : file like
+        the file pointer to write the shard to
+    start : int
+        the index of the first chunk of the shard
+    stop : int
+        the index after the last chunk of the shard
+    bloscpack_args : dict
+        the bloscpack args for the shard, None means use the defaults
+    metadata_args : dict
+        the metadata args for the shard
+
+    Raises
+    ------
+    ValueError
+        if the chunk range is invalid or the Numpy metadata can not be
+        adjusted for the shard
+
+    Notes
+    -----
+    The compressed chunks and their checksums are copied verbatim. Numpy
+    metadata is adjusted to the shape of the shard, any other metadata is
+    copied as is. The 'checksum' value of 'bloscpack_args' will be silently
+    ignored and replaced with the checksum of the input.
+
+    """
+    bloscpack_header, metadata, metadata_header, offsets = \
+            _read_beginning(input_fp)
+    check_range('start', start, 0, bloscpack_header.nchunks - 1)
+    check_range('stop', stop, start + 1, bloscpack_header.nchunks)
+    extents = _read_chunk_extents(input_fp, bloscpack_header, offsets)
+    _write_shard(input_fp, output_fp, bloscpack_header, metadata, extents,
+            start, stop,
+            bloscpack_args=bloscpack_args,
+            metadata_args=metadata_args)
+
+
+def split(in_file, out_prefix=None,
+        nshards=None, chunks_per_shard=None, shard_size=None,
+        bloscpack_args=None,
+        metadata_args=DEFAULT_METADATA_ARGS,
+        force=False):
+    """ Split a compressed file into shards without recompression.
+
+    Parameters
+    ----------
+    in_file : str
+        the name of the file to split
+    out_prefix : str
+        the prefix for the names of the shards, the default is 'in_file'
+        without the extension
+    nshards : int
+        the desired number of shards
+    chunks_per_shard : int
+        the desired number of chunks per shard
+    shard_size : int
+        the desired maximum size of the compressed chunks in each shard
+    bloscpack_args : dict
+        the bloscpack args for the shards, None means use the defaults
+    metadata_args : dict
+        the metadata args for the shards
+    force : bool
+        overwrite existing shards
+
+    Returns
+    -------
+    out_files : list of str
+        the names of the shards, in order
+
+    Raises
+    ------
+    FileNotFound
+        if any of the shards exists already and 'force' is not set
+
+    Notes
+    -----
+    Exactly one of 'nshards', 'chunks_per_shard' and 'shard_size' must be
+    given. The shards are named '<out_prefix>.<k>.blp'. See ``shard_fp`` for
+    details on the contents of each shard.
+
+    """
+    if out_prefix is None:
+        out_prefix = in_file[:-len(EXTENSION)] \
+                if in_file.endswith(EXTENSION) else in_file
+    with open(in_file, 'rb') as input_fp:
+        bloscpack_header, metadata, metadata_header, offsets = \
+                _read_beginning(input_fp)
+        extents = _read_chunk_extents(input_fp, bloscpack_header, offsets)
+        ranges = _plan_split(extents,
+                nshards=nshards,
+                chunks_per_shard=chunks_per_shard,
+                shard_size=shard_size)
+        width = len(str(len(ranges) - 1))
+        out_files = ['%s.%s%s' % (out_prefix, str(k).zfill(width), EXTENSION)
+                     for k in xrange(len(ranges))]
+        for out_file in out_files:
+            if path.exists(out_file):
+                if not force:
+                    raise FileNotFound("output file '%s' exists!" % out_file)
+                else:
+                    print_verbose("overwriting existing file: '%s'" %
+                            out_file)
+        for out_file, (start, stop) in zip(out_files, ranges):
+            print_verbose("writing chunks '%d' to '%d' to: '%s'" %
+                    (start, stop - 1, out_file))
+            with open(out_file, 'wb') as output_fp:
+                _write_shard(input_fp, output_fp,
+                        bloscpack_header, metadata, extents, start, stop,
+                        bloscpack_args=bloscpack_args,
+                        metadata_args=metadata_args)
+    return out_files
+
+
+def _check_chunk(raw, checksum_impl):
+    """ Check a raw chunk as stored in the file, without decompressing it.
+
+    Parameters
+    ----------
+    raw : str
+        the compressed chunk followed by its checksum
+    checksum_impl : Checksum
+        the checksum that has been used
+
+    Returns
+    -------
+    ok : bool
+        if the length from the Blosc header and the checksum are correct
+
+    """
+    if len(raw) < BLOSC_HEADER_LENGTH + checksum_impl.size:
+        return False
+    compressed_length = len(raw) - checksum_impl.size
+    blosc_header = decode_blosc_header(raw[:BLOSC_HEADER_LENGTH])
+    if blosc_header['ctbytes'] != compressed_length:
+        return False
+    if checksum_impl.size > 0:
+        compressed = buffer(raw, 0, compressed_length)
+        return checksum_impl(compressed) == raw[compressed_length:]
+    return True
+
+
+def verify_fp(input_fp, nthreads=blosc.ncores):
+    """ Verify the integrity of all chunks in a compressed file pointer.
+
+    Parameters
+    ----------
+    input_fp : file like
+        the file pointer to verify
+    nthreads : int
+        the number of threads used to compute checksums
+
+    Returns
+    -------
+    bad_chunks : list of int
+        the indices of all chunks that failed verification
+
+    Raises
+    ------
+    ChecksumMismatch
+        if the checksum of the metadata does not match
+
+    Notes
+    -----
+    The chunks are read sequentially and checked in batches by a pool of
+    threads. No chunk is decompressed, instead the length of each chunk is
+    checked against its Blosc header and the checksum, if any, is recomputed.
+
+    """
+    bloscpack_header, metadata, metadata_header, offsets = \
+            _read_beginning(input_fp)
+    checksum_impl = bloscpack_header.checksum_impl
+    if checksum_impl.size == 0:
+        print_verbose('no checksum, will only check the chunk lengths')
+    extents = _read_chunk_extents(input_fp, bloscpack_header, offsets)
+    check = lambda raw: _check_chunk(raw, checksum_impl)
+    batch_size = nthreads * 4
+    bad_chunks = []
+    pool = multiprocessing.pool.ThreadPool(nthreads)
+    try:
+        for first in xrange(0, len(extents), batch_size):
+            batch = []
+            for position, length in extents[first:first + batch_size]:
+                input_fp.seek(position, 0)
+                batch.append(input_fp.read(length))
+            for i, ok in enumerate(pool.map(check, batch), first):
+                if not ok:
+                    print_verbose("chunk '%d' is corrupt" % i)
+                    bad_chunks.append(i)
+    finally:
+        pool.close()
+        pool.join()
+    print_verbose("verified '%d' chunks, '%d' corrupt" %
+            (len(extents), len(bad_chunks)))
+    return bad_chunks
+
+
+def verify_file(filename, nthreads=blosc.ncores):
+    """ Verify the integrity of all chunks in a compressed file.
+
+    Parameters
+    ----------
+    filename : str
+        the name of the file to verify
+    nthreads : int
+        the number of threads used to compute checksums
+
+    Returns
+    -------
+    bad_chunks : list of int
+        the indices of all chunks that failed verification
+
+    Notes
+    -----
+    See ``verify_fp`` for details.
+
+    """
+    with open(filename, 'rb') as input_fp:
+        return verify_fp(input_fp, nthreads=nthreads)
+
+
+def _plan_reads(extents, indices, max_gap=DEFAULT_MAX_GAP):
+    """ Merge the ranges of several chunks into as few reads as possible.
+
+    Parameters
+    ----------
+    extents : list of (int, int) tuples
+        the position and length of every chunk
+    indices : sequence of int
+        the chunks to read, in any order, may contain duplicates
+    max_gap : int
+        the largest number of unneeded bytes between two chunks that are
+        still fetched with a single read
+
+    Returns
+    -------
+    reads : list of (int, int, list) tuples
+        for each read, ordered by position, the position and the length of
+        the read and a list of (index, start, length) tuples locating the
+        chunks within the buffer of the read
+
+    """
+    if max_gap < 0:
+        raise ValueError("'max_gap' must be >= 0, not '%d'" % max_gap)
+    reads = []
+    for i in sorted(set(indices), key=lambda i: extents[i]):
+        position, length = extents[i]
+        if reads:
+            start, read_length, pieces = reads[-1]
+            if position - (start + read_length) <= max_gap:
+                pieces.append((i, position - start, length))
+                end = max(start + read_length, position + length)
+                reads[-1] = (start, end - start, pieces)
+                continue
+        reads.append((position, length, [(i, 0, length)]))
+    return reads
+
+
+def read_chunks_fp(input_fp, indices, max_gap=DEFAULT_MAX_GAP,
+        observer=None):
+    """ Read and decompress several chunks from a compressed file pointer.
+
+    Parameters
+    ----------
+    input_fp : file like
+        the file pointer to read from
+    indices : sequence of int
+        the chunks to read, in any order, may contain duplicates
+    max_gap : int
+        the largest number of unneeded bytes between two chunks that are
+        still fetched with a single read
+    observer : ChunkObserver or None
+        if given, receives an event for every distinct chunk read
+
+    Returns
+    -------
+    chunks : list of str
+        the decompressed chunks, in the order of 'indices'
+
+    Raises
+    ------
+    IndexError
+        if an index is out of range
+    ChecksumMismatch
+        if the checksum of a chunk does not match
+
+    Notes
+    -----
+    Chunks that are adjacent, or separated by at most 'max_gap' bytes, in the
+    file are fetched with a single seek and read and are then sliced out of
+    the combined buffer. This saves syscalls on local files and round trips
+    on network filesystems.
+
+    """
+    bloscpack_header, metadata, metadata_header, offsets = \
+            _read_beginning(input_fp)
+    checksum_impl = bloscpack_header.checksum_impl
+    extents = _read_chunk_extents(input_fp, bloscpack_header, offsets)
+    for i in indices:
+        if not 0 <= i < len(extents):
+            raise IndexError("chunk index '%d' out of range for '%d' chunks" %
+                    (i, len(extents)))
+    reads = _plan_reads(extents, indices, max_gap=max_gap)
+    print_verbose("reading '%d' chunks with '%d' reads" %
+            (len(set(indices)), len(reads)), level=DEBUG)
+    decompressed = {}
+    stats = _pipeline_stats(observer=observer)
+    for start, length, pieces in reads:
+        with stats.stage('read') as read_frame:
+            input_fp.seek(start, 0)
+            block = input_fp.read(length)
+        if len(block) != length:
+            raise EOFError('unexpected end of file while reading chunks')
+        for i, piece_start, piece_length in pieces:
+            raw = block[piece_start:piece_start + piece_length]
+            with stats.stage('decompress') as frame:
+                compressed = _unwrap_chunk(raw, checksum_impl)
+                decompressed[i] = _decompress_chunk_str(compressed)
+            if observer is not None:
+                observer.chunk(ChunkEvent('read', i, len(decompressed[i]),
+                    len(compressed), read_frame.wall * piece_length / length,
+                    frame.wall, 0.0, frame.nested.get('checksum', 0.0)))
+    if observer is not None:
+        observer.finish('read')
+    return [decompressed[i] for i in indices]
+
+
+def read_chunks(in_file, indices, max_gap=DEFAULT_MAX_GAP, observer=None):
+    """ Read and decompress several chunks from a compressed file.
+
+    Parameters
+    ----------
+    in_file : str or Storage
+        the name or URL of the file or the storage to read from
+    indices : sequence of int
+        the chunks to read, in any order, may contain duplicates
+    max_gap : int
+        the largest number of unneeded bytes between two chunks that are
+        still fetched with a single read
+    observer : ChunkObserver or None
+        if given, receives an event for every distinct chunk read
+
+    Returns
+    -------
+    chunks : list of str
+        the decompressed chunks, in the order of 'indices'
+
+    Notes
+    -----
+    See ``read_chunks_fp`` for details.
+
+    """
+    storage = open_storage(in_file)
+    input_fp = storage.open_read()
+    try:
+        return read_chunks_fp(input_fp, indices, max_gap=max_gap,
+                observer=observer)
+    finally:
+        input_fp.close()
+        if storage is not in_file:
+            storage.close()
+
+
+_job_pool = None
+_job_pool_lock = threading.Lock()
+
+
+def _submit(func, args, kwargs, callback):
+    """ Run a function in the shared pool of asynchronous jobs. """
+    global _job_pool
+    with _job_pool_lock:
+        if _job_pool is None:
+            # jobs only overlap if Blosc releases the GIL, which it does for
+            # as long as the pool exists
+            _acquire_releasegil()
+            _job_pool = multiprocessing.pool.ThreadPool(DEFAULT_ASYNC_JOBS)
+    return _job_pool.apply_async(func, args, kwargs, callback)
+
+
+def pack_file_async(in_file, out_file, callback=None, **kwargs):
+    """ Start compressing a file in the background.
+
+    Parameters
+    ----------
+    in_file : str
+        the name of the input file
+    out_file : str or Storage
+        the name of the output file or the storage to write to
+    callback : callable or None
+        called with the result once the job has succeeded
+    kwargs : dict
+        passed on to ``pack_file``
+
+    Returns
+    -------
+    result : multiprocessing.pool.AsyncResult
+        the handle of the job, its 'get' method waits for the job and
+        re-raises any exception
+
+    Notes
+    -----
+    Jobs run in a shared pool of 'DEFAULT_ASYNC_JOBS' threads, created on
+    first use. Since Blosc releases the GIL while compressing, the I/O and
+    compression of concurrent jobs overlap.
+
+    """
+    return _submit(pack_file, (in_file, out_file), kwargs, callback)
+
+
+def unpack_file_async(in_file, out_file, callback=None, **kwargs):
+    """ Start decompressing a file in the background.
+
+    Parameters
+    ----------
+    in_file : str or Storage
+        the name or URL of the input file or the storage to read from
+    out_file : str
+        the name of the output file
+    callback : callable or None
+        called with the metadata once the job has succeeded
+    kwargs : dict
+        passed on to ``unpack_file``
+
+    Returns
+    -------
+    result : multiprocessing.pool.AsyncResult
+        the handle of the job, its 'get' method waits for the job, returns
+        the metadata and re-raises any exception
+
+    Notes
+    -----
+    See ``pack_file_async`` for details.
+
+    """
+    return _submit(unpack_file, (in_file, out_file), kwargs, callback)
+
+
+def read_chunks_async(in_file, indices, callback=None,
+        max_gap=DEFAULT_MAX_GAP, observer=None):
+    """ Start reading several chunks in the background.
+
+    Parameters
+    ----------
+    in_file : str or Storage
+        the name or URL of the file or the storage to read from
+    indices : sequence of int
+        the chunks to read, in any order, may contain duplicates
+    callback : callable or None
+        called with the chunks once the job has succeeded
+    max_gap : int
+        the largest number of unneeded bytes between two chunks that are
+        still fetched with a single read
+    observer : ChunkObserver or None
+        if given, receives an event for every distinct chunk read
+
+    Returns
+    -------
+    result : multiprocessing.pool.AsyncResult
+        the handle of the job, its 'get' method waits for the job, returns
+        the decompressed chunks and re-raises any exception
+
+    Notes
+    -----
+    See ``pack_file_async`` for details.
+
+    """
+    return _submit(read_chunks, (in_file, indices),
+            {'max_gap': max_gap, 'observer': observer}, callback)
+
+
+def _read_merkle_beginning(input_fp):
+    """ Read the beginning of a file and locate its Merkle tree.
+
+    Raises
+    ------
+    ValueError
+        if the file has no Merkle tree
+
+    """
+    bloscpack_header, metadata, metadata_header, offsets = \
+            _read_beginning(input_fp)
+    if not bloscpack_header.merkle:
+        raise ValueError('file does not contain a Merkle tree')
+    return bloscpack_header, _merkle_position(bloscpack_header,
+            metadata_header)
+
+
+def merkle_root_fp(input_fp):
+    """ Read the root of the Merkle tree from a compressed file pointer.
+
+    Parameters
+    ----------
+    input_fp : file like
+        the file pointer to read from
+
+    Returns
+    -------
+    root : str
+        the digest at the root of the Merkle tree
+
+    Raises
+    ------
+    ValueError
+        if the file has no Merkle tree
+
+    """
+    bloscpack_header, position = _read_merkle_beginning(input_fp)
+    return _read_merkle_node(input_fp, position, bloscpack_header, 0)
+
+
+def merkle_diff_fp(first_fp, second_fp):
+    """ Find the chunks that differ between two compressed file pointers.
+
+    Parameters
+    ----------
+    first_fp : file like
+        the first file pointer
+    second_fp : file like
+        the second file pointer
+
+    Returns
+    -------
+    differing : list of int
+        the indices of all chunks whose digests differ, including the chunks
+        present in only one of the files
+
+    Raises
+    ------
+    ValueError
+        if either file has no Merkle tree
+    IncompatibleFiles
+        if the Merkle trees differ in checksum or capacity
+
+    Notes
+    -----
+    Starting at the root, only subtrees whose digests differ are descended
+    into, so for a few differing chunks only a logarithmic number of nodes is
+    read. Replicas have identical trees, since the capacity of the tree is
+    fixed when the file is created.
+
+    """
+    first_header, first_position = _read_merkle_beginning(first_fp)
+    second_header, second_position = _read_merkle_beginning(second_fp)
+    capacity = _merkle_capacity(first_header)
+    if first_header.checksum != second_header.checksum or \
+            capacity != _merkle_capacity(second_header):
+        raise IncompatibleFiles('can not compare Merkle trees with '
+                'different checksums or capacities')
+    differing, stack, nreads = [], [0], 0
+    while stack:
+        i = stack.pop()
+        nreads += 1
+        if _read_merkle_node(first_fp, first_position, first_header, i) == \
+                _read_merkle_node(second_fp, second_position, second_header, i):
+            continue
+        if i >= capacity - 1:
+            differing.append(i - capacity + 1)
+        else:
+            stack.extend((2 * i + 2, 2 * i + 1))
+    print_verbose("compared '%d' nodes of the Merkle trees, '%d' chunks "
+            "differ" % (nreads, len(differing)))
+    return differing
+
+
+def merkle_diff(first_file, second_file):
+    """ Find the chunks that differ between two compressed files.
+
+    See ``merkle_diff_fp`` for details.
+    """
+    with open_two_file(open(first_file, 'rb'), open(second_file, 'rb')) as \
+            (first_fp, second_fp):
+        return merkle_diff_fp(first_fp, second_fp)
+
+
+def _read_digests(input_fp, bloscpack_header, extents):
+    """ Read the digest table, i.e. the checksum following each chunk. """
+    size = bloscpack_header.checksum_impl.size
+    digests = []
+    for position, length in extents:
+        input_fp.seek(position + length - size, 0)
+        digests.append(input_fp.read(size))
+    return digests
+
+
+def sync_fp(local_fp, remote_fp, output_fp):
+    """ Reconstruct a remote compressed file using the chunks of a local one.
+
+    Parameters
+    ----------
+    local_fp : file like
+        the file pointer to the local, possibly outdated, copy
+    remote_fp : file like
+        the file pointer to the remote, up to date, copy
+    output_fp : file like
+        the file pointer to write the up to date copy to
+
+    Returns
+    -------
+    transferred : list of int
+        the indices of the chunks that were read from 'remote_fp'
+
+    Raises
+    ------
+    ValueError
+        if either file has no checksum, or one that is not in
+        'SYNC_CHECKSUMS_AVAIL'
+    IncompatibleFiles
+        if the files use different checksums
+
+    Notes
+    -----
+    Only the header, metadata, offsets and the digest table of the remote are
+    read, plus the chunks whose digest and length do not occur anywhere in the
+    local file. Since chunks are matched by their digests, the 32 bit
+    checksums are refused, with those the result could silently differ from
+    the remote. Consecutive chunks from the same file are copied in a single
+    block.
+
+    """
+    remote_header, metadata, metadata_header, remote_offsets = \
+            _read_beginning(remote_fp)
+    prefix_length = remote_fp.tell()
+    local_header, metadata, metadata_header, local_offsets = \
+            _read_beginning(local_fp)
+    if remote_header.checksum_impl.size == 0 or \
+            local_header.checksum_impl.size == 0:
+        raise ValueError('can not sync files without checksums')
+    if remote_header.checksum != local_header.checksum:
+        raise IncompatibleFiles("can not sync files with checksums "
+                "'%s' and '%s'" %
+                (local_header.checksum, remote_header.checksum))
+    if remote_header.checksum not in SYNC_CHECKSUMS_AVAIL:
+        raise ValueError("can not sync files with the checksum '%s', use one "
+                "of: %s" % (remote_header.checksum,
+                    ', '.join(SYNC_CHECKSUMS_AVAIL)))
+    remote_extents = _read_chunk_extents(remote_fp, remote_header,
+            remote_offsets)
+    local_extents = _read_chunk_extents(local_fp, local_header,
+            local_offsets)
+    local_chunks = {}
+    for (position, length), digest in zip(local_extents,
+            _read_digests(local_fp, local_header, local_extents)):
+        local_chunks.setdefault((digest, length), position)
+
+    # plan which ranges to copy from which file, coalescing neighbours, each
+    # chunk that is shared in the remote is stored only once
+    stored_extents = sorted(set(remote_extents))
+    missing, ranges = set(), [(remote_fp, 0, prefix_length)]
+    for (position, length), digest in zip(stored_extents,
+            _read_digests(remote_fp, remote_header, stored_extents)):
+        source_fp = local_fp
+        if (digest, length) in local_chunks:
+            position = local_chunks[(digest, length)]
+        else:
+            source_fp = remote_fp
+            missing.add(position)
+        previous_fp, start, previous_length = ranges[-1]
+        if previous_fp is source_fp and start + previous_length == position:
+            ranges[-1] = (source_fp, start, previous_length + length)
+        else:
+            ranges.append((source_fp, position, length))
+    for source_fp, start, length in ranges:
+        _copy_range(source_fp, output_fp, start, length)
+    transferred = [i for i, (offset, _) in enumerate(remote_extents)
+                   if offset in missing]
+    print_verbose("transferred '%d' of '%d' chunks (%s) from the remote" %
+            (len(transferred), len(remote_extents),
+             double_pretty_size(sum(length for source_fp, start, length
+                 in ranges if source_fp is remote_fp))))
+    return transferred
+
+
+def sync_file(local_file, remote_file, out_file=None):
+    """ Update a local compressed file to match a remote one.
+
+    Parameters
+    ----------
+    local_file : str
+        the local, possibly outdated, file
+    remote_file : str
+        the remote, up to date, file
+    out_file : str or None
+        the file to write the up to date copy to, if None, 'local_file' is
+        replaced once the copy is complete
+
+    Returns
+    -------
+    transferred : list of int
+        the indices of the chunks that were read from 'remote_file'
+
+    See ``sync_fp`` for details.
+    """
+    output_file = out_file if out_file is not None \
+            else local_file + '.sync'
+    with open_two_file(open(local_file, 'rb'), open(remote_file, 'rb')) as \
+            (local_fp, remote_fp):
+        with open(output_file, 'wb') as output_fp:
+            transferred = sync_fp(local_fp, remote_fp, output_fp)
+    if out_file is None:
+        os.rename(output_file, local_file)
+    return transferred
+
+
+if __name__ == '__main__':
+    parser = create_parser()
+    PREFIX = parser.prog
+    args = parser.parse_args()
+    if args.verbose:
+        LEVEL = VERBOSE
+    elif args.debug:
+        LEVEL = DEBUG
+    print_verbose('command line argument parsing complete', level=DEBUG)
+    print_verbose('command line arguments are: ', level=DEBUG)
+    for arg, val in vars(args).iteritems():
+        print_verbose('\t%s: %s' % (arg, str(val)), level=DEBUG)
+    process_nthread_arg(args)
+    if getattr(args, 'memory_budget', None) is not None and args.workers < 2:
+        error('--memory-budget requires more than one --workers')
+
+    # compression and decompression handled via subparsers
+    if args.subcommand in ['compress', 'c']:
+        print_verbose('getting ready for compression')
+        in_file, out_file, blosc_args = process_compression_args(args)
+        try:
+            check_files(in_file, out_file, args)
+        except FileNotFound as fnf:
+            error(str(fnf))
+        metadata = process_metadata_args(args)
+        bloscpack_args = DEFAULT_BLOSCPACK_ARGS.copy()
+        bloscpack_args['offsets'] = args.offsets
+        bloscpack_args['checksum'] = args.checksum
+        bloscpack_args['merkle'] = args.merkle
+        bloscpack_args['dedup'] = args.dedup
+        bloscpack_args['constant'] = args.constant
+        try:
+            memory_budget = (MemoryBudget(args.memory_budget)
+                             if args.memory_budget else None)
+            pack_file(in_file, out_file, chunk_size=args.chunk_size,
+                    metadata=metadata,
+                    blosc_args=blosc_args,
+                    bloscpack_args=bloscpack_args,
+                    metadata_args=DEFAULT_METADATA_ARGS,
+                    objective=args.objective,
+                    adaptive=args.adaptive,
+                    nthreads=args.workers,
+                    memory_budget=memory_budget)
+        except (ChunkingException, ValueError) as e:
+            error(str(e))
+    elif args.subcommand in ['decompress', 'd']:
+        print_verbose('getting ready for decompression')
+        in_file, out_file = process_decompression_args(args)
+        try:
+            check_files(in_file, out_file, args)
+        except FileNotFound as fnf:
+            error(str(fnf))
+        try:
+            memory_budget = (MemoryBudget(args.memory_budget)
+                             if args.memory_budget else None)
+            metadata = unpack_file(in_file, out_file, sparse=args.sparse,
+                    nthreads=args.workers, readahead=args.readahead,
+                    memory_budget=memory_budget)
+            if metadata:
+                print_verbose("Metadata is:\n'%s'" % metadata, level=NORMAL)
+        except FormatVersionMismatch as fvm:
+            error(fvm.message)
+        except ChecksumMismatch as csm:
+            error(csm.message)
+    elif args.subcommand in ['append', 'a']:
+        print_verbose('getting ready for append')
+        original_file, new_file = process_append_args(args)
+        try:
+            if not path.exists(original_file):
+                raise FileNotFound("original file '%s' does not exist!" %
+                        original_file)
+            if not path.exists(new_file):
+                raise FileNotFound("new file '%s' does not exist!" %
+                        new_file)
+        except FileNotFound as fnf:
+            error(str(fnf))
+        print_verbose("original file is: '%s'" % original_file)
+        print_verbose("new file is: '%s'" % new_file)
+        blosc_args = _blosc_args_from_args(args)
+        metadata = process_metadata_args(args)
+        append(original_file, new_file, blosc_args=blosc_args)
+        if metadata is not None:
+            with open(original_file, 'r+b') as fp:
+                _seek_to_metadata(fp)
+                _rewrite_metadata_fp(fp, metadata)
+    elif args.subcommand in ('info', 'i'):
+        try:
+            if not path.exists(args.file_):
+                raise FileNotFound("file '%s' does not exist!" %
+                        args.file_)
+        except FileNotFound as fnf:
+            error(str(fnf))
+        try:
+            with open(args.file_) as fp:
+                bloscpack_header, metadata, metadata_header, offsets = \
+                        _read_beginning(fp)
+                if bloscpack_header.merkle:
+                    fp.seek(0)
+                    merkle_root = merkle_root_fp(fp)
+        except ValueError as ve:
+            error(str(ve) + "\n" +
+            "This might not be a bloscpack compressed file.")
+        print_normal(bloscpack_header.pformat())
+        if metadata is not None:
+            print_normal("'metadata':")
+            print_normal(pprint.pformat(metadata, indent=4))
+            print_normal("'metadata_header':")
+            print_normal(pprint.pformat(metadata_header, indent=4))
+        if offsets:
+            print_normal("'offsets':")
+            print_normal("[%s,...]" % (",".join(str(o) for o in offsets[:5])))
+        if bloscpack_header.merkle:
+            print_normal("'merkle_root': %s" % merkle_root.encode('hex'))
+
+    elif args.subcommand in ('concat', 'cat'):
+        print_verbose('getting ready for concatenation')
+        try:
+            for in_file in args.in_files:
+                if not path.exists(in_file):
+                    raise FileNotFound("input file '%s' does not exist!" %
+                            in_file)
+            if path.exists(args.out_file) and not args.force:
+                raise FileNotFound("output file '%s' exists!" % args.out_file)
+        except FileNotFound as fnf:
+            error(str(fnf))
+        blosc_args = _blosc_args_from_args(args)
+        try:
+            concat(args.in_files, args.out_file, blosc_args=blosc_args)
+        except (IncompatibleFiles, FormatVersionMismatch, ChecksumMismatch,
+                ValueError) as e:
+            error(str(e))
+    elif args.subcommand in ('split', 's'):
+        print_verbose('getting ready for splitting')
+        try:
+            if not path.exists(args.in_file):
+                raise FileNotFound("input file '%s' does not exist!" %
+                        args.in_file)
+            split(args.in_file, args.out_prefix,
+                    nshards=args.nshards,
+                    chunks_per_shard=args.chunks_per_shard,
+                    shard_size=args.shard_size,
+                    force=args.force)
+        except (FileNotFound, FormatVersionMismatch, ValueError) as e:
+            error(str(e))
+    elif args.subcommand in ('verify', 'v'):
+        try:
+            if not path.exists(args.file_):
+                raise FileNotFound("file '%s' does not exist!" %
+                        args.file_)
+            bad_chunks = verify_file(args.file_, nthreads=args.nthreads)
+        except (FileNotFound, FormatVersionMismatch, ChecksumMismatch,
+                ValueError) as e:
+            error(str(e))
+        if bad_chunks:
+            error("'%d' corrupt chunk%s: %s" % (len(bad_chunks),
+                's' if len(bad_chunks) > 1 else '',
+                ', '.join(str(i) for i in bad_chunks)))
+    elif args.subcommand in ('sync', 'sy'):
+        print_verbose('getting ready for syncing')
+        try:
+            for in_file in (args.local_file, args.remote_file):
+                if not path.exists(in_file):
+                    raise FileNotFound("input file '%s' does not exist!" %
+                            in_file)
+            if args.out_file is not None and path.exists(args.out_file) \
+                    and not args.force:
+                raise FileNotFound("output file '%s' exists!" %
+                        args.out_file)
+            sync_file(args.local_file, args.remote_file, args.out_file)
+        except (FileNotFound, IncompatibleFiles, FormatVersionMismatch,
+                ValueError) as e:
+            error(str(e))
     else:  # pragma: no cover
         # we should never reach this
         error('You found the easter-egg, please contact the author')
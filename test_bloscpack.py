@@ -4,12 +4,21 @@
 
 from __future__ import print_function
 
+import os
 import os.path as path
 import tempfile
 import contextlib
 import shutil
+import subprocess
+import sys
 import struct
 import atexit
+import imp
+import json
+import threading
+import time
+import BaseHTTPServer
+import SocketServer
 import numpy as np
 import numpy.testing as npt
 import nose.tools as nt
@@ -70,6 +79,21 @@ def test_print_verbose():
     bloscpack.LEVEL = NORMAL
 
 
+def test_print_debug_lazy():
+    class NoRepr(object):
+        def __repr__(self):
+            raise AssertionError('formatted although debugging is off')
+    # the arguments are not formatted unless debugging is on
+    print_debug('buffer: %r', NoRepr())
+    bloscpack.LEVEL = DEBUG
+    try:
+        nt.assert_raises(AssertionError, print_debug, 'buffer: %r', NoRepr())
+        # messages without arguments are not formatted
+        print_debug('100%')
+    finally:
+        bloscpack.LEVEL = NORMAL
+
+
 def test_error():
     # switch out the exit, to make sure test-suite doesn't fall over
     backup = bloscpack.sys.exit
@@ -102,6 +126,23 @@ def test_parser():
     parser = create_parser()
 
 
+def test_process_compression_args():
+    parser = create_parser()
+    def blosc_args(*argv):
+        args = parser.parse_args(['compress'] + list(argv) + ['data.dat'])
+        return bloscpack.process_compression_args(args)[2]
+    nt.assert_equal(DEFAULT_BLOSC_ARGS, blosc_args())
+    nt.assert_equal(dict(DEFAULT_BLOSC_ARGS, cname='zlib', shuffle=False),
+            blosc_args('-c', 'zlib', '-s'))
+    # with an objective, only the blosc args not given are chosen
+    nt.assert_equal(dict(DEFAULT_BLOSC_ARGS, cname='auto', clevel='auto',
+                         shuffle='auto'),
+            blosc_args('-A', 'speed>=100'))
+    nt.assert_equal(dict(DEFAULT_BLOSC_ARGS, cname='zlib', clevel=3,
+                         shuffle='auto'),
+            blosc_args('-A', 'speed>=100', '-c', 'zlib', '-l', '3'))
+
+
 def test_check_files():
     args = namedtuple('Args', 'force')(False)
     # check input_file exists
@@ -132,6 +173,18 @@ def test_check_bloscpack_arguments():
     extra = DEFAULT_BLOSCPACK_ARGS.copy()
     extra['wtf'] = 'wtf'
     nt.assert_raises(ValueError, bloscpack._check_bloscpack_args, extra)
+    # the args added later are optional, the others are not
+    old = dict((arg, DEFAULT_BLOSCPACK_ARGS[arg])
+               for arg in ('offsets', 'checksum', 'max_app_chunks'))
+    nt.assert_equal(DEFAULT_BLOSCPACK_ARGS,
+            bloscpack._complete_bloscpack_args(old))
+    nt.assert_raises(ValueError, bloscpack._check_bloscpack_args,
+            bloscpack._complete_bloscpack_args(missing))
+    nt.assert_raises(ValueError, bloscpack._check_bloscpack_args,
+            bloscpack._complete_bloscpack_args(extra))
+    a = np.arange(1000)
+    npt.assert_array_equal(a,
+            unpack_ndarray_str(pack_ndarray_str(a, bloscpack_args=old)))
 
 
 def test_check_metadata_arguments():
@@ -191,6 +244,235 @@ def test_calculate_nchunks():
                 chunk_size='2M'))
 
 
+def test_cpu_cache_sizes():
+    tdir = tempfile.mkdtemp(prefix='blpk')
+    try:
+        for index, (type_, level, size) in enumerate((
+                ('Data', '1', '32K'), ('Instruction', '1', '64K'),
+                ('Unified', '2', '1024K'), ('Unified', '3', '8M'))):
+            os.mkdir(path.join(tdir, 'index%d' % index))
+            for name, value in (('type', type_), ('level', level),
+                                ('size', size)):
+                with open(path.join(tdir, 'index%d' % index, name), 'w') as fp:
+                    fp.write(value + '\n')
+        os.mkdir(path.join(tdir, 'power'))
+        nt.assert_equal({1: 2**15, 2: 2**20, 3: 2**23},
+                bloscpack._cpu_cache_sizes(tdir))
+    finally:
+        shutil.rmtree(tdir)
+    nt.assert_equal({}, bloscpack._cpu_cache_sizes('/no/such/path'))
+
+
+def test_blosc_nthreads():
+    nthreads = bloscpack._blosc_nthreads()
+    try:
+        blosc.set_nthreads(3)
+        nt.assert_equal(3, bloscpack._blosc_nthreads())
+    finally:
+        blosc.set_nthreads(nthreads)
+    nt.assert_equal(nthreads, bloscpack._blosc_nthreads())
+
+
+def test_auto_chunk_size():
+    sample = np.linspace(0, 1, 2**19).tostring()
+    chunk_size = auto_chunk_size(sample, 2**30, 8)
+    nt.assert_equal(0, chunk_size % 8)
+    nt.assert_true(chunk_size >= AUTO_CHUNK_MIN_SIZE)
+    # small inputs become a single chunk, a multiple of the typesize
+    nt.assert_equal(1000, auto_chunk_size(sample[:1000], 1000, 8))
+    nt.assert_equal(996, auto_chunk_size(sample[:1000], 1000, 12))
+    # bounds without a power of two between them
+    cpu_cache_sizes = bloscpack._cpu_cache_sizes
+    bloscpack._cpu_cache_sizes = lambda: {2: 2**18, 3: 2**21}
+    try:
+        nt.assert_equal(3 * 2**16,
+                auto_chunk_size(sample[:250000], 2**30, 8, nthreads=3))
+        nt.assert_equal(196600,
+                auto_chunk_size(sample[:250000], 2**30, 10, nthreads=3))
+    finally:
+        bloscpack._cpu_cache_sizes = cpu_cache_sizes
+    with create_tmp_files() as (tdir, in_file, out_file, dcmp_file):
+        create_array(1, in_file)
+        pack_file(in_file, out_file, chunk_size='auto')
+        unpack_file(out_file, dcmp_file)
+        cmp(in_file, dcmp_file)
+    a = np.linspace(0, 1, 2**18).reshape(2**9, 2**9)
+    npt.assert_array_equal(a,
+            unpack_ndarray_str(pack_ndarray_str(a, chunk_size='auto')))
+
+
+def test_objective():
+    results = [({'cname': 'fast'}, 500 * 2**20, 0.8),
+               ({'cname': 'medium'}, 200 * 2**20, 0.5),
+               ({'cname': 'small'}, 20 * 2**20, 0.3)]
+    objective = Objective.parse('speed>=100')
+    nt.assert_equal('speed>=100', str(objective))
+    nt.assert_equal((results[1], True), objective.choose(results))
+    nt.assert_equal((results[0], False),
+            Objective(min_speed=1000).choose(results))
+    objective = Objective.parse('ratio <= 0.6')
+    nt.assert_equal('ratio<=0.6', str(objective))
+    nt.assert_equal((results[1], True), objective.choose(results))
+    nt.assert_equal((results[2], False),
+            Objective(max_ratio=0.1).choose(results))
+    for invalid in ('speed', 'speed<=3', 'ratio>=0.5', 'size>=3', 'speed>=x'):
+        nt.assert_raises(ValueError, Objective.parse, invalid)
+    nt.assert_raises(ValueError, Objective)
+    nt.assert_raises(ValueError, Objective, min_speed=1, max_ratio=1)
+
+
+def test_auto_blosc_args():
+    samples = [np.linspace(i, i + 1, 2**14).tostring() for i in range(2)]
+    blosc_args = DEFAULT_BLOSC_ARGS.copy()
+    blosc_args.update(cname='auto', clevel='auto', shuffle='auto')
+    chosen, results = auto_blosc_args(samples, blosc_args,
+            objective='speed>=0')
+    nt.assert_equal(len(CNAME_AVAIL) * len(AUTO_CLEVELS) * 2, len(results))
+    # without a speed limit, the best ratio wins
+    nt.assert_equal(min(ratio for _, _, ratio in results),
+            [ratio for args, _, ratio in results if args == chosen][0])
+    blosc_args = DEFAULT_BLOSC_ARGS.copy()
+    blosc_args['cname'] = 'auto'
+    chosen, results = auto_blosc_args(samples, blosc_args)
+    nt.assert_equal(CNAME_AVAIL, [args['cname'] for args, _, _ in results])
+    nt.assert_equal(DEFAULT_CLEVEL, chosen['clevel'])
+    # without samples, or too few to time, the defaults are used
+    nt.assert_equal((DEFAULT_BLOSC_ARGS, []),
+            auto_blosc_args([], blosc_args))
+    nt.assert_equal((DEFAULT_BLOSC_ARGS, []),
+            auto_blosc_args([np.arange(3).tostring()], blosc_args))
+    a = np.linspace(0, 1, 2**18)
+    npt.assert_array_equal(a, unpack_ndarray_str(pack_ndarray_str(a,
+        chunk_size='100K', blosc_args=blosc_args)))
+    # the objective reaches the calibration
+    npt.assert_array_equal(a, unpack_ndarray_str(pack_ndarray_str(a,
+        chunk_size='100K', blosc_args=blosc_args, objective='ratio<=0.5')))
+    nt.assert_raises(ValueError, pack_ndarray_str, a,
+            blosc_args=blosc_args, objective='bogus')
+    # a tiny array is packed with the defaults
+    b = np.arange(3)
+    npt.assert_array_equal(b, unpack_ndarray_str(pack_ndarray_str(b,
+        blosc_args=blosc_args, objective='speed>=1e9')))
+    with create_tmp_files() as (tdir, in_file, out_file, dcmp_file):
+        create_array(1, in_file)
+        blosc_args = dict(DEFAULT_BLOSC_ARGS, clevel='auto', shuffle='auto')
+        stats = pack_file(in_file, out_file, blosc_args=blosc_args,
+                objective='ratio<=0.9', stats=PipelineStats())
+        nt.assert_equal(1, stats.count['calibrate'])
+        unpack_file(out_file, dcmp_file)
+        cmp(in_file, dcmp_file)
+        nt.assert_raises(ValueError, pack_file, in_file, out_file,
+                objective='bogus')
+        nt.assert_raises(ValueError, pack_ndarray_file, a, out_file,
+                blosc_args=blosc_args, objective='bogus')
+
+
+def test_adaptive_compressor():
+    nt.assert_raises(ValueError, AdaptiveCompressor, [('NO_SUCH_CODEC', 1)])
+    nt.assert_raises(ValueError, AdaptiveCompressor, budget=-1)
+    chunk = np.linspace(0, 1, 2**15).tostring()
+    blosc_args = dict(DEFAULT_BLOSC_ARGS, cname='blosclz', shuffle=False)
+    adaptive = AdaptiveCompressor([('blosclz', False), ('zlib', True)],
+            budget=1e6)
+    # without a pool, only the given blosc args are tried
+    compress_func = bloscpack._compress_chunk_str
+    nt.assert_equal(compress_func(chunk, blosc_args),
+            adaptive.compress(compress_func, chunk, blosc_args))
+    adaptive.open()
+    try:
+        compressed = adaptive.compress(compress_func, chunk, blosc_args)
+    finally:
+        adaptive.close()
+    nt.assert_equal(compress_func(chunk,
+            dict(blosc_args, cname='zlib', shuffle=True)), compressed)
+    nt.assert_equal({('blosclz', False): 1, ('zlib', True): 1},
+            adaptive.chosen)
+    nt.assert_equal(chunk, blosc.decompress(compressed))
+    with create_tmp_files() as (tdir, in_file, out_file, dcmp_file):
+        create_array(1, in_file)
+        adaptive = AdaptiveCompressor(budget=1e6)
+        pack_file(in_file, out_file, chunk_size='1M', adaptive=adaptive)
+        nchunks, _, _ = calculate_nchunks(path.getsize(in_file), '1M')
+        nt.assert_equal(nchunks, sum(adaptive.chosen.values()))
+        nt.assert_equal(0, adaptive.timeouts)
+        unpack_file(out_file, dcmp_file)
+        cmp(in_file, dcmp_file)
+        pack_file(in_file, out_file, adaptive=True)
+        unpack_file(out_file, dcmp_file)
+        cmp(in_file, dcmp_file)
+
+
+def test_adaptive_budget():
+    blosc_args = dict(DEFAULT_BLOSC_ARGS, cname='blosclz')
+    candidates = [('zlib', True), ('zlib', False)]
+    # trials that wait until released miss every deadline, while the base
+    # compress spends enough CPU time for the budget not to run out
+    release = threading.Event()
+    def compress_func(chunk, blosc_args):
+        if blosc_args['cname'] == 'zlib':
+            release.wait()
+        else:
+            start = bloscpack._thread_cpu_time()
+            while bloscpack._thread_cpu_time() - start < 0.005:
+                pass
+        return chunk
+    adaptive = AdaptiveCompressor(candidates)
+    adaptive.open()
+    try:
+        for i in range(2 * ADAPTIVE_MAX_MISSES):
+            adaptive.compress(compress_func, 'chunk', blosc_args)
+            # let the trials left running finish, before the next chunk
+            release.set()
+            while adaptive.running:
+                time.sleep(0.001)
+            release.clear()
+    finally:
+        release.set()
+        adaptive.close()
+    # each candidate missed until it was retired, and no chunk was skipped
+    nt.assert_equal(0, adaptive.skipped)
+    nt.assert_equal(set(candidates), adaptive.retired)
+    nt.assert_equal(2 * ADAPTIVE_MAX_MISSES, adaptive.timeouts)
+    nt.assert_equal({('blosclz', True): 2 * ADAPTIVE_MAX_MISSES},
+            adaptive.chosen)
+
+    # at the default budget, the CPU time of the trials, those left running
+    # included, is bounded by the budget and a trial of each candidate
+    def burn(n):
+        for _ in xrange(n):
+            pass
+    def compress_func(chunk, blosc_args):
+        burn(10**4 * (25 if blosc_args['cname'] == 'zlib' and
+                      chunk == 'slow' else 1))
+        return chunk
+    adaptive = AdaptiveCompressor(candidates)
+    adaptive.open()
+    try:
+        for i in range(100):
+            adaptive.compress(compress_func, ('slow', 'fast')[i % 2],
+                    blosc_args)
+    finally:
+        adaptive.close()
+    start = bloscpack._thread_cpu_time()
+    compress_func('slow', dict(blosc_args, cname='zlib'))
+    trial = bloscpack._thread_cpu_time() - start
+    nt.assert_true(adaptive.trial_time <= ADAPTIVE_TIME_BUDGET *
+            adaptive.base_time + len(candidates) * (trial + 0.01),
+            (adaptive.trial_time, adaptive.base_time, trial))
+
+    # once the trials have spent the budget, there are none
+    adaptive = AdaptiveCompressor(candidates[:1])
+    adaptive.open()
+    try:
+        adaptive.trial_time = 1.0
+        adaptive.compress(compress_func, 'chunk', blosc_args)
+        nt.assert_equal(set(), adaptive.running)
+    finally:
+        adaptive.close()
+    nt.assert_equal(1, adaptive.skipped)
+    nt.assert_equal(0, adaptive.timeouts)
+
+
 def test_decode_blosc_header():
     array_ = np.linspace(0, 100, 2e4).tostring()
     # basic test case
@@ -246,28 +528,63 @@ def test_create_options():
     nt.assert_equal('00000001', create_options(offsets=True, metadata=False))
     nt.assert_equal('00000011', create_options(offsets=True, metadata=True))
 
+    nt.assert_equal('00000101', create_options(merkle=True))
+    nt.assert_equal('00000111', create_options(metadata=True, merkle=True))
+    nt.assert_equal('00001001', create_options(dedup=True))
+    nt.assert_equal('00010001', create_options(constant=True))
+
 
 def test_decode_options():
     nt.assert_equal({'offsets': False,
-        'metadata': False},
+        'metadata': False,
+        'merkle': False,
+        'dedup': False,
+        'constant': False},
             decode_options('00000000'))
     nt.assert_equal({'offsets': False,
-        'metadata': True},
+        'metadata': True,
+        'merkle': False,
+        'dedup': False,
+        'constant': False},
             decode_options('00000010'))
     nt.assert_equal({'offsets': True,
-        'metadata': False},
+        'metadata': False,
+        'merkle': False,
+        'dedup': False,
+        'constant': False},
             decode_options('00000001'))
     nt.assert_equal({'offsets': True,
-        'metadata': True},
+        'metadata': True,
+        'merkle': False,
+        'dedup': False,
+        'constant': False},
             decode_options('00000011'))
+    nt.assert_equal({'offsets': True,
+        'metadata': False,
+        'merkle': True,
+        'dedup': False,
+        'constant': False},
+            decode_options('00000101'))
+    nt.assert_equal({'offsets': True,
+        'metadata': False,
+        'merkle': False,
+        'dedup': True,
+        'constant': False},
+            decode_options('00001001'))
+    nt.assert_equal({'offsets': True,
+        'metadata': False,
+        'merkle': False,
+        'dedup': False,
+        'constant': True},
+            decode_options('00010001'))
 
     nt.assert_raises(ValueError, decode_options, '0000000')
     nt.assert_raises(ValueError, decode_options, '000000000')
     nt.assert_raises(ValueError, decode_options, '0000000a')
     nt.assert_raises(ValueError, decode_options, 'abc')
 
-    nt.assert_raises(ValueError, decode_options, '00000100')
-    nt.assert_raises(ValueError, decode_options, '00001100')
+    nt.assert_raises(ValueError, decode_options, '00100000')
+    nt.assert_raises(ValueError, decode_options, '00111100')
     nt.assert_raises(ValueError, decode_options, '11111100')
 
 
@@ -1485,6 +1802,1190 @@ def test_append_mix_shuffle():
     nt.assert_equal(blosc_header_last['flags'], 0)
 
 
+def pack_fp(data, chunk_size=DEFAULT_CHUNK_SIZE, metadata=None,
+        blosc_args=DEFAULT_BLOSC_ARGS,
+        bloscpack_args=DEFAULT_BLOSCPACK_ARGS):
+    """ Pack a string into a StringIO, which is reset. """
+    in_fp, out_fp = StringIO(data), StringIO()
+    source = PlainFPSource(in_fp)
+    sink = CompressedFPSink(out_fp)
+    bloscpack.pack(source, sink,
+            *calculate_nchunks(len(data), chunk_size),
+            metadata=metadata,
+            blosc_args=blosc_args,
+            bloscpack_args=bloscpack_args)
+    out_fp.reset()
+    return out_fp
+
+
+def unpack_fp(input_fp):
+    """ Unpack a file pointer into a string. """
+    dcmp_fp = StringIO()
+    bloscpack.unpack(CompressedFPSource(input_fp), PlainFPSink(dcmp_fp))
+    return dcmp_fp.getvalue()
+
+
+def test_concat_fp():
+    first, second = StringIO(), StringIO()
+    create_array_fp(1, first)
+    create_array_fp(1, second)
+    first_str, second_str = first.getvalue(), second.getvalue()
+    # 16000000 bytes is a multiple of the chunk-size, the boundaries line up
+    inputs = [pack_fp(first_str, chunk_size=320000),
+              pack_fp(second_str, chunk_size=320000)]
+    out_fp = StringIO()
+    nchunks_copied = bloscpack.concat_fp(inputs, out_fp)
+    out_fp.reset()
+    bloscpack_header = bloscpack._read_bloscpack_header(out_fp)
+    out_fp.reset()
+    nt.assert_equal(bloscpack_header.nchunks, nchunks_copied)
+    nt.assert_equal(first_str + second_str, unpack_fp(out_fp))
+
+    # with a short last chunk, everything after it must be re-chunked
+    inputs = [pack_fp(first_str, chunk_size='1M'),
+              pack_fp(second_str, chunk_size='1M'),
+              pack_fp(first_str, chunk_size='1M')]
+    out_fp = StringIO()
+    nchunks_copied = bloscpack.concat_fp(inputs, out_fp)
+    out_fp.reset()
+    bloscpack_header, _, _, offsets = bloscpack._read_beginning(out_fp)
+    out_fp.reset()
+    nt.assert_equal(15, nchunks_copied)
+    nt.assert_equal(46, bloscpack_header.nchunks)
+    nt.assert_equal(46, len(offsets))
+    nt.assert_equal(first_str + second_str + first_str, unpack_fp(out_fp))
+
+    # without offsets in the inputs or the output
+    bloscpack_args = DEFAULT_BLOSCPACK_ARGS.copy()
+    bloscpack_args['offsets'] = False
+    inputs = [pack_fp(first_str, chunk_size=320000,
+                      bloscpack_args=bloscpack_args),
+              pack_fp(second_str, chunk_size=320000,
+                      bloscpack_args=bloscpack_args)]
+    out_fp = StringIO()
+    bloscpack.concat_fp(inputs, out_fp, bloscpack_args=bloscpack_args)
+    out_fp.reset()
+    nt.assert_equal(first_str + second_str, unpack_fp(out_fp))
+
+
+def test_concat_fp_incompatible():
+    data = np.arange(1000).tostring()
+    inputs = [pack_fp(data, chunk_size='1K'), pack_fp(data, chunk_size='2K')]
+    nt.assert_raises(IncompatibleFiles, bloscpack.concat_fp,
+            inputs, StringIO())
+    bloscpack_args = DEFAULT_BLOSCPACK_ARGS.copy()
+    bloscpack_args['checksum'] = 'sha1'
+    inputs = [pack_fp(data), pack_fp(data, bloscpack_args=bloscpack_args)]
+    nt.assert_raises(IncompatibleFiles, bloscpack.concat_fp,
+            inputs, StringIO())
+
+
+def test_concat_ndarray():
+    a = np.arange(3000).reshape(1000, 3)
+    b = np.arange(1500).reshape(500, 3)
+    inputs = [StringIO(pack_ndarray_str(x, chunk_size='1K')) for x in a, b]
+    out_fp = StringIO()
+    bloscpack.concat_fp(inputs, out_fp)
+    out_fp.reset()
+    npt.assert_array_equal(np.concatenate([a, b]),
+            unpack_ndarray(CompressedFPSource(out_fp)))
+
+    inputs = [StringIO(pack_ndarray_str(x)) for x in a, b.reshape(750, 2)]
+    nt.assert_raises(IncompatibleFiles, bloscpack.concat_fp,
+            inputs, StringIO())
+    inputs = [StringIO(pack_ndarray_str(x)) for x in a, b.astype('float64')]
+    nt.assert_raises(IncompatibleFiles, bloscpack.concat_fp,
+            inputs, StringIO())
+
+
+def test_concat():
+    with create_tmp_files() as (tdir, in_file, out_file, dcmp_file):
+        create_array(1, in_file)
+        pack_file(in_file, out_file)
+        concat_file = path.join(tdir, 'concat.blp')
+        bloscpack.concat([out_file, out_file], concat_file)
+        unpack_file(concat_file, dcmp_file)
+        with open_two_file(open(in_file, 'rb'), open(dcmp_file, 'rb')) as \
+                (in_fp, dcmp_fp):
+            nt.assert_equal(in_fp.read() * 2, dcmp_fp.read())
+
+
+def test_plan_split():
+    extents = [(i * 10, 10) for i in range(10)]
+    nt.assert_equal([(0, 3), (3, 6), (6, 10)],
+            bloscpack._plan_split(extents, nshards=3))
+    nt.assert_equal([(0, 4), (4, 8), (8, 10)],
+            bloscpack._plan_split(extents, chunks_per_shard=4))
+    nt.assert_equal([(0, 2), (2, 4), (4, 6), (6, 8), (8, 10)],
+            bloscpack._plan_split(extents, shard_size=25))
+    nt.assert_equal([(i, i + 1) for i in range(10)],
+            bloscpack._plan_split(extents, shard_size=5))
+    nt.assert_raises(ValueError, bloscpack._plan_split, extents)
+    nt.assert_raises(ValueError, bloscpack._plan_split, extents,
+            nshards=2, chunks_per_shard=2)
+    nt.assert_raises(ValueError, bloscpack._plan_split, extents, nshards=11)
+
+
+def test_shard_fp():
+    in_fp = StringIO()
+    create_array_fp(1, in_fp)
+    in_str = in_fp.getvalue()
+    packed = pack_fp(in_str)
+    nchunks = bloscpack._read_bloscpack_header(packed).nchunks
+    received = []
+    for start, stop in ((0, 5), (5, 6), (6, nchunks)):
+        packed.reset()
+        out_fp = StringIO()
+        bloscpack.shard_fp(packed, out_fp, start, stop)
+        out_fp.reset()
+        bloscpack_header = bloscpack._read_bloscpack_header(out_fp)
+        nt.assert_equal(stop - start, bloscpack_header.nchunks)
+        out_fp.reset()
+        received.append(unpack_fp(out_fp))
+    nt.assert_equal(in_str, ''.join(received))
+    packed.reset()
+    nt.assert_raises(ValueError, bloscpack.shard_fp, packed, StringIO(), 5, 5)
+
+
+def test_shard_ndarray():
+    a = np.arange(3000).reshape(1000, 3)
+    # 24 bytes per row, 1536 bytes per chunk
+    packed = StringIO(pack_ndarray_str(a, chunk_size='1.5K'))
+    out_fp = StringIO()
+    bloscpack.shard_fp(packed, out_fp, 2, 4)
+    out_fp.reset()
+    npt.assert_array_equal(a[128:256],
+            unpack_ndarray(CompressedFPSource(out_fp)))
+    # 1024 bytes per chunk do not consist of whole rows
+    packed = StringIO(pack_ndarray_str(a, chunk_size='1K'))
+    nt.assert_raises(ValueError, bloscpack.shard_fp,
+            packed, StringIO(), 1, 2)
+
+
+def test_split():
+    with create_tmp_files() as (tdir, in_file, out_file, dcmp_file):
+        create_array(1, in_file)
+        pack_file(in_file, out_file)
+        shards = bloscpack.split(out_file, nshards=4)
+        nt.assert_equal([path.join(tdir, 'file.%d.blp' % k)
+                         for k in range(4)], shards)
+        nt.assert_raises(FileNotFound, bloscpack.split, out_file, nshards=4)
+        bloscpack.split(out_file, nshards=4, force=True)
+        concat_file = path.join(tdir, 'concat.blp')
+        bloscpack.concat(shards, concat_file)
+        unpack_file(concat_file, dcmp_file)
+        cmp(in_file, dcmp_file)
+
+
+def corrupt_chunk(input_fp, i):
+    """ Flip a byte in the middle of chunk 'i' of a packed StringIO. """
+    offsets = bloscpack._read_beginning(input_fp)[3]
+    position = offsets[i] + BLOSC_HEADER_LENGTH + 4
+    input_fp.seek(position)
+    byte = input_fp.read(1)
+    input_fp.seek(position)
+    input_fp.write('\x00' if byte == '\xff' else '\xff')
+    input_fp.reset()
+
+
+def test_verify_fp():
+    in_fp = StringIO()
+    create_array_fp(1, in_fp)
+    packed = pack_fp(in_fp.getvalue())
+    nt.assert_equal([], bloscpack.verify_fp(packed))
+    packed.reset()
+    corrupt_chunk(packed, 2)
+    corrupt_chunk(packed, 7)
+    nt.assert_equal([2, 7], bloscpack.verify_fp(packed, nthreads=2))
+
+    # without offsets the chunks are found by walking the Blosc headers
+    bloscpack_args = DEFAULT_BLOSCPACK_ARGS.copy()
+    bloscpack_args['offsets'] = False
+    packed = pack_fp(in_fp.getvalue(), bloscpack_args=bloscpack_args)
+    nt.assert_equal([], bloscpack.verify_fp(packed))
+
+    # without checksum only the lengths can be checked
+    bloscpack_args = DEFAULT_BLOSCPACK_ARGS.copy()
+    bloscpack_args['checksum'] = 'None'
+    packed = pack_fp(in_fp.getvalue(), bloscpack_args=bloscpack_args)
+    corrupt_chunk(packed, 2)
+    nt.assert_equal([], bloscpack.verify_fp(packed))
+    # truncate the last chunk
+    packed = StringIO(packed.getvalue()[:-10])
+    nt.assert_equal([15], bloscpack.verify_fp(packed))
+
+
+def rebuilt_merkle_tree(input_fp):
+    """ Rebuild the Merkle tree from the chunks of a packed StringIO. """
+    bloscpack_header, metadata, metadata_header, offsets = \
+            bloscpack._read_beginning(input_fp)
+    size = bloscpack_header.checksum_impl.size
+    digests = []
+    for position, length in bloscpack._read_chunk_extents(input_fp,
+            bloscpack_header, offsets):
+        input_fp.seek(position + length - size)
+        digests.append(input_fp.read(size))
+    input_fp.reset()
+    return bloscpack._build_merkle_tree(digests,
+            bloscpack._merkle_capacity(bloscpack_header),
+            bloscpack_header.checksum_impl)
+
+
+def stored_merkle_tree(input_fp):
+    """ Read the complete Merkle tree section from a packed StringIO. """
+    bloscpack_header, metadata, metadata_header, offsets = \
+            bloscpack._read_beginning(input_fp)
+    position = bloscpack._merkle_position(bloscpack_header, metadata_header)
+    nodes = [bloscpack._read_merkle_node(input_fp, position,
+                bloscpack_header, i)
+             for i in xrange(2 * bloscpack._merkle_capacity(bloscpack_header)
+                 - 1)]
+    input_fp.reset()
+    return nodes
+
+
+def test_merkle_pack_unpack():
+    in_fp = StringIO()
+    create_array_fp(1, in_fp)
+    bloscpack_args = dict(DEFAULT_BLOSCPACK_ARGS, checksum='sha1')
+    bloscpack_args['merkle'] = True
+    for checksum in ['md5', 'sha1']:
+        bloscpack_args['checksum'] = checksum
+        packed = pack_fp(in_fp.getvalue(), metadata={'dtype': 'float64'},
+                bloscpack_args=bloscpack_args)
+        nt.assert_equal(rebuilt_merkle_tree(packed),
+                stored_merkle_tree(packed))
+        nt.assert_equal(stored_merkle_tree(packed)[0],
+                bloscpack.merkle_root_fp(packed))
+        packed.reset()
+        nt.assert_equal(in_fp.getvalue(), unpack_fp(packed))
+        packed.reset()
+        nt.assert_equal([], bloscpack.verify_fp(packed))
+
+    # a Merkle tree requires offsets and a checksum without many collisions
+    for key, value in [('offsets', False), ('checksum', 'None'),
+            ('checksum', 'adler32'), ('checksum', 'crc32')]:
+        bloscpack_args = dict(DEFAULT_BLOSCPACK_ARGS, checksum='sha1')
+        bloscpack_args['merkle'] = True
+        bloscpack_args[key] = value
+        nt.assert_raises(ValueError, pack_fp, in_fp.getvalue(),
+                bloscpack_args=bloscpack_args)
+    # files without a tree have no root
+    nt.assert_raises(ValueError, bloscpack.merkle_root_fp,
+            pack_fp(in_fp.getvalue()))
+
+
+def test_merkle_append_fp():
+    in_fp, new_fp = StringIO(), StringIO()
+    create_array_fp(1, in_fp)
+    create_array_fp(1, new_fp)
+    bloscpack_args = dict(DEFAULT_BLOSCPACK_ARGS, checksum='sha1')
+    bloscpack_args['merkle'] = True
+    for data in [in_fp.getvalue(), in_fp.getvalue()[:-1000]]:
+        packed = pack_fp(data, bloscpack_args=bloscpack_args)
+        bloscpack.append_fp(packed, StringIO(new_fp.getvalue()),
+                len(new_fp.getvalue()))
+        packed.reset()
+        nt.assert_equal(rebuilt_merkle_tree(packed),
+                stored_merkle_tree(packed))
+        nt.assert_equal(data + new_fp.getvalue(), unpack_fp(packed))
+
+
+def test_merkle_rewrite_chunk():
+    in_fp = StringIO()
+    create_array_fp(1, in_fp)
+    data = in_fp.getvalue()
+    bloscpack_args = dict(DEFAULT_BLOSCPACK_ARGS, checksum='sha1')
+    bloscpack_args['merkle'] = True
+    packed = pack_fp(data, bloscpack_args=bloscpack_args)
+    bloscpack_header, metadata, metadata_header, offsets = \
+            bloscpack._read_beginning(packed)
+    packed.reset()
+    root = bloscpack.merkle_root_fp(packed)
+    # rewrite the last chunk, which may grow at the end of the file
+    last = bloscpack_header.last_chunk
+    changed = '\x01' * last
+    bloscpack._rewrite_chunk(packed, bloscpack_header,
+            bloscpack._merkle_position(bloscpack_header, metadata_header),
+            offsets[-1], bloscpack_header.nchunks - 1,
+            blosc.compress(changed, typesize=8))
+    packed.reset()
+    nt.assert_equal(rebuilt_merkle_tree(packed), stored_merkle_tree(packed))
+    nt.assert_not_equal(root, bloscpack.merkle_root_fp(packed))
+    packed.reset()
+    nt.assert_equal(data[:-last] + changed, unpack_fp(packed))
+
+
+def test_merkle_diff_fp():
+    in_fp = StringIO()
+    create_array_fp(1, in_fp)
+    bloscpack_args = dict(DEFAULT_BLOSCPACK_ARGS, checksum='sha1')
+    bloscpack_args['merkle'] = True
+    first = pack_fp(in_fp.getvalue(), bloscpack_args=bloscpack_args)
+    second = pack_fp(in_fp.getvalue(), bloscpack_args=bloscpack_args)
+    nt.assert_equal([], bloscpack.merkle_diff_fp(first, second))
+    first.reset()
+    second.reset()
+
+    # a replica with changed data differs only in the changed chunks
+    changed = in_fp.getvalue()
+    changed = changed[:3000000] + '\x01' * 8 + changed[3000008:]
+    third = pack_fp(changed, bloscpack_args=bloscpack_args)
+    nt.assert_equal([2], bloscpack.merkle_diff_fp(first, third))
+    first.reset()
+
+    # appended chunks are found too
+    bloscpack.append_fp(second, StringIO(in_fp.getvalue()),
+            len(in_fp.getvalue()))
+    second.reset()
+    nt.assert_equal(range(15, 31), bloscpack.merkle_diff_fp(first, second))
+
+    # trees of different shapes can not be compared
+    bloscpack_args['checksum'] = 'sha256'
+    fourth = pack_fp(in_fp.getvalue(), bloscpack_args=bloscpack_args)
+    first.reset()
+    nt.assert_raises(bloscpack.IncompatibleFiles, bloscpack.merkle_diff_fp,
+            first, fourth)
+
+
+def test_sync_fp():
+    in_fp = StringIO()
+    create_array_fp(1, in_fp)
+    data = in_fp.getvalue()
+    changed = data[:3000000] + '\x01' * 8 + data[3000008:]
+    bloscpack_args = DEFAULT_BLOSCPACK_ARGS.copy()
+    bloscpack_args['checksum'] = 'sha1'
+    local = pack_fp(data, bloscpack_args=bloscpack_args)
+    for remote_data, expected in [(data, []),
+                                  (changed, [2]),
+                                  (changed + data[:2000000], [2, 15, 16, 17])]:
+        remote, out_fp = pack_fp(remote_data,
+                bloscpack_args=bloscpack_args), StringIO()
+        local.reset()
+        nt.assert_equal(expected, bloscpack.sync_fp(local, remote, out_fp))
+        nt.assert_equal(remote.getvalue(), out_fp.getvalue())
+
+    # chunks are found even if they moved
+    remote, out_fp = pack_fp(data[1048576:-8],
+            bloscpack_args=bloscpack_args), StringIO()
+    local.reset()
+    nt.assert_equal([14], bloscpack.sync_fp(local, remote, out_fp))
+    nt.assert_equal(remote.getvalue(), out_fp.getvalue())
+
+    for checksum, exception in [('None', ValueError),
+                                ('md5', bloscpack.IncompatibleFiles)]:
+        bloscpack_args['checksum'] = checksum
+        remote = pack_fp(data, bloscpack_args=bloscpack_args)
+        local.reset()
+        nt.assert_raises(exception, bloscpack.sync_fp, local, remote,
+                StringIO())
+
+    # 32 bit checksums may collide, so they are refused
+    for checksum in ['adler32', 'crc32']:
+        bloscpack_args['checksum'] = checksum
+        local = pack_fp(data, bloscpack_args=bloscpack_args)
+        remote = pack_fp(changed, bloscpack_args=bloscpack_args)
+        nt.assert_raises(ValueError, bloscpack.sync_fp, local, remote,
+                StringIO())
+
+
+def dedup_data(pattern, tail=1000):
+    """ Build a string of repeated 1M blocks and a short tail. """
+    blocks = [np.random.RandomState(k).bytes(1048576)
+              for k in range(max(pattern) + 1)]
+    return ''.join(blocks[k] for k in pattern) + blocks[0][:tail]
+
+
+def test_dedup_pack_unpack():
+    data = dedup_data([0, 1, 0, 0, 2, 1])
+    bloscpack_args = dict(DEFAULT_BLOSCPACK_ARGS, checksum='sha1')
+    bloscpack_args['dedup'] = True
+    bloscpack_args['merkle'] = True
+    packed = pack_fp(data, bloscpack_args=bloscpack_args)
+    offsets = bloscpack._read_beginning(packed)[3]
+    nt.assert_equal(4, len(set(offsets)))
+    nt.assert_equal(offsets[0], offsets[2])
+    nt.assert_equal(offsets[0], offsets[3])
+    nt.assert_equal(offsets[1], offsets[5])
+    nt.assert_true(len(packed.getvalue()) <
+            0.6 * len(pack_fp(data).getvalue()))
+    packed.reset()
+    nt.assert_equal(data, unpack_fp(packed))
+    packed.reset()
+    nt.assert_equal([], bloscpack.verify_fp(packed))
+    packed.reset()
+    nt.assert_equal(rebuilt_merkle_tree(packed), stored_merkle_tree(packed))
+
+    # dedup requires offsets
+    bloscpack_args['merkle'] = False
+    bloscpack_args['offsets'] = False
+    nt.assert_raises(ValueError, pack_fp, data,
+            bloscpack_args=bloscpack_args)
+
+
+def test_dedup_append_fp():
+    bloscpack_args = DEFAULT_BLOSCPACK_ARGS.copy()
+    bloscpack_args['dedup'] = True
+    # the last chunk is shared with the first one and must not be overwritten
+    data, new_data = dedup_data([0, 1, 0], tail=0), dedup_data([2])
+    packed = pack_fp(data, bloscpack_args=bloscpack_args)
+    bloscpack.append_fp(packed, StringIO(new_data), len(new_data))
+    packed.reset()
+    nt.assert_equal(data + new_data, unpack_fp(packed))
+
+
+def test_dedup_copy():
+    data = dedup_data([0, 1, 0, 0, 2, 1])
+    bloscpack_args = DEFAULT_BLOSCPACK_ARGS.copy()
+    bloscpack_args['checksum'] = 'sha1'
+    local = pack_fp(data, bloscpack_args=bloscpack_args)
+    bloscpack_args['dedup'] = True
+    remote = pack_fp(data, bloscpack_args=bloscpack_args)
+
+    # chunks shared in the input are copied once for each offset
+    out_fp = StringIO()
+    bloscpack.shard_fp(remote, out_fp, 1, 4)
+    out_fp.reset()
+    nt.assert_equal(data[1048576:4 * 1048576], unpack_fp(out_fp))
+
+    # syncing reproduces the shared chunks
+    out_fp = StringIO()
+    remote.reset()
+    nt.assert_equal([], bloscpack.sync_fp(local, remote, out_fp))
+    nt.assert_equal(remote.getvalue(), out_fp.getvalue())
+
+
+def test_constant_value():
+    as_bytes = lambda s: np.frombuffer(s, dtype=np.uint8)
+    nt.assert_equal('\x00' * 8,
+            bloscpack._constant_value(as_bytes('\x00' * 800), 8))
+    nt.assert_equal('abcd',
+            bloscpack._constant_value(as_bytes('abcd' * 100), 4))
+    nt.assert_equal('abcdabcd',
+            bloscpack._constant_value(as_bytes('abcd' * 100), 8))
+    nt.assert_equal(None,
+            bloscpack._constant_value(as_bytes('abcd' * 101), 8))
+    nt.assert_equal(None,
+            bloscpack._constant_value(as_bytes('abcd' * 99 + 'abce'), 4))
+    nt.assert_equal(None, bloscpack._constant_value(None, 4))
+
+
+def test_constant_pack_unpack():
+    chunk = 1048576
+    data = ('\x00' * chunk + np.random.RandomState(0).bytes(chunk) +
+            np.float64(1.5).tostring() * (chunk // 8) + '\x00' * 1000)
+    bloscpack_args = DEFAULT_BLOSCPACK_ARGS.copy()
+    bloscpack_args['constant'] = True
+    packed = pack_fp(data, bloscpack_args=bloscpack_args)
+    bloscpack_header, _, _, offsets = bloscpack._read_beginning(packed)
+    lengths = [extent[1] for extent in
+               bloscpack._read_chunk_extents(packed, bloscpack_header,
+                   offsets)]
+    # header, value and adler32 checksum
+    nt.assert_equal([16 + 8 + 4] * 3, [lengths[0], lengths[2], lengths[3]])
+    packed.reset()
+    nt.assert_equal(data, unpack_fp(packed))
+    packed.reset()
+    nt.assert_equal([], bloscpack.verify_fp(packed))
+
+    # markers are copied verbatim and the option is passed on
+    out_fp = StringIO()
+    packed.reset()
+    bloscpack.shard_fp(packed, out_fp, 2, 4)
+    out_fp.reset()
+    nt.assert_equal(data[2 * chunk:], unpack_fp(out_fp))
+
+    # ndarrays in either order are filled in place
+    bloscpack_args['checksum'] = 'None'
+    for a in [np.zeros((300, 1000)), np.ones((300, 1000), order='F'),
+              np.arange(300000, dtype=np.int32).reshape(300, 1000),
+              np.array(['abc', 'abc', 'abc'], dtype='object')]:
+        a[:100] = a[0, 0] if a.ndim == 2 else a[0]
+        packed = bloscpack.pack_ndarray_str(a, chunk_size='100K',
+                bloscpack_args=bloscpack_args)
+        npt.assert_array_equal(a, bloscpack.unpack_ndarray_str(packed))
+
+
+def test_unpack_file_sparse():
+    chunk = 1048576
+    random = np.random.RandomState(0).bytes(chunk)
+    for data in ['\x00' * 4 * chunk + random + '\x00' * (3 * chunk + 8),
+                 random + '\x00' * 2 * chunk + random[:8]]:
+        for constant in [False, True]:
+            bloscpack_args = DEFAULT_BLOSCPACK_ARGS.copy()
+            bloscpack_args['constant'] = constant
+            with create_tmp_files() as (tdir, in_file, out_file, dcmp_file):
+                with open(in_file, 'wb') as fp:
+                    fp.write(data)
+                pack_file(in_file, out_file, bloscpack_args=bloscpack_args)
+                for nthreads in [1, 3]:
+                    unpack_file(out_file, dcmp_file, sparse=True,
+                            nthreads=nthreads)
+                    cmp(in_file, dcmp_file)
+
+
+def test_preallocate():
+    nbytes = 2**22
+    with create_tmp_files() as (tdir, in_file, out_file, dcmp_file):
+        for sparse in [False, True]:
+            with open(dcmp_file, 'wb') as fp:
+                bloscpack._preallocate(fp, nbytes, sparse=sparse)
+            nt.assert_equal(nbytes, path.getsize(dcmp_file))
+            reserved = os.stat(dcmp_file).st_blocks * 512
+            if sparse:
+                nt.assert_true(reserved < nbytes)
+            elif bloscpack._posix_fallocate is not None:
+                nt.assert_true(reserved >= nbytes)
+            os.remove(dcmp_file)
+
+
+def test_unpack_file_parallel():
+    with create_tmp_files() as (tdir, in_file, out_file, dcmp_file):
+        create_array(1, in_file)
+        bloscpack_args = DEFAULT_BLOSCPACK_ARGS.copy()
+        bloscpack_args['constant'] = True
+        pack_file(in_file, out_file, chunk_size='300K',
+                bloscpack_args=bloscpack_args)
+        for nthreads in [2, 4]:
+            unpack_file(out_file, dcmp_file, nthreads=nthreads)
+            cmp(in_file, dcmp_file)
+        # python-blosc before 1.5 cannot release the GIL
+        set_releasegil = blosc.set_releasegil
+        del blosc.set_releasegil
+        try:
+            unpack_file(out_file, dcmp_file, nthreads=2)
+        finally:
+            blosc.set_releasegil = set_releasegil
+        cmp(in_file, dcmp_file)
+        # a corrupt chunk is still detected
+        with open(out_file, 'r+b') as fp:
+            fp.seek(-100, 2)
+            fp.write('\x00' * 10)
+        nt.assert_raises(ChecksumMismatch, unpack_file, out_file, dcmp_file,
+                nthreads=4)
+
+
+def test_unpack_file_readahead():
+    with create_tmp_files() as (tdir, in_file, out_file, dcmp_file):
+        create_array(1, in_file)
+        pack_file(in_file, out_file, chunk_size='100K')
+        for readahead in [1, reverse_pretty('1M'), reverse_pretty('1G')]:
+            unpack_file(out_file, dcmp_file, readahead=readahead)
+            cmp(in_file, dcmp_file)
+        nt.assert_equal(bloscpack._posix_fadvise is not None,
+                drop_file_cache(out_file))
+        # advice is skipped for file likes without a file descriptor
+        nt.assert_false(bloscpack._fadvise(StringIO(), 0, 0,
+            bloscpack.POSIX_FADV_DONTNEED))
+        if bloscpack._posix_fadvise is not None:
+            with open(out_file, 'rb') as fp:
+                nt.assert_true(bloscpack._fadvise(fp, 0, 0,
+                    bloscpack.POSIX_FADV_DONTNEED))
+
+
+def test_plan_reads():
+    extents = [(0, 10), (10, 10), (25, 10), (100, 10), (35, 5)]
+    # adjacent chunks only
+    nt.assert_equal([(0, 20, [(0, 0, 10), (1, 10, 10)]),
+                     (25, 15, [(2, 0, 10), (4, 10, 5)]),
+                     (100, 10, [(3, 0, 10)])],
+                    bloscpack._plan_reads(extents, range(5), max_gap=0))
+    # bridge small gaps, any order, duplicates read once
+    nt.assert_equal([(0, 40, [(0, 0, 10), (2, 25, 10), (4, 35, 5)]),
+                     (100, 10, [(3, 0, 10)])],
+                    bloscpack._plan_reads(extents, [4, 3, 0, 2, 0],
+                        max_gap=15))
+    nt.assert_equal([(0, 110, [(0, 0, 10), (3, 100, 10)])],
+                    bloscpack._plan_reads(extents, [3, 0], max_gap=90))
+    # shared chunks are read once
+    nt.assert_equal([(0, 10, [(0, 0, 10), (1, 0, 10)])],
+                    bloscpack._plan_reads([(0, 10), (0, 10)], [0, 1]))
+    nt.assert_raises(ValueError, bloscpack._plan_reads, extents, [0],
+            max_gap=-1)
+
+
+def test_read_chunks_fp():
+    with create_tmp_files() as (tdir, in_file, out_file, dcmp_file):
+        create_array(1, in_file)
+        pack_file(in_file, out_file, chunk_size='100K')
+        with open(in_file, 'rb') as fp:
+            data = fp.read()
+        chunk_size = reverse_pretty('100K')
+        indices = [7, 3, 4, 5, 50, 3, 0]
+        expected = [data[i * chunk_size:(i + 1) * chunk_size]
+                    for i in indices]
+        for max_gap in [0, 200000, 10 ** 9]:
+            nt.assert_equal(expected,
+                    read_chunks(out_file, indices, max_gap=max_gap))
+        with open(out_file, 'rb') as fp:
+            nt.assert_raises(IndexError, read_chunks_fp, fp, [10 ** 6])
+        # a corrupt chunk is detected within a combined read
+        with open(out_file, 'r+b') as fp:
+            bloscpack_header, _, _, offsets = bloscpack._read_beginning(fp)
+            fp.seek(offsets[4] + 100)
+            fp.write('\x00' * 10)
+        nt.assert_raises(ChecksumMismatch, read_chunks, out_file, [3, 4, 5])
+        nt.assert_equal(expected[:1], read_chunks(out_file, [7]))
+
+
+@contextlib.contextmanager
+def serve_file(filename, ranges=True):
+    """ Serve a file over HTTP/1.1 with support for 'Range' requests, unless
+    'ranges' is False.
+    """
+    requests = []
+
+    class RangeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def send_body(self, with_body):
+            with open(filename, 'rb') as fp:
+                data = fp.read()
+            requests.append(self.headers.get('Range'))
+            status = 200
+            if ranges and self.headers.get('Range'):
+                first, last = self.headers['Range'][6:].split('-')
+                data = data[int(first):int(last) + 1]
+                status = 206
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            if with_body:
+                self.wfile.write(data)
+
+        def do_HEAD(self):
+            self.send_body(False)
+
+        def do_GET(self):
+            self.send_body(True)
+
+        def log_message(self, *args):
+            pass
+
+    # unlike HTTPServer, TCPServer does not look up the host name
+    server = SocketServer.ThreadingTCPServer(('127.0.0.1', 0), RangeHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield ('http://127.0.0.1:%d/file.blp' % server.server_address[1],
+                requests)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_http_storage():
+    with create_tmp_files() as (tdir, in_file, out_file, dcmp_file):
+        create_array(1, in_file)
+        pack_file(in_file, out_file, chunk_size='100K')
+        with open(in_file, 'rb') as fp:
+            data = fp.read()
+        chunk_size = reverse_pretty('100K')
+        with serve_file(out_file) as (url, requests):
+            storage = HTTPStorage(url, readahead=4096)
+            nt.assert_equal(path.getsize(out_file), storage.size())
+            # adjacent chunks are fetched with a single request
+            chunks = read_chunks(storage, [3, 4, 5, 40])
+            nt.assert_equal([data[i * chunk_size:(i + 1) * chunk_size]
+                             for i in [3, 4, 5, 40]], chunks)
+            nt.assert_equal(1, requests.count(None))
+            nt.assert_equal(len(requests), storage.nrequests)
+            starts = [int(r[6:].split('-')[0]) for r in requests if r]
+            with open(out_file, 'rb') as fp:
+                offsets = bloscpack._read_beginning(fp)[3]
+            nt.assert_true(offsets[3] in starts and offsets[40] in starts)
+            nt.assert_false(offsets[4] in starts or offsets[5] in starts)
+            # a single connection was used for all requests
+            nt.assert_equal(1, storage.nconnections)
+            storage.close()
+            unpack_file(url, dcmp_file)
+            cmp(in_file, dcmp_file)
+        # a server ignoring ranges sends the file once
+        with serve_file(out_file, ranges=False) as (url, requests):
+            storage = HTTPStorage(url, readahead=4096)
+            nt.assert_equal([data[i * chunk_size:(i + 1) * chunk_size]
+                             for i in [3, 40]],
+                    read_chunks(storage, [3, 40]))
+            # the size and one request for all reads
+            nt.assert_equal(2, len(requests))
+            nt.assert_equal(2, storage.nrequests)
+            storage.close()
+        nt.assert_raises(ValueError, HTTPStorage, 'ftp://example.com/a.blp')
+
+
+def test_memory_storage():
+    with create_tmp_files() as (tdir, in_file, out_file, dcmp_file):
+        create_array(1, in_file)
+        storage = MemoryStorage()
+        pack_file(in_file, storage, chunk_size='1M')
+        nt.assert_equal(len(storage.data), storage.size())
+        nt.assert_equal(MAGIC, storage.data[:4])
+        unpack_file(storage, dcmp_file)
+        cmp(in_file, dcmp_file)
+        nt.assert_raises(IOError,
+                HTTPStorage('http://localhost/a.blp').open_write)
+
+
+def test_pack_unpack_pipelined():
+    in_fp, out_fp, dcmp_fp = StringIO(), StringIO(), StringIO()
+    create_array_fp(1, in_fp)
+    in_fp_size = in_fp.tell()
+    in_fp.seek(0)
+    nchunks, chunk_size, last_chunk_size = \
+            calculate_nchunks(in_fp_size, reverse_pretty('300K'))
+    pack(PlainFPSource(in_fp), CompressedFPSink(out_fp),
+            nchunks, chunk_size, last_chunk_size, nthreads=3, max_inflight=2)
+    out_fp.seek(0)
+    unpack(CompressedFPSource(out_fp), PlainFPSink(dcmp_fp), max_inflight=2)
+    cmp_fp(in_fp, dcmp_fp)
+    # errors while reading ahead are raised in the calling thread
+    out_fp.seek(-100, 2)
+    out_fp.write('\x00' * 10)
+    out_fp.seek(0)
+    nt.assert_raises(ChecksumMismatch, unpack, CompressedFPSource(out_fp),
+            PlainFPSink(StringIO()), max_inflight=2)
+
+
+def test_memory_budget():
+    budget = MemoryBudget(100)
+    nt.assert_true(budget.acquire(60))
+    nt.assert_false(budget.acquire(60, block=False))
+    budget.release(60)
+    # an oversized item is admitted when nothing else is buffered
+    nt.assert_true(budget.acquire(150, block=False))
+    budget.release(150)
+    nt.assert_equal((0, 150), (budget.in_use, budget.peak))
+    nt.assert_raises(ValueError, MemoryBudget, 0)
+
+    in_fp, out_fp, dcmp_fp = StringIO(), StringIO(), StringIO()
+    create_array_fp(1, in_fp)
+    in_fp_size = in_fp.tell()
+    in_fp.seek(0)
+    chunk_size = reverse_pretty('100K')
+    nchunks, chunk_size, last_chunk_size = \
+            calculate_nchunks(in_fp_size, chunk_size)
+    budget = MemoryBudget(5 * chunk_size)
+    pack(PlainFPSource(in_fp), CompressedFPSink(out_fp),
+            nchunks, chunk_size, last_chunk_size, nthreads=3,
+            max_inflight=100, memory_budget=budget)
+    nt.assert_equal(0, budget.in_use)
+    nt.assert_true(2 * chunk_size <= budget.peak <= 5 * chunk_size)
+    out_fp.seek(0)
+    budget = MemoryBudget(3 * chunk_size)
+    unpack(CompressedFPSource(out_fp), PlainFPSink(dcmp_fp),
+            max_inflight=100, memory_budget=budget)
+    cmp_fp(in_fp, dcmp_fp)
+    nt.assert_equal(0, budget.in_use)
+    nt.assert_true(0 < budget.peak <= 3 * chunk_size)
+
+
+def test_unpack_file_memory_budget():
+    with create_tmp_files() as (tdir, in_file, out_file, dcmp_file):
+        create_array(1, in_file)
+        pack_file(in_file, out_file, chunk_size='100K')
+        budget = MemoryBudget(reverse_pretty('150K'))
+        unpack_file(out_file, dcmp_file, nthreads=3, memory_budget=budget)
+        cmp(in_file, dcmp_file)
+        nt.assert_equal(0, budget.in_use)
+        nt.assert_true(0 < budget.peak <= reverse_pretty('150K'))
+        # the chunks read ahead are counted without workers too
+        budget = MemoryBudget(reverse_pretty('150K'))
+        unpack_file(out_file, dcmp_file, memory_budget=budget)
+        cmp(in_file, dcmp_file)
+        nt.assert_equal(0, budget.in_use)
+        nt.assert_true(0 < budget.peak <= reverse_pretty('150K'))
+
+
+def test_pack_file_memory_budget():
+    with create_tmp_files() as (tdir, in_file, out_file, dcmp_file):
+        create_array(1, in_file)
+        budget = MemoryBudget(reverse_pretty('500K'))
+        pack_file(in_file, out_file, chunk_size='100K', nthreads=3,
+                memory_budget=budget)
+        nt.assert_equal(0, budget.in_use)
+        nt.assert_true(0 < budget.peak <= reverse_pretty('500K'))
+        unpack_file(out_file, dcmp_file)
+        cmp(in_file, dcmp_file)
+        budget = MemoryBudget(reverse_pretty('500K'))
+        pack_file_async(in_file, out_file, chunk_size='100K', nthreads=3,
+                memory_budget=budget).get()
+        nt.assert_true(0 < budget.peak <= reverse_pretty('500K'))
+        unpack_file(out_file, dcmp_file)
+        cmp(in_file, dcmp_file)
+
+
+def test_shared_memory_budget():
+    with create_tmp_files() as (tdir, in_file, out_file, dcmp_file):
+        create_array(1, in_file)
+        pack_file(in_file, out_file, chunk_size='100K')
+        budget = MemoryBudget(250000)
+        with open(out_file, 'rb') as input_fp:
+            source = CompressedFPSource(input_fp)
+            header = source.bloscpack_header
+            with open(dcmp_file, 'w+b') as output_fp:
+                output_fp.truncate(header.chunk_size * (header.nchunks - 1) +
+                        header.last_chunk)
+                sink = PlainParallelFPSink(output_fp, header.chunk_size, 3,
+                        memory_budget=budget)
+                # the read ahead and the sink share the budget, which used
+                # to deadlock, so run them with a timeout
+                thread = threading.Thread(target=unpack, args=(source, sink),
+                        kwargs={'max_inflight': 8, 'memory_budget': budget})
+                thread.daemon = True
+                thread.start()
+                thread.join(30)
+                nt.assert_false(thread.is_alive())
+        cmp(in_file, dcmp_file)
+        nt.assert_equal(0, budget.in_use)
+        nt.assert_true(0 < budget.peak <= 250000)
+
+
+def test_pipeline_stats():
+    stats = PipelineStats()
+    with stats.stage('write'):
+        with stats.stage('checksum'):
+            time.sleep(0.02)
+    nt.assert_equal(['checksum', 'write'], stats.stages())
+    nt.assert_true(stats.wall['checksum'] >= 0.02)
+    # nested stages are excluded from their parent
+    nt.assert_true(stats.wall['write'] < 0.02)
+    nt.assert_equal({'checksum': 1, 'write': 1}, stats.count)
+    nt.assert_equal([1, 2],
+            [item for frame, item in stats.timed('read', [1, 2])])
+    nt.assert_equal(3, stats.count['read'])
+    with create_tmp_files() as (tdir, in_file, out_file, dcmp_file):
+        create_array(1, in_file)
+        # nothing is timed unless asked for
+        nt.assert_equal([], pack_file(in_file, out_file,
+            chunk_size='500K').stages())
+        stats = PipelineStats()
+        nt.assert_true(stats is pack_file(in_file, out_file,
+            chunk_size='500K', stats=stats))
+        nt.assert_equal(['metadata', 'read', 'checksum', 'compress', 'write',
+                         'finalize'], stats.stages())
+        nt.assert_equal(stats.count['compress'], stats.count['write'])
+        for nthreads in (1, 2):
+            stats = PipelineStats()
+            unpack_file(out_file, dcmp_file, nthreads=nthreads, stats=stats)
+            cmp(in_file, dcmp_file)
+            nt.assert_equal(['metadata', 'read', 'checksum', 'decompress',
+                             'write', 'finalize'], stats.stages())
+            nt.assert_true(all(wall >= 0 for wall in stats.wall.values()))
+
+
+class RecordingObserver(ChunkObserver):
+
+    def __init__(self):
+        self.events = []
+        self.finished = []
+
+    def chunk(self, event):
+        self.events.append(event)
+
+    def finish(self, operation):
+        self.finished.append(operation)
+
+
+def test_chunk_observer():
+    with create_tmp_files() as (tdir, in_file, out_file, dcmp_file):
+        create_array(1, in_file)
+        in_size = path.getsize(in_file)
+        chunk_size = reverse_pretty('500K')
+        nchunks = calculate_nchunks(in_size, chunk_size)[0]
+        for nthreads in (1, 2):
+            observer = RecordingObserver()
+            with open_two_file(open(in_file, 'rb'),
+                    open(out_file, 'wb')) as (input_fp, output_fp):
+                pack(PlainFPSource(input_fp), CompressedFPSink(output_fp),
+                        *calculate_nchunks(in_size, chunk_size),
+                        nthreads=nthreads, observer=observer)
+            nt.assert_equal(['pack'], observer.finished)
+            nt.assert_equal(range(nchunks),
+                    [e.index for e in observer.events])
+            nt.assert_equal(in_size, sum(e.raw_size for e in observer.events))
+            nt.assert_true(all(e.operation == 'pack' and
+                               e.compressed_size > 0 and e.duration > 0
+                               for e in observer.events))
+        observer = RecordingObserver()
+        unpack_file(out_file, dcmp_file, observer=observer)
+        cmp(in_file, dcmp_file)
+        nt.assert_equal(['unpack'], observer.finished)
+        nt.assert_equal(in_size, sum(e.raw_size for e in observer.events))
+        nt.assert_true(all(e.codec_time > 0 for e in observer.events))
+        observer = RecordingObserver()
+        read_chunks(out_file, [2, 0, 2], observer=observer)
+        nt.assert_equal([0, 2], sorted(e.index for e in observer.events))
+        nt.assert_equal(['read'], observer.finished)
+        # appending rewrites the last chunk, and may stop there
+        last_size = in_size - (nchunks - 1) * chunk_size
+        for new_size in (in_size, 10):
+            pack_file(in_file, out_file, chunk_size=chunk_size)
+            observer = RecordingObserver()
+            with open(in_file, 'rb') as new_fp:
+                with open(out_file, 'r+b') as orig_fp:
+                    append_fp(orig_fp, new_fp, new_size, observer=observer)
+            nt.assert_equal(['append'], observer.finished)
+            nt.assert_equal(range(nchunks - 1, nchunks - 1 +
+                                  len(observer.events)),
+                    [e.index for e in observer.events])
+            nt.assert_equal(last_size + new_size,
+                    sum(e.raw_size for e in observer.events))
+            nt.assert_true(all(e.operation == 'append' and
+                               e.compressed_size > 0 for e in observer.events))
+        nt.assert_equal(1, len(observer.events))
+
+
+def test_prometheus_exporter():
+    with create_tmp_files() as (tdir, in_file, out_file, dcmp_file):
+        create_array(1, in_file)
+        metrics_file = path.join(tdir, 'bloscpack.prom')
+        exporter = PrometheusExporter(metrics_file,
+                duration_buckets=(0.5, 1000.0))
+        pack_file(in_file, out_file, chunk_size='500K', observer=exporter)
+        unpack_file(out_file, dcmp_file, observer=exporter)
+        nchunks = calculate_nchunks(path.getsize(in_file),
+                reverse_pretty('500K'))[0]
+        with open(metrics_file) as fp:
+            lines = fp.read().splitlines()
+        for operation in ('pack', 'unpack'):
+            nt.assert_true('bloscpack_chunks_total{operation="%s"} %d' %
+                    (operation, nchunks) in lines)
+            nt.assert_true('bloscpack_raw_bytes_total{operation="%s"} %d' %
+                    (operation, path.getsize(in_file)) in lines)
+            nt.assert_true('bloscpack_chunk_duration_seconds_bucket'
+                    '{operation="%s",le="1000.0"} %d' %
+                    (operation, nchunks) in lines)
+            nt.assert_true('bloscpack_chunk_ratio_count{operation="%s"} %d' %
+                    (operation, nchunks) in lines)
+        nt.assert_true('# TYPE bloscpack_chunk_ratio histogram' in lines)
+        nt.assert_false(path.exists(metrics_file + '.tmp'))
+    # sizes beyond sys.maxint, on 32 bit builds, are longs
+    exporter = PrometheusExporter(metrics_file)
+    exporter.chunk(ChunkEvent('pack', 0, 2 ** 31L, 2 ** 30L, 0.0, 0.5, 0.0,
+                              0.0))
+    lines = exporter.render().splitlines()
+    nt.assert_true('bloscpack_raw_bytes_total{operation="pack"} 2147483648'
+            in lines)
+    nt.assert_true('bloscpack_compressed_bytes_total{operation="pack"} '
+            '1073741824' in lines)
+    nt.assert_true('bloscpack_chunk_ratio_sum{operation="pack"} 0.5'
+            in lines)
+    nt.assert_false(any(line.endswith('L') for line in lines))
+
+
+def test_async_jobs():
+    with create_tmp_files() as (tdir, in_file, out_file, dcmp_file):
+        create_array(1, in_file)
+        out_files = [path.join(tdir, 'file%d.blp' % i) for i in range(4)]
+        results = [pack_file_async(in_file, f, chunk_size='500K')
+                   for f in out_files]
+        for result in results:
+            result.get()
+        finished = []
+        results = [unpack_file_async(f, f + '.dcmp',
+                                     callback=finished.append)
+                   for f in out_files]
+        for result in results:
+            nt.assert_equal(None, result.get())
+        nt.assert_equal([None] * 4, finished)
+        for f in out_files:
+            cmp(in_file, f + '.dcmp')
+        with open(in_file, 'rb') as fp:
+            data = fp.read()
+        chunk_size = reverse_pretty('500K')
+        nt.assert_equal([data[2 * chunk_size:3 * chunk_size]],
+                read_chunks_async(out_files[0], [2]).get())
+        # exceptions are raised when getting the result
+        nt.assert_raises(IndexError,
+                read_chunks_async(out_files[0], [10 ** 6]).get)
+
+
+def test_releasegil():
+    def releasegil():
+        value = blosc.set_releasegil(False)
+        blosc.set_releasegil(value)
+        return value
+    users, original = bloscpack._releasegil_users, releasegil()
+    bloscpack._acquire_releasegil()
+    bloscpack._acquire_releasegil()
+    nt.assert_true(releasegil())
+    # the first user to finish does not turn it off for the other
+    bloscpack._release_releasegil()
+    nt.assert_true(releasegil())
+    bloscpack._release_releasegil()
+    nt.assert_equal(original, releasegil())
+    # pipelines leave it as they found it
+    in_fp, out_fp = StringIO(), StringIO()
+    create_array_fp(1, in_fp)
+    in_fp.reset()
+    pack(PlainFPSource(in_fp), CompressedFPSink(out_fp),
+            *calculate_nchunks(len(in_fp.getvalue()), '1M'), nthreads=2)
+    nt.assert_equal(users, bloscpack._releasegil_users)
+    nt.assert_equal(original, releasegil())
+    # python-blosc before 1.5 has no such setting
+    set_releasegil = blosc.set_releasegil
+    del blosc.set_releasegil
+    try:
+        out_fp = StringIO()
+        in_fp.reset()
+        pack(PlainFPSource(in_fp), CompressedFPSink(out_fp),
+                *calculate_nchunks(len(in_fp.getvalue()), '1M'), nthreads=2)
+        nt.assert_equal(users, bloscpack._releasegil_users)
+    finally:
+        blosc.set_releasegil = set_releasegil
+    nt.assert_equal(original, releasegil())
+
+
+def test_compressed_mmap_source():
+    with create_tmp_files() as (tdir, in_file, out_file, dcmp_file):
+        create_array(1, in_file)
+        pack_file(in_file, out_file, chunk_size='100K')
+        with open(in_file, 'rb') as fp:
+            data = fp.read()
+        with open(out_file, 'rb') as fp:
+            source = CompressedMmapSource(fp)
+            # many threads reading chunks out of order from a single file
+            indices = list(reversed(range(source.nchunks))) * 3
+            pool = bloscpack.multiprocessing.pool.ThreadPool(8)
+            chunks = pool.map(source.decompress_chunk, indices)
+            pool.close()
+            pool.join()
+            nt.assert_equal(data, ''.join(chunks[source.nchunks - 1::-1]))
+            nt.assert_equal(chunks[:source.nchunks],
+                    chunks[source.nchunks:2 * source.nchunks])
+            # and the source can be unpacked as usual
+            dcmp_fp = StringIO()
+            unpack(source, PlainFPSink(dcmp_fp))
+            nt.assert_equal(data, dcmp_fp.getvalue())
+            source.close()
+        with open(out_file, 'r+b') as fp:
+            fp.seek(-100, 2)
+            fp.write('\x00' * 10)
+        with open(out_file, 'rb') as fp:
+            source = CompressedMmapSource(fp)
+            nt.assert_raises(ChecksumMismatch, source.read_chunk,
+                    source.nchunks - 1)
+
+
+def load_datasets():
+    """ Import the benchmark datasets, which are not in a package. """
+    return imp.load_source('datasets', path.join(path.dirname(
+        path.abspath(__file__)), 'bench', 'datasets.py'))
+
+
+def test_datasets():
+    datasets = load_datasets()
+    for family in datasets.FAMILIES:
+        data = datasets.generate(family, 12345, seed=1)
+        # the exact size and the same bytes every time
+        nt.assert_equal(12345, len(data))
+        nt.assert_equal(data, datasets.generate(family, 12345, seed=1))
+        nt.assert_not_equal(data, datasets.generate(family, 12345, seed=2))
+        nt.assert_equal('', datasets.generate(family, 0))
+    # across blocks, and independent of how much is generated
+    size = datasets.BLOCK_SIZE + 1000
+    data = datasets.generate('noise', size)
+    nt.assert_equal(size, len(data))
+    nt.assert_equal(data[:1000], datasets.generate('noise', 1000))
+    with create_tmp_files() as (tdir, in_file, out_file, dcmp_file):
+        datasets.write('noise', in_file, size)
+        with open(in_file, 'rb') as fp:
+            nt.assert_equal(data, fp.read())
+        # and in another process
+        root = path.dirname(path.abspath(__file__))
+        subprocess.check_call([sys.executable,
+            path.join(root, 'bench', 'datasets.py'), 'json_logs', '20K',
+            in_file, '--seed', '3'],
+            env=dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None,
+                [root, os.environ.get('PYTHONPATH')]))))
+        with open(in_file, 'rb') as fp:
+            nt.assert_equal(datasets.generate('json_logs', 20480, seed=3),
+                    fp.read())
+    nt.assert_equal(8, datasets.typesize('smooth'))
+    nt.assert_raises(ValueError, datasets.generate, 'no_such_family', 10)
+
+
+def load_bench_suite():
+    """ Import the benchmark suite, which needs the datasets. """
+    load_datasets()
+    return imp.load_source('bench_suite', path.join(path.dirname(
+        path.abspath(__file__)), 'bench', 'bench_suite.py'))
+
+
+def bench_report(times):
+    settings = {'cname': 'blosclz', 'clevel': 7, 'shuffle': True,
+                'typesize': 8, 'chunk_size': reverse_pretty('1M'),
+                'nthreads': 1}
+    return {'environment': {},
+            'results': [{'scenario': 'pack', 'settings': settings,
+                         'times_s': times}]}
+
+
+def test_bench_mann_whitney():
+    bench_suite = load_bench_suite()
+    nt.assert_almost_equal(0.0404277991850,
+            bench_suite.mann_whitney([1, 2, 3], [4, 5, 6]))
+    nt.assert_almost_equal(0.9854518341294,
+            bench_suite.mann_whitney([4, 5, 6], [1, 2, 3]))
+    # with ties
+    nt.assert_almost_equal(0.0820798642393,
+            bench_suite.mann_whitney([1, 2, 2], [2, 3, 4]))
+    # all tied
+    nt.assert_equal(1.0, bench_suite.mann_whitney([1, 1], [1, 1]))
+    # the fallback for Python 2.6, which has no math.erfc
+    for x, expected in [(-3, 1.9999779095), (-1.2, 1.9103139782),
+                        (-0.1, 1.1124629160), (0, 1.0), (0.5, 0.4795001222),
+                        (1.7456, 0.0135623345), (4, 0.0000000154)]:
+        nt.assert_almost_equal(expected, bench_suite._erfc(x))
+
+
+def test_bench_compare():
+    bench_suite = load_bench_suite()
+    def status(baseline, current, tolerance, alpha=0.05):
+        rows = bench_suite.compare(bench_report(baseline),
+                bench_report(current), tolerance, alpha)
+        nt.assert_equal(1, len(rows))
+        return rows[0]['status']
+    # the medians differ by exactly 25%, and 50% the other way round
+    slow = [1.0, 1.0625, 1.125, 1.1875, 1.25]
+    slower = [1.3, 1.35, 1.40625, 1.45, 1.5]
+    fast = [1.3, 1.4, 1.5, 1.6, 1.7]
+    faster = [0.5, 0.6, 0.75, 0.8, 0.9]
+    nt.assert_equal('regression', status(slow, slower, 0.24))
+    nt.assert_equal('ok', status(slow, slower, 0.25))
+    nt.assert_equal('improvement', status(fast, faster, 0.49))
+    nt.assert_equal('ok', status(fast, faster, 0.5))
+    nt.assert_equal('ok', status(slow, slow, 0.0))
+    # changes beyond the tolerance must be significant too
+    nt.assert_equal('ok', status([1.0], [2.0], 0.05))
+    nt.assert_equal('ok', status(slow, slower, 0.05, alpha=0.001))
+
+
+def test_bench_compare_command():
+    bench = path.join(path.dirname(path.abspath(__file__)), 'bench')
+    with create_tmp_files() as (tdir, in_file, out_file, dcmp_file):
+        files = {}
+        for name, times in [('slow', [1.0, 1.0625, 1.125, 1.1875, 1.25]),
+                            ('slower', [1.3, 1.35, 1.40625, 1.45, 1.5])]:
+            files[name] = path.join(tdir, name + '.json')
+            with open(files[name], 'w') as fp:
+                json.dump(bench_report(times), fp)
+        def compare(baseline, current):
+            with open(os.devnull, 'w') as devnull:
+                return subprocess.call([sys.executable,
+                    path.join(bench, 'bench_suite.py'),
+                    '--baseline', files[baseline], '--compare',
+                    files[current]], stdout=devnull,
+                    env=dict(os.environ, PYTHONPATH=os.pathsep.join(filter(
+                        None, [path.dirname(bench),
+                               os.environ.get('PYTHONPATH')]))))
+        nt.assert_equal(1, compare('slow', 'slower'))
+        nt.assert_equal(0, compare('slower', 'slow'))
+        nt.assert_equal(0, compare('slow', 'slow'))
+
+
 def cmp(file1, file2):
     """ File comparison utility with a small chunksize """
     with open_two_file(open(file1, 'rb'), open(file2, 'rb')) as \